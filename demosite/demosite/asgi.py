@@ -1,7 +1,9 @@
 """
 ASGI config for demosite project.
 
-It exposes the ASGI callable as a module-level variable named ``application``.
+It exposes the ASGI callable as a module-level variable named ``application``. Requests for /schedule/events, the
+board's push channel, are served by scheduleboard.push when SCHEDULEBOARD_PUSH_ENABLED is set; everything else goes to
+Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
@@ -13,4 +15,8 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'demosite.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from scheduleboard.push import PushApplication  # only once get_asgi_application() has loaded the apps
+
+application = PushApplication(django_application)
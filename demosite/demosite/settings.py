@@ -57,6 +57,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'scheduleboard.metrics.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -135,3 +136,98 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.0/howto/static-files/
 
 STATIC_URL = '/static/'
+
+# Schedule board
+
+# How long (in seconds) a station's schedule is cached before the MBTA API is called again,
+# and how many (station, minute) entries the cache holds.
+SCHEDULEBOARD_CACHE_TTL = 30
+SCHEDULEBOARD_CACHE_SIZE = 64
+
+# When enabled, a background thread refreshes every station in STATION_CHOICES every SCHEDULEBOARD_POLL_INTERVAL
+# seconds, and page loads read the latest snapshot instead of calling the MBTA API.
+SCHEDULEBOARD_POLLER_ENABLED = False
+SCHEDULEBOARD_POLL_INTERVAL = 10
+
+# Schedules barely change, so they are kept in a sliding window: every SCHEDULEBOARD_SCHEDULE_INTERVAL seconds the
+# schedules that have passed are dropped and only the newly uncovered end of the window is fetched, and the whole
+# window is fetched again every SCHEDULEBOARD_WINDOW_RESET seconds. Every refresh fetches just the predictions and
+# merges them by trip and stop. Set SCHEDULEBOARD_SCHEDULE_INTERVAL to 0 to fetch both on every refresh.
+SCHEDULEBOARD_SCHEDULE_INTERVAL = 600
+SCHEDULEBOARD_WINDOW_RESET = 3600
+
+# Every call to the MBTA API gives up after MBTA_API_TIMEOUT seconds (a (connect, read) tuple) and is retried at most
+# MBTA_API_RETRIES times.
+MBTA_API_TIMEOUT = (3.05, 10)
+MBTA_API_RETRIES = 2
+
+# Routes are shared by every snapshot and only rebuilt from fresh API data every SCHEDULEBOARD_ROUTE_REFRESH seconds.
+SCHEDULEBOARD_ROUTE_REFRESH = 3600
+
+# How many rendered board pages (one per station and snapshot version) are kept for reuse.
+SCHEDULEBOARD_PAGE_CACHE_SIZE = 64
+
+# Open boards fetch only their changed rows from /schedule/api every SCHEDULEBOARD_CLIENT_REFRESH seconds; the last
+# SCHEDULEBOARD_DELTA_HISTORY versions of each station are remembered to compute those changes.
+SCHEDULEBOARD_CLIENT_REFRESH = 30
+SCHEDULEBOARD_DELTA_HISTORY = 20
+
+# When SCHEDULEBOARD_STORE_ENABLED is set, the board is read from the database (see scheduleboard/store.py), which is
+# filled by `python manage.py ingest`. Stored schedules are kept for SCHEDULEBOARD_STORE_RETENTION seconds.
+SCHEDULEBOARD_STORE_ENABLED = False
+SCHEDULEBOARD_STORE_RETENTION = 86400
+
+# When SCHEDULEBOARD_GTFS_ENABLED is set, schedules are computed from the GTFS feed imported with
+# `python manage.py importgtfs`, and only predictions are fetched from the MBTA API.
+SCHEDULEBOARD_GTFS_ENABLED = False
+
+# The MBTA API key sent with every call (see https://api-v3.mbta.com/), read from the environment. Calls are spaced
+# out to stay within MBTA_API_RATE_LIMIT calls per minute (by default 1000 with a key and 20 without), and a call that
+# cannot get through within MBTA_API_QUEUE_TIMEOUT seconds is shed. Refreshes of stations viewed in the last
+# SCHEDULEBOARD_VIEWER_TTL seconds take priority over idle ones.
+MBTA_API_KEY = os.environ.get('MBTA_API_KEY')
+MBTA_API_RATE_LIMIT = None
+MBTA_API_QUEUE_TIMEOUT = 5
+SCHEDULEBOARD_VIEWER_TTL = 120
+
+# When SCHEDULEBOARD_SHARED_DIR is set, every worker process reads the snapshots that a single
+# `python manage.py publishsnapshots` writes there (see scheduleboard/shared.py), instead of fetching them itself.
+# Snapshots written more than SCHEDULEBOARD_SHARED_MAX_AGE seconds ago are ignored. The snapshots are pickled, so the
+# directory must only be writable by the site.
+SCHEDULEBOARD_SHARED_DIR = None
+SCHEDULEBOARD_SHARED_MAX_AGE = 120
+
+# After MBTA_API_FAILURE_THRESHOLD failed calls in a row (errors, timeouts and 5xx responses), calls to the MBTA API
+# fail at once and only one probe call is let through every MBTA_API_PROBE_INTERVAL seconds until it recovers (see
+# scheduleboard/breaker.py). Meanwhile, the board serves the last good snapshot of each station, for up to
+# SCHEDULEBOARD_STALE_TTL seconds, and labels boards older than SCHEDULEBOARD_STALE_AFTER seconds with their age.
+# With SCHEDULEBOARD_STALE_WHILE_REVALIDATE, page loads never wait on the MBTA API once a station has been fetched:
+# the last good snapshot is served right away, and a fresh one is fetched in the background by up to
+# SCHEDULEBOARD_REVALIDATE_WORKERS threads.
+MBTA_API_FAILURE_THRESHOLD = 5
+MBTA_API_PROBE_INTERVAL = 30
+SCHEDULEBOARD_STALE_TTL = 3600
+SCHEDULEBOARD_STALE_AFTER = 90
+SCHEDULEBOARD_STALE_WHILE_REVALIDATE = False
+SCHEDULEBOARD_REVALIDATE_WORKERS = 2
+
+# On ASGI deployments (e.g. `uvicorn demosite.asgi:application`), set SCHEDULEBOARD_PUSH_ENABLED so open boards receive
+# their changes over /schedule/events (see scheduleboard/push.py) instead of polling /schedule/api. Each subscribed
+# station is refreshed every SCHEDULEBOARD_PUSH_INTERVAL seconds; a display with more than SCHEDULEBOARD_PUSH_QUEUE
+# updates waiting is sent a single full board instead, and idle connections get a keepalive every
+# SCHEDULEBOARD_PUSH_HEARTBEAT seconds.
+SCHEDULEBOARD_PUSH_ENABLED = False
+SCHEDULEBOARD_PUSH_INTERVAL = 10
+SCHEDULEBOARD_PUSH_QUEUE = 8
+SCHEDULEBOARD_PUSH_HEARTBEAT = 15
+
+# The multi-station board (/schedule/multi?stations=place-sstat,place-north) fetches its stations in parallel on up to
+# SCHEDULEBOARD_MULTI_WORKERS threads, and waits at most SCHEDULEBOARD_MULTI_TIMEOUT seconds for them: a station that
+# is slower than that shows its last good snapshot, or a notice, instead of holding up the page.
+SCHEDULEBOARD_MULTI_WORKERS = 8
+SCHEDULEBOARD_MULTI_TIMEOUT = 5
+
+# When SCHEDULEBOARD_STREAMING is set, every station in STATION_CHOICES keeps a stream of its schedules and predictions
+# open to the MBTA streaming API (see scheduleboard/streaming.py), which requires MBTA_API_KEY, and the board is built
+# from those streams instead of polling. Stations fall back to polling until their streams have started.
+SCHEDULEBOARD_STREAMING = False
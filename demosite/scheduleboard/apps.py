@@ -1,4 +1,7 @@
 from django.apps import AppConfig
+from django.conf import settings
+import os
+import sys
 
 
 class ScheduleboardConfig(AppConfig):
@@ -6,3 +9,22 @@ class ScheduleboardConfig(AppConfig):
     We create a single app, the scheduleboard app
     """
     name = 'scheduleboard'
+
+    def ready(self):
+        """
+        Starts the background poller when SCHEDULEBOARD_POLLER_ENABLED is set, and the streams of every station when
+        SCHEDULEBOARD_STREAMING is set.
+        Under runserver's autoreloader, only the child process that actually serves requests starts them.
+        """
+        poller_enabled = getattr(settings, 'SCHEDULEBOARD_POLLER_ENABLED', False)
+        streaming_enabled = getattr(settings, 'SCHEDULEBOARD_STREAMING', False)
+        if not (poller_enabled or streaming_enabled):
+            return
+        if 'runserver' in sys.argv and os.environ.get('RUN_MAIN') != 'true':
+            return
+        if streaming_enabled:
+            from . import streaming
+            streaming.start_streams()
+        if poller_enabled:
+            from . import poller
+            poller.start_poller()
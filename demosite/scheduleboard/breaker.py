@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+
+"""
+This file contains the circuit breaker in front of the MBTA API. After a run of failed calls (connection errors,
+timeouts and 5xx responses) the circuit opens: calls fail at once with CircuitOpen instead of tying up a worker thread
+until they time out, and a single probe call is let through every reset_timeout seconds to find out whether the API
+has recovered. The first successful call closes the circuit again.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling the MBTA API while the circuit is open.
+    """
+    pass
+
+
+class CircuitBreaker:
+    """
+    A thread-safe circuit breaker, shared by the blocking and the asyncio clients.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        """
+        Creates a new, closed breaker
+        :param failure_threshold: the number of consecutive failed calls that opens the circuit
+        :param reset_timeout: while the circuit is open, one probe call is let through every reset_timeout seconds
+        :param clock: a function returning the current time in seconds, mostly useful for tests
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None  # None while the circuit is closed
+        self._probe_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """
+        :return: True if a call may be made now: the circuit is closed, or it is time for the next probe
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = self.clock()
+            if now < self._probe_at:
+                return False
+            self._probe_at = now + self.reset_timeout  # one probe per reset_timeout, however many callers there are
+            logger.info("Probing the MBTA API")
+            return True
+
+    def record_success(self):
+        """
+        Records a call that got an answer, closing the circuit if it was open.
+        """
+        with self._lock:
+            if self.opened_at is not None:
+                logger.warning(f"The MBTA API recovered after {self.clock() - self.opened_at:.0f} seconds")
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        """
+        Records a failed call, opening the circuit after failure_threshold of them in a row.
+        """
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is None and self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+                self._probe_at = self.opened_at + self.reset_timeout
+                logger.warning(f"The MBTA API failed {self.failures} times in a row, calling it only every "
+                               f"{self.reset_timeout} seconds until it recovers")
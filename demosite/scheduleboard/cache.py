@@ -0,0 +1,132 @@
+from collections import OrderedDict
+import logging
+import threading
+import time
+from . import metrics
+
+"""
+This file contains a small in-process cache used to keep the schedule board from calling the MBTA API once per page
+view. Entries expire after a fixed time-to-live, the cache holds a bounded number of entries (least recently used
+entries are evicted first), and concurrent misses for the same key share a single fetch.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class _InFlight:
+    """
+    Book-keeping for a fetch that is currently running. Threads that miss on a key while another thread is already
+    fetching it wait on the event and then read the shared result (or error).
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    """
+    A thread-safe, size-bounded cache whose entries expire after ttl seconds.
+    """
+
+    def __init__(self, ttl, max_size, clock=time.monotonic, name=None):
+        """
+        Creates a new cache
+        :param ttl: the number of seconds an entry stays fresh
+        :param max_size: the maximum number of entries held; the least recently used entry is evicted first
+        :param clock: a function returning the current time in seconds, mostly useful for tests
+        :param name: if given, hits and misses are counted under this name, see metrics.count_cache
+        """
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._in_flight = {}  # key -> _InFlight
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_fetch(self, key, fetch):
+        """
+        Returns the cached value for key, calling fetch() to produce it if there is no fresh entry.
+        If another thread is already fetching the same key, this waits for that fetch instead of starting a new one.
+        :param key: any hashable key
+        :param fetch: a function taking no arguments that returns the value to cache
+        :return: the cached (or freshly fetched) value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > self.clock():
+                self._entries.move_to_end(key)
+                self._count(True)
+                return entry[1]
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _InFlight()
+                self._in_flight[key] = flight
+        self._count(not leader)  # waiting on another thread's fetch counts as a hit
+
+        if not leader:
+            logger.debug(f"Waiting on in-flight fetch for {key}")
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = fetch()
+        except BaseException as e:
+            # waiters get the error too, rather than a None they would take for the value; an interruption of this
+            # thread (e.g. KeyboardInterrupt) is not theirs to re-raise, so they get a RuntimeError instead
+            flight.error = e if isinstance(e, Exception) else RuntimeError(f"The fetch of {key} was interrupted")
+            raise
+        else:
+            self.set(key, flight.value)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            flight.event.set()
+        return flight.value
+
+    def get(self, key):
+        """
+        Returns the cached value for key without fetching anything. Useful where waiting on another thread's fetch
+        is not an option, such as in async code.
+        :param key: any hashable key
+        :return: the cached value, or None if there is no fresh entry
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > self.clock():
+                self._entries.move_to_end(key)
+                self._count(True)
+                return entry[1]
+        self._count(False)
+        return None
+
+    def _count(self, hit):
+        if self.name:
+            metrics.count_cache(self.name, hit)
+
+    def set(self, key, value):
+        """
+        Stores value under key, evicting the least recently used entries if the cache is full.
+        :param key: any hashable key
+        :param value: the value to store
+        """
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
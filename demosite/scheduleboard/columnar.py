@@ -0,0 +1,108 @@
+try:
+    import numpy  # optional, only needed for ScheduleTable
+except ImportError:
+    numpy = None
+
+"""
+This file contains an optional columnar representation of a station's schedule. Scheduled times, route types,
+direction ids and prediction deltas are held in NumPy arrays, so sorting, slicing a time window and filtering by
+route type are done with vectorized operations instead of per-row Python calls. This pays off when a full day of
+schedules is held for many stations and sliced for every request: services.select_rows filters every snapshot by
+route type through its table (see models.StationSnapshot.get_table) when NumPy is installed.
+
+NumPy is not a requirement of the schedule board; install it with `pip install numpy` to use this module.
+"""
+
+
+class ScheduleTable:
+    """
+    A station's schedule, stored as parallel NumPy arrays sorted by scheduled time.
+    Tables are immutable; window() and filter() return new tables that share memory with this one where possible.
+    """
+
+    def __init__(self, rows, times, route_types, direction_ids, prediction_deltas):
+        """
+        Creates a table from columns that are already sorted by time. Use ScheduleTable.from_schedule to build one
+        from a list of models.Schedule objects.
+        :param rows: an object array of the models.Schedule objects
+        :param times: a float64 array of scheduled times, in seconds since the epoch
+        :param route_types: an int8 array of route types
+        :param direction_ids: an int8 array of direction ids
+        :param prediction_deltas: a float64 array of predicted minus scheduled time in seconds (NaN if no prediction)
+        """
+        self.rows = rows
+        self.times = times
+        self.route_types = route_types
+        self.direction_ids = direction_ids
+        self.prediction_deltas = prediction_deltas
+
+    @classmethod
+    def from_schedule(cls, schedule, presorted=False):
+        """
+        Builds a table from a list of schedules, in any order.
+        :param schedule: a list of models.Schedule objects
+        :param presorted: True if schedule is already in the order the table should keep, e.g. a snapshot's
+        :return: a new ScheduleTable, sorted by scheduled time
+        """
+        if numpy is None:
+            raise ImportError("ScheduleTable requires numpy, install it with `pip install numpy`")
+        count = len(schedule)
+        rows = numpy.empty(count, dtype=object)
+        rows[:] = schedule
+        times = numpy.fromiter((s.get_scheduled_time().timestamp() for s in schedule), dtype=numpy.float64,
+                               count=count)
+        route_types = numpy.fromiter((s.route.route_type for s in schedule), dtype=numpy.int8, count=count)
+        direction_ids = numpy.fromiter((s.direction_id for s in schedule), dtype=numpy.int8, count=count)
+        predicted = numpy.fromiter(
+            (s.prediction.get_display_time().timestamp()
+             if s.prediction and s.prediction.get_display_time() else numpy.nan for s in schedule),
+            dtype=numpy.float64, count=count)
+
+        if presorted:
+            return cls(rows, times, route_types, direction_ids, predicted - times)
+        order = numpy.argsort(times, kind="stable")
+        times = times[order]
+        return cls(rows[order], times, route_types[order], direction_ids[order], predicted[order] - times)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _take(self, index):
+        return ScheduleTable(self.rows[index], self.times[index], self.route_types[index], self.direction_ids[index],
+                             self.prediction_deltas[index])
+
+    def window(self, start=None, end=None):
+        """
+        Returns the rows scheduled in [start, end). Since the table is sorted, this is a binary search and a slice.
+        :param start: a timezone aware datetime, or None for no lower bound
+        :param end: a timezone aware datetime, or None for no upper bound
+        :return: a new ScheduleTable
+        """
+        first = 0 if start is None else numpy.searchsorted(self.times, start.timestamp(), side="left")
+        last = len(self) if end is None else numpy.searchsorted(self.times, end.timestamp(), side="left")
+        return self._take(slice(first, last))
+
+    def filter(self, route_types=None, direction_id=None):
+        """
+        Returns only the rows matching the given route types and direction.
+        :param route_types: an iterable of route types to keep, or None to keep all of them
+        :param direction_id: the direction id to keep, or None to keep both directions
+        :return: a new ScheduleTable
+        """
+        mask = numpy.ones(len(self), dtype=bool)
+        if route_types is not None:
+            matches = numpy.zeros(len(self), dtype=bool)
+            for route_type in set(route_types):  # at most a handful, cheaper than numpy.isin
+                matches |= self.route_types == route_type
+            mask &= matches
+        if direction_id is not None:
+            mask &= self.direction_ids == direction_id
+        return self._take(mask)
+
+    def to_list(self, limit=None, offset=0):
+        """
+        :param limit: the maximum number of rows to return, or None for all of them
+        :param offset: the number of rows to skip
+        :return: a list of the models.Schedule objects in this table, in chronological order
+        """
+        return self.rows[offset:None if limit is None else offset + limit].tolist()
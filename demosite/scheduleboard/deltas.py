@@ -0,0 +1,93 @@
+from collections import OrderedDict
+import threading
+from . import display
+
+"""
+This file contains the JSON representation of a station's board, and a log of recent board versions so that clients
+can ask for only the rows that were added, changed or removed since the version they already have.
+"""
+
+
+def serialize_row(schedule):
+    """
+    Creates the JSON representation of a single row of the board.
+    :param schedule: a models.Schedule
+    :return: a dictionary of JSON serializable values
+    """
+    route = schedule.route
+    scheduled_time = schedule.get_scheduled_time()
+    predicted_time = schedule.prediction.get_display_time() if schedule.prediction else None
+    return {
+        'id': schedule.id,
+        'scheduled_time': scheduled_time.isoformat(),
+        'scheduled_display': display.format_time(scheduled_time),
+        'predicted_time': predicted_time.isoformat() if predicted_time else None,
+        'predicted_display': display.format_time(predicted_time),
+        'direction_id': schedule.direction_id,
+        'destination': schedule.get_destination(),
+        'status': schedule.get_status(),
+        'route': {
+            'id': route.id,
+            'name': route.get_name(),
+            'color': route.color,
+            'text_color': route.text_color,
+            'route_type': route.route_type,
+        },
+    }
+
+
+class DeltaLog:
+    """
+    Remembers the serialized rows of the last few versions of each station's board, so that a delta between any of
+    them and the current version can be computed.
+    """
+
+    def __init__(self, history=20):
+        """
+        Creates a new log
+        :param history: how many versions are remembered per station
+        """
+        self.history = history
+        self._versions = {}  # station -> OrderedDict of version -> {row id: row}
+        self._lock = threading.Lock()
+
+    def record(self, snapshot):
+        """
+        Remembers a snapshot's rows, serializing them only if its version has not been seen before.
+        :param snapshot: a models.StationSnapshot
+        :return: a dictionary of row id -> serialized row, in chronological order
+        """
+        version = snapshot.get_version()
+        with self._lock:
+            versions = self._versions.setdefault(snapshot.station, OrderedDict())
+            rows = versions.get(version)
+        if rows is None:
+            rows = OrderedDict((s.id, serialize_row(s)) for s in snapshot.schedule)
+            with self._lock:
+                versions[version] = rows
+                while len(versions) > self.history:
+                    versions.popitem(last=False)
+        return rows
+
+    def get_board(self, snapshot, since=None):
+        """
+        Creates the JSON board for a snapshot. If since is a version we remember, only the changes are included.
+        :param snapshot: the current models.StationSnapshot
+        :param since: the version the client already has, or None
+        :return: a dictionary with the station, the current version, when it was fetched, and either "rows"
+        (full=True) or "upserts" and "removed" (full=False)
+        """
+        rows = self.record(snapshot)
+        board = {'station': snapshot.station, 'version': snapshot.get_version(),
+                 'fetched_at': snapshot.fetched_at.isoformat() if snapshot.fetched_at else None}
+        with self._lock:
+            previous = self._versions[snapshot.station].get(since) if since else None
+        if previous is None:
+            board['full'] = True
+            board['rows'] = list(rows.values())
+            return board
+        board['full'] = False
+        board['since'] = since
+        board['upserts'] = [row for row_id, row in rows.items() if previous.get(row_id) != row]
+        board['removed'] = [row_id for row_id in previous if row_id not in rows]
+        return board
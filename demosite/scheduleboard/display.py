@@ -0,0 +1,80 @@
+from django.utils import dateformat, timezone
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+from collections import namedtuple
+import functools
+
+"""
+This file contains the display rows the schedule board is rendered from. Each row holds the formatted strings shown in
+one line of the board, so the template does not call methods or apply filters per row. Formatted times are cached per
+timestamp, route cells per route, and the HTML of each row per row, so rows that did not change between snapshots
+cost a dictionary lookup to render.
+"""
+
+# One line of the board: every value is already formatted for display.
+DisplayRow = namedtuple('DisplayRow', ['id', 'timestamp', 'scheduled', 'predicted', 'route_type', 'line',
+                                       'destination', 'status', 'color', 'text_color'])
+
+
+def format_time(value):
+    """
+    :param value: a timezone aware datetime, or None
+    :return: the time formatted like the board shows it (e.g. 3:05 PM) in the current time zone, or an empty string
+    """
+    if not value:
+        return ""
+    return _format_time(value, timezone.get_current_timezone_name())
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_time(value, zone):
+    return dateformat.format(value.astimezone(timezone.get_current_timezone()), 'g:i A')
+
+
+def build_row(schedule):
+    """
+    :param schedule: a models.Schedule
+    :return: its DisplayRow
+    """
+    route = schedule.route
+    scheduled = schedule.get_scheduled_time()
+    predicted = schedule.prediction.get_display_time() if schedule.prediction else None
+    return DisplayRow(schedule.id, int(scheduled.timestamp()), format_time(scheduled), format_time(predicted),
+                      route.route_type, route.get_name(), schedule.get_destination(), schedule.get_status(),
+                      route.color, route.text_color)
+
+
+def build_rows(schedule):
+    """
+    :param schedule: a list of models.Schedule
+    :return: a tuple of DisplayRows, in the same order
+    """
+    return tuple(build_row(s) for s in schedule)
+
+
+@functools.lru_cache(maxsize=1024)
+def route_cells(color, text_color, line, destination):
+    """
+    :return: the HTML of the line and destination cells, in the route's colors
+    """
+    return format_html('<td style="color:{}" bgcolor="{}">{}</td><td style="color:{}" bgcolor="{}">{}</td>',
+                       text_color, color, line, text_color, color, destination)
+
+
+@functools.lru_cache(maxsize=8192)
+def render_row(row):
+    """
+    :param row: a DisplayRow
+    :return: the HTML of the row's <tr>
+    """
+    return format_html('<tr class="route_type_{}" data-id="{}" data-time="{}"><td>{}</td><td>{}</td>{}<td>{}</td></tr>',
+                       row.route_type, row.id, row.timestamp, row.scheduled, row.predicted,
+                       route_cells(row.color, row.text_color, row.line, row.destination), row.status)
+
+
+def render_rows(rows):
+    """
+    :param rows: an iterable of DisplayRows
+    :return: the HTML of every row, safe to include in the template as is
+    """
+    return mark_safe("\n".join(render_row(row) for row in rows))
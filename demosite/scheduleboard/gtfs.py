@@ -0,0 +1,217 @@
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta
+import csv
+import io
+import logging
+import zipfile
+from .models import (Schedule, Route, GtfsRoute, GtfsService, GtfsServiceException, GtfsTrip, GtfsStopTime)
+
+"""
+This file contains a local copy of the MBTA's GTFS static feed (https://www.mbta.com/developers/gtfs). Static schedules
+only change when a new feed is published, so instead of asking the MBTA API for six hours of schedules on every page
+load, the feed is imported once (see import_feed, or `python manage.py importgtfs`) and the board's schedules are
+computed locally by get_schedule. Only predictions still come from the MBTA API.
+"""
+
+logger = logging.getLogger(__name__)
+
+# The number of rows per INSERT statement while importing
+BATCH_SIZE = 2000
+
+
+def parse_gtfs_time(value):
+    """
+    :param value: a GTFS time such as "08:05:00" or "25:10:00" (after midnight, on the same service day)
+    :return: the number of seconds after noon minus 12 hours on the service day, or None for an empty value
+    """
+    if not value:
+        return None
+    hours, minutes, seconds = value.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def parse_gtfs_date(value):
+    """
+    :param value: a GTFS date such as "20200420"
+    :return: a datetime.date
+    """
+    return date(int(value[:4]), int(value[4:6]), int(value[6:]))
+
+
+def read_table(feed, name):
+    """
+    :param feed: an open zipfile.ZipFile
+    :param name: the name of a file in the feed, e.g. "trips.txt"
+    :return: an iterator of dictionaries, one per row, or an empty list if the feed does not contain the file
+    """
+    if name not in feed.namelist():
+        return []
+    return csv.DictReader(io.TextIOWrapper(feed.open(name), encoding="utf-8-sig", newline=""))
+
+
+def import_feed(path, stations):
+    """
+    Replaces the imported feed with the GTFS zip at path. Only the stop times at the given stations, and the trips,
+    routes and services they use, are kept, which keeps the local copy small.
+    :param path: the path (or file object) of a GTFS zip file
+    :param stations: an iterable of parent station ids, e.g. the keys of models.STATION_CHOICES
+    :return: a dictionary of model name -> number of rows imported
+    """
+    stations = set(stations)
+    with zipfile.ZipFile(path) as feed:
+        parents = {row["stop_id"]: row.get("parent_station") or row["stop_id"]
+                   for row in read_table(feed, "stops.txt")}
+
+        stop_times = []
+        for row in read_table(feed, "stop_times.txt"):
+            station = parents.get(row["stop_id"], row["stop_id"])
+            if station not in stations:
+                continue
+            arrival = None if row.get("drop_off_type") == "1" else parse_gtfs_time(row["arrival_time"])
+            departure = None if row.get("pickup_type") == "1" else parse_gtfs_time(row["departure_time"])
+            if arrival is None and departure is None:
+                continue  # the trip passes through without stopping for passengers
+            stop_times.append(GtfsStopTime(
+                trip_id=row["trip_id"], station=station, stop_id=row["stop_id"],
+                stop_sequence=int(row["stop_sequence"]), arrival_seconds=arrival, departure_seconds=departure,
+                scheduled_seconds=departure if departure is not None else arrival))
+        trip_ids = {stop_time.trip_id for stop_time in stop_times}
+
+        trips = []
+        headsigns = defaultdict(Counter)  # (route, direction) -> trip headsign counts
+        for row in read_table(feed, "trips.txt"):
+            if row["trip_id"] in trip_ids:
+                direction_id = int(row.get("direction_id") or 0)
+                trips.append(GtfsTrip(id=row["trip_id"], route_id=row["route_id"], service_id=row["service_id"],
+                                      direction_id=direction_id))
+                headsigns[row["route_id"], direction_id][row.get("trip_headsign", "")] += 1
+        route_ids = {trip.route_id for trip in trips}
+        service_ids = {trip.service_id for trip in trips}
+
+        directions = {}  # (route, direction) -> (direction name, destination), from the MBTA's directions.txt
+        for row in read_table(feed, "directions.txt"):
+            directions[row["route_id"], int(row["direction_id"])] = (row["direction"], row["direction_destination"])
+
+        routes = []
+        for row in read_table(feed, "routes.txt"):
+            rid = row["route_id"]
+            if rid not in route_ids:
+                continue
+            names, destinations = [], []
+            for direction_id in (0, 1):
+                name, destination = directions.get((rid, direction_id), ("", None))
+                if destination is None:  # no directions.txt, use the most common trip headsign instead
+                    common = headsigns[rid, direction_id].most_common(1)
+                    destination = common[0][0] if common else ""
+                names.append(name)
+                destinations.append(destination)
+            routes.append(GtfsRoute(
+                id=rid, color=row.get("route_color", ""), text_color=row.get("route_text_color", ""),
+                short_name=row.get("route_short_name", ""), long_name=row.get("route_long_name", ""),
+                dir_destinations=destinations, dir_names=names, route_type=int(row["route_type"])))
+
+        services = [GtfsService(id=row["service_id"], days="".join(row[day] for day in (
+            "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")),
+            start_date=parse_gtfs_date(row["start_date"]), end_date=parse_gtfs_date(row["end_date"]))
+            for row in read_table(feed, "calendar.txt") if row["service_id"] in service_ids]
+        exceptions = [GtfsServiceException(service_id=row["service_id"], date=parse_gtfs_date(row["date"]),
+                                           exception_type=int(row["exception_type"]))
+                      for row in read_table(feed, "calendar_dates.txt") if row["service_id"] in service_ids]
+
+    with transaction.atomic():
+        for model in (GtfsStopTime, GtfsTrip, GtfsRoute, GtfsServiceException, GtfsService):
+            model.objects.all().delete()
+        for model, rows in ((GtfsRoute, routes), (GtfsTrip, trips), (GtfsStopTime, stop_times),
+                            (GtfsService, services), (GtfsServiceException, exceptions)):
+            model.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+    counts = {"routes": len(routes), "trips": len(trips), "stop times": len(stop_times), "services": len(services),
+              "service exceptions": len(exceptions)}
+    logger.info(f"Imported GTFS feed: {counts}")
+    return counts
+
+
+def get_active_services(days):
+    """
+    Finds the services that run on each of the given days, from calendar.txt and calendar_dates.txt.
+    :param days: a list of datetime.date
+    :return: a dictionary of date -> set of service ids
+    """
+    active = {day: set() for day in days}
+    for service in GtfsService.objects.filter(start_date__lte=max(days), end_date__gte=min(days)):
+        for day in days:
+            if service.start_date <= day <= service.end_date and service.days[day.weekday()] == "1":
+                active[day].add(service.id)
+    for exception in GtfsServiceException.objects.filter(date__in=days):
+        if exception.exception_type == 1:
+            active[exception.date].add(exception.service_id)
+        else:
+            active[exception.date].discard(exception.service_id)
+    return active
+
+
+def service_day_start(day):
+    """
+    :param day: a datetime.date
+    :return: noon minus 12 hours on day in the current time zone, which is what GTFS times count from. This is
+    midnight, except on days when daylight saving time starts or ends.
+    """
+    return timezone.make_aware(datetime(day.year, day.month, day.day, 12)) - timedelta(hours=12)
+
+
+def get_schedule(min_time, station_name, hours=6, route_types=None):
+    """
+    Computes a station's schedules for the hours starting at min_time from the imported feed, like
+    services.get_schedules_routes_and_predictions does with the MBTA API. Every service day the window touches is
+    included: trips of the previous service day that run past midnight, so a window starting at 00:30 still shows the
+    24:40 (00:40) departures, and the next service day's first trips for a window starting late in the evening.
+    The schedules are read with a single query on the (station, scheduled_seconds) index.
+    :param min_time: a timezone aware datetime
+    :param station_name: the parent station id
+    :param hours: the length of the window
+    :param route_types: an iterable of route types to include, or None for every route type
+    :return: a tuple of Schedules (list of models.Schedule without predictions, in chronological order) and Routes
+    (dictionary by ID, models.Route)
+    """
+    day = timezone.localtime(min_time).date() - timedelta(days=1)
+    last_day = timezone.localtime(min_time + timedelta(hours=hours)).date()
+    days = []
+    while day <= last_day:
+        days.append(day)
+        day += timedelta(days=1)
+    active = get_active_services(days)
+
+    starts = {day: service_day_start(day) for day in days}
+    windows = {}  # date -> (first, last) seconds of the window on that service day
+    conditions = Q()
+    for day in days:
+        first = int((min_time - starts[day]).total_seconds())
+        windows[day] = (first, first + hours * 3600)
+        conditions |= Q(trip__service_id__in=active[day], scheduled_seconds__gte=first,
+                        scheduled_seconds__lt=first + hours * 3600)
+    query = GtfsStopTime.objects.select_related('trip__route').filter(conditions, station=station_name)
+    if route_types:
+        query = query.filter(trip__route__route_type__in=list(route_types))
+
+    schedule, routes = [], {}
+    for stop_time in query:
+        trip = stop_time.trip
+        route = routes.get(trip.route_id)
+        if route is None:
+            r = trip.route
+            route = routes[r.id] = Route(r.id, r.color, r.text_color, r.short_name, r.long_name, r.dir_destinations,
+                                         r.dir_names, r.route_type)
+        start = next(starts[day] for day in days if trip.service_id in active[day]
+                     and windows[day][0] <= stop_time.scheduled_seconds < windows[day][1])
+        arrival = departure = None
+        if stop_time.arrival_seconds is not None:
+            arrival = start + timedelta(seconds=stop_time.arrival_seconds)
+        if stop_time.departure_seconds is not None:
+            departure = start + timedelta(seconds=stop_time.departure_seconds)
+        schedule.append(Schedule(f"schedule-{trip.id}-{stop_time.stop_id}-{stop_time.stop_sequence}", arrival,
+                                 departure, trip.direction_id, route, trip.id, stop_time.stop_id, None))
+    schedule.sort(key=Schedule.get_scheduled_time)
+    logger.debug(f"Computed {len(schedule)} schedules for {station_name} from the GTFS feed")
+    return schedule, routes
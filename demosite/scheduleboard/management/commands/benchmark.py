@@ -0,0 +1,241 @@
+from django.core.management.base import BaseCommand, CommandError
+from concurrent.futures import ThreadPoolExecutor
+from django.template import engines
+from django.utils import timezone
+from datetime import datetime, timedelta
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import time
+import timeit
+from scheduleboard import display, mbta, models, replay, services, stubs, timestamps, views
+
+"""
+A management command that times parts of the schedule board's pipeline, e.g. `python manage.py benchmark timestamps`.
+Results can be saved with --save and compared against a previous run with --compare.
+"""
+
+
+def sample_timestamps(rows=600, hours=6):
+    """
+    Creates the timestamps found in a typical six hour response: each row has an arrival and a departure time,
+    and rows are spread over the window so that many of them share the same minute.
+    :param rows: the number of schedule rows
+    :param hours: the length of the window
+    :return: a list of MBTA formatted timestamp strings
+    """
+    start = datetime(2020, 4, 20, 14, 0)
+    rng = random.Random(0)
+    values = []
+    for i in range(rows):
+        time = start + timedelta(minutes=rng.randrange(hours * 60))
+        values.extend([time.strftime("%Y-%m-%dT%H:%M:00-04:00")] * 2)
+    return values
+
+
+def bench_timestamps(number):
+    """
+    Compares strptime (the previous parser) against timestamps.parse_mbta_datetime, both with an empty memo cache
+    (the first response of the day) and a warm one (every later response).
+    :param number: how many times each parser is run over the sample
+    :return: a dictionary of label -> seconds per sample
+    """
+    values = sample_timestamps()
+
+    def strptime_parse():
+        for value in values:
+            datetime.strptime(timestamps.fix_UTC_offset(value), timestamps.mbta_datetime_format)
+
+    def cold_parse():
+        timestamps.parse_mbta_datetime.cache_clear()
+        for value in values:
+            timestamps.parse_mbta_datetime(value)
+
+    def warm_parse():
+        for value in values:
+            timestamps.parse_mbta_datetime(value)
+
+    return {
+        "strptime": timeit.timeit(strptime_parse, number=number) / number,
+        "parse_mbta_datetime (cold)": timeit.timeit(cold_parse, number=number) / number,
+        "parse_mbta_datetime (warm)": timeit.timeit(warm_parse, number=number) / number,
+    }
+
+
+def bench_concurrency(number, calls=100, threads=10, delay=0.2):
+    """
+    Compares how many slow upstream calls the blocking and the asyncio client paths keep in flight. A local stand-in
+    for the MBTA API answers every call after delay seconds. The blocking client runs in a pool of threads, as it
+    would under a threaded WSGI server; the asyncio client runs every call on a single event loop.
+    :param number: ignored, every case is run once since it is dominated by the stand-in's delay
+    :param calls: how many calls are made at once
+    :param threads: the number of threads available to the blocking client
+    :param delay: how long the stand-in takes to answer, in seconds
+    :return: a dictionary of label -> seconds to complete every call
+    """
+    server = stubs.StubUpstream([(200, {}, {"data": [], "included": []}, delay)]).start()
+    try:
+        client = mbta.MBTAClient(base_url=server.url, pool_size=threads)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(lambda i: client.get("schedules", {"call": i}), range(calls)))
+        results = {f"blocking client, {threads} threads": time.perf_counter() - start}
+
+        if mbta.httpx:
+            async_client = mbta.AsyncMBTAClient(base_url=server.url, pool_size=threads)
+
+            async def run():
+                await asyncio.gather(*(async_client.get("schedules", {"call": i}) for i in range(calls)))
+
+            start = time.perf_counter()
+            asyncio.run(run())
+            results["asyncio client, 1 thread"] = time.perf_counter() - start
+    finally:
+        server.stop()
+    results["ideal (every call in flight at once)"] = delay
+    return results
+
+
+# The fixtures bench_pipeline runs over, and the number of rows of the synthetic stand-in used for each when it has
+# not been recorded with `python manage.py recordfixtures`.
+PIPELINE_FIXTURES = (("small", 40), ("typical", 400), ("peak", 1500))
+
+
+def pipeline_fixtures():
+    """
+    :return: a list of (label, fixture) pairs, recorded fixtures where available and synthetic ones otherwise
+    """
+    fixtures = []
+    min_time = timezone.make_aware(datetime(2020, 4, 20, 14, 0))
+    for name, rows in PIPELINE_FIXTURES:
+        file_name = os.path.join(replay.FIXTURE_DIR, f"{name}.json")
+        if os.path.exists(file_name):
+            fixtures.append((name, replay.load_fixture(file_name)))
+        else:
+            document = stubs.schedule_document(min_time, rows)
+            fixtures.append((f"{name} (synthetic)", replay.make_fixture("schedules", {}, document)))
+    return fixtures
+
+
+def bench_pipeline(number):
+    """
+    Times each stage of turning a /schedules response into the board page: decoding the JSON, parse_included,
+    creating the schedule entries, sorting them, and rendering index.html, for small, typical and peak-hour responses.
+    :param number: how many times each stage is run
+    :return: a dictionary of label -> seconds per run
+    """
+    results = {}
+    filters = {'route_types': None, 'page': 1, 'limit': None}
+    for name, fixture in pipeline_fixtures():
+        body = fixture['body'].encode('utf-8')
+        document = mbta.loads(body)
+        routes, predictions = services.parse_included(document['included'])
+        entries = [services.create_schedule_entry(element, routes, predictions) for element in document['data']]
+        schedule = sorted(entries, key=models.Schedule.get_scheduled_time)
+        snapshot = models.StationSnapshot("place-sstat", schedule, routes, predictions, schedule[0].arrival_time)
+        now = timezone.localtime()
+        stages = {
+            "decode": lambda: mbta.loads(body),
+            "parse_included": lambda: services.parse_included(document['included']),
+            "create_schedule entries": lambda: [services.create_schedule_entry(element, routes, predictions)
+                                                for element in document['data']],
+            "sort": lambda: sorted(entries, key=models.Schedule.get_scheduled_time),
+            "render index.html": lambda: views.render_page(snapshot, now, filters, len(schedule)),
+        }
+        for stage, run in stages.items():
+            results[f"{name}, {len(schedule)} rows: {stage}"] = timeit.timeit(run, number=number) / number
+    return results
+
+
+# The rows of index.html as they were rendered before display.py: every value is looked up, and every time
+# formatted, by the template for every row. Kept to measure the display rows against.
+PER_ROW_TEMPLATE = """{% for s in schedule %}
+    <tr class="route_type_{{s.route.route_type}}" data-id="{{s.id}}" data-time="{{ s.get_scheduled_time|date:'U' }}">
+        <td>{{ s.get_scheduled_time|date:'g:i A' }}</td>
+        <td>{% if s.prediction %}{{ s.prediction.get_display_time|date:'g:i A'}}{% endif %}</td>
+        <td style="color:{{s.route.text_color}}" bgcolor="{{s.route.color}}">{{s.route.get_name}}</td>
+        <td style="color:{{s.route.text_color}}" bgcolor="{{s.route.color}}">{{s.get_destination}}</td>
+        <td>{{ s.get_status }}</td>
+    </tr>
+{% endfor %}"""
+
+
+def bench_render(number):
+    """
+    Compares rendering the rows of a peak-hour board with the per-row template (before) and with display rows (after),
+    both with empty caches (the first page load) and warm ones (the next snapshot of the same station, where most rows
+    did not change).
+    :param number: how many times each case is run
+    :return: a dictionary of label -> seconds per run
+    """
+    name, fixture = pipeline_fixtures()[-1]
+    document = mbta.loads(fixture['body'].encode('utf-8'))
+    schedule, routes, predictions = services.parse_schedule_document(document)
+    template = engines['django'].from_string(PER_ROW_TEMPLATE)
+
+    def clear_caches():
+        display._format_time.cache_clear()
+        display.route_cells.cache_clear()
+        display.render_row.cache_clear()
+
+    def display_rows():
+        snapshot = models.StationSnapshot("place-sstat", schedule, routes, predictions, timezone.now())
+        return display.render_rows(snapshot.get_display_rows())
+
+    clear_caches()
+    display_rows()
+    label = f"{name}, {len(schedule)} rows"
+    return {
+        f"{label}: per-row template": timeit.timeit(lambda: template.render({'schedule': schedule}),
+                                                    number=number) / number,
+        f"{label}: display rows (cold)": timeit.timeit(lambda: (clear_caches(), display_rows()),
+                                                       number=number) / number,
+        f"{label}: display rows (warm)": timeit.timeit(display_rows, number=number) / number,
+    }
+
+
+BENCHMARKS = {
+    "concurrency": bench_concurrency,
+    "pipeline": bench_pipeline,
+    "render": bench_render,
+    "timestamps": bench_timestamps,
+}
+
+
+class Command(BaseCommand):
+    help = "Times parts of the schedule board pipeline"
+
+    def add_arguments(self, parser):
+        parser.add_argument("benchmarks", nargs="*", help=f"the benchmarks to run: {', '.join(sorted(BENCHMARKS))} "
+                                                          f"(default: all)")
+        parser.add_argument("--number", type=int, default=50, help="how many times each case is repeated")
+        parser.add_argument("--save", metavar="FILE", help="save the results to FILE as JSON")
+        parser.add_argument("--compare", metavar="FILE", help="compare the results to a run saved with --save")
+
+    def handle(self, *args, **options):
+        unknown = set(options["benchmarks"]) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+        previous = {}
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                previous = json.load(f)["results"]
+        logging.disable(logging.WARNING)  # the demo site logs every call at DEBUG, which would swamp the timings
+        results = {}
+        for name in options["benchmarks"] or sorted(BENCHMARKS):
+            self.stdout.write(f"{name}:")
+            results[name] = BENCHMARKS[name](options["number"])
+            for label, seconds in results[name].items():
+                line = f"  {label:<48} {seconds * 1000:9.3f} ms"
+                before = previous.get(name, {}).get(label)
+                if before:
+                    line += f"  (was {before * 1000:9.3f} ms, {seconds / before:5.2f}x)"
+                self.stdout.write(line)
+        if options["save"]:
+            with open(options["save"], "w") as f:
+                json.dump({"created": timezone.now().isoformat(), "python": platform.python_version(),
+                           "number": options["number"], "results": results}, f, indent=2)
+            self.stdout.write(f"Saved results to {options['save']}")
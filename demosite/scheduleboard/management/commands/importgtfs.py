@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from scheduleboard import gtfs, models
+
+"""
+A management command that imports a GTFS static feed for the stations in models.STATION_CHOICES, e.g.
+`python manage.py importgtfs MBTA_GTFS.zip` with the zip from https://cdn.mbta.com/MBTA_GTFS.zip
+"""
+
+
+class Command(BaseCommand):
+    help = "Imports a GTFS static feed, so that schedules are computed locally (see SCHEDULEBOARD_GTFS_ENABLED)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="the GTFS zip file")
+        parser.add_argument("--station", action="append",
+                            help="a parent station id to import (repeatable), defaults to every station on the board")
+
+    def handle(self, *args, **options):
+        stations = options["station"] or [station[0] for station in models.STATION_CHOICES]
+        try:
+            counts = gtfs.import_feed(options["path"], stations)
+        except (OSError, KeyError, ValueError) as e:
+            raise CommandError(f"Could not import {options['path']}: {e}")
+        self.stdout.write(", ".join(f"{count} {name}" for name, count in counts.items()))
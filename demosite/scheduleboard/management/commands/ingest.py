@@ -0,0 +1,47 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from datetime import timedelta
+import time
+from scheduleboard import models, services, store
+from scheduleboard.models import StationSnapshot
+
+"""
+A management command that fetches every station in models.STATION_CHOICES from the MBTA API and writes the results to
+the database-backed store, e.g. `python manage.py ingest --interval 30` to keep the store up to date.
+"""
+
+
+class Command(BaseCommand):
+    help = "Fetches every station from the MBTA API and stores the schedules in the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=int, default=0,
+                            help="keep ingesting every INTERVAL seconds instead of ingesting once")
+
+    def handle(self, *args, **options):
+        while True:
+            self.ingest()
+            if not options["interval"]:
+                return
+            time.sleep(options["interval"])
+
+    def ingest(self):
+        """
+        Fetches every station with a single call to the MBTA API, stores the results, and removes schedules that are
+        older than SCHEDULEBOARD_STORE_RETENTION seconds. Failed fetches are reported and leave the store unchanged.
+        """
+        now = timezone.localtime()
+        stations = [station[0] for station in models.STATION_CHOICES]
+        try:
+            results = services.get_schedules_for_stations(now, stations)
+        except Exception as e:
+            self.stderr.write(f"Could not fetch stations, the store was not updated: {e}")
+            return
+        for station, (schedule, routes, predictions) in results.items():
+            count = store.save_snapshot(StationSnapshot(station, schedule, routes, predictions, now))
+            self.stdout.write(f"{station}: stored {count} schedules")
+        retention = getattr(settings, 'SCHEDULEBOARD_STORE_RETENTION', 86400)
+        removed = store.delete_before(now - timedelta(seconds=retention))
+        if removed:
+            self.stdout.write(f"Removed {removed} old schedules")
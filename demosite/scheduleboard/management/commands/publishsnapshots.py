@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import time
+from scheduleboard import models, poller, shared
+
+"""
+A management command that keeps the shared snapshot store (see scheduleboard/shared.py) up to date for every worker
+process, e.g. `python manage.py publishsnapshots --interval 10`. Run a single one per machine.
+"""
+
+
+class Command(BaseCommand):
+    help = "Fetches every station from the MBTA API and publishes the snapshots to SCHEDULEBOARD_SHARED_DIR"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=int, default=0,
+                            help="keep publishing every INTERVAL seconds instead of publishing once")
+
+    def handle(self, *args, **options):
+        if shared.snapshots is None:
+            raise CommandError("Set SCHEDULEBOARD_SHARED_DIR in demosite/settings.py to use the shared snapshot store")
+        stations = [station[0] for station in models.STATION_CHOICES]
+        # the poller is not started: it only does the fetching (and predictions-only refreshes) on our schedule
+        refresher = poller.SnapshotPoller(stations, options["interval"],
+                                          schedule_interval=getattr(settings, 'SCHEDULEBOARD_SCHEDULE_INTERVAL', None))
+        while True:
+            self.publish(refresher, stations)
+            if not options["interval"]:
+                return
+            time.sleep(options["interval"])
+
+    def publish(self, refresher, stations):
+        """
+        Refreshes every station with a single fetch and writes the snapshots. Stations whose refresh failed keep their
+        previous snapshots, which are written again only once they are refreshed.
+        """
+        published = {station: refresher.get_snapshot(station) for station in stations}
+        refresher.refresh(stations)
+        for station in stations:
+            snapshot = refresher.get_snapshot(station)
+            if snapshot is None or snapshot is published[station]:
+                self.stderr.write(f"{station}: could not refresh, the shared snapshot was not updated")
+                continue
+            sequence = shared.snapshots.write(snapshot)
+            self.stdout.write(f"{station}: published {len(snapshot.schedule)} schedules as sequence {sequence}")
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+import os
+import requests
+from scheduleboard import mbta, replay, services
+
+"""
+A management command that records real MBTA API responses of various sizes to fixture files, which the tests and
+`python manage.py benchmark pipeline` replay offline. Needs network access, e.g. `python manage.py recordfixtures`.
+"""
+
+
+def fixture_calls(now):
+    """
+    :param now: a timezone aware datetime
+    :return: a dictionary of fixture name -> (path, params) of the call to record
+    """
+    peak = now.replace(hour=17, minute=0, second=0, microsecond=0)
+    return {
+        "small": ("schedules", services.schedule_payload(now, "place-sstat", route_types=(1,))),
+        "typical": ("schedules", services.schedule_payload(now, "place-sstat")),
+        "peak": ("schedules", services.schedule_payload(peak, "place-sstat,place-north")),
+    }
+
+
+class Command(BaseCommand):
+    help = "Records MBTA API responses to fixture files for offline tests and benchmarks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--directory", default=replay.FIXTURE_DIR, help="where to save the fixtures")
+
+    def handle(self, *args, **options):
+        for name, (path, params) in fixture_calls(timezone.localtime()).items():
+            file_name = os.path.join(options["directory"], f"{name}.json")
+            try:
+                fixture = replay.record(mbta.client, path, params, file_name)
+            except requests.RequestException as e:
+                raise CommandError(f"Could not record {name}: {e}")
+            self.stdout.write(f"{name}: {len(fixture['body'])} bytes saved to {file_name}")
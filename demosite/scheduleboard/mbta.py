@@ -0,0 +1,330 @@
+from django.conf import settings
+from collections import OrderedDict
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+import weakref
+import requests
+from requests.adapters import HTTPAdapter
+from . import breaker, metrics, ratelimit
+
+try:
+    import orjson  # optional, decodes large responses several times faster than the json module
+except ImportError:
+    orjson = None
+
+try:
+    import httpx  # optional, only needed for AsyncMBTAClient
+except ImportError:
+    httpx = None
+
+"""
+This file contains the HTTP client used for every call to the MBTA API. A single client keeps a pool of keep-alive
+connections, bounds every call with a timeout, retries failed calls a bounded number of times with jittered backoff,
+and sends conditional GETs so that unchanged responses come back as 304 Not Modified and do not need to be decoded.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def loads(body):
+    """
+    Decodes a JSON body, using orjson when it is installed.
+    :param body: the raw body, as bytes or str
+    :return: the decoded JSON document
+    """
+    if orjson:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+# Status codes worth retrying: rate limiting and transient server errors.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class BaseMBTAClient:
+    """
+    The settings and conditional GET book-keeping shared by the blocking and the asyncio clients.
+    """
+
+    def __init__(self, base_url="https://api-v3.mbta.com", timeout=(3.05, 10), retries=2, backoff=0.5, pool_size=10,
+                 max_validators=64, api_key=None, limiter=None, queue_timeout=5, circuit=None):
+        """
+        Creates a new client
+        :param base_url: the root of the MBTA API
+        :param timeout: the timeout, either a number of seconds or a (connect, read) tuple
+        :param retries: how many times a failed call is retried before giving up
+        :param backoff: the base delay in seconds; retry n waits a random time between 0 and backoff * 2^n
+        :param pool_size: the number of keep-alive connections to keep open
+        :param max_validators: how many responses to remember for conditional GETs
+        :param api_key: the MBTA API key sent with every call, or None
+        :param limiter: the ratelimit.RateLimiter every call takes a token from, or None for no limit
+        :param queue_timeout: the longest time in seconds a call waits for a token before it is shed with
+        ratelimit.RateLimited
+        :param circuit: the breaker.CircuitBreaker that stops calls while the API is failing, or None
+        """
+        self.circuit = circuit
+        self.api_key = api_key
+        self.limiter = limiter
+        self.queue_timeout = queue_timeout
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.max_validators = max_validators
+        self._validators = OrderedDict()  # (path, params) -> (etag, last_modified, document)
+        self._lock = threading.Lock()
+
+    def _conditional_headers(self, path, params):
+        """
+        :return: a tuple of the validator cache key, the remembered validator (or None), and the request headers
+        to send for a conditional GET
+        """
+        key = (path, tuple(sorted(params.items())))
+        headers = {}
+        with self._lock:
+            validator = self._validators.get(key)
+        if validator:
+            etag, last_modified, document = validator
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        return key, validator, headers
+
+    def _remember(self, key, response_headers, document):
+        """
+        Remembers the validators of a response, so the next identical call can be made conditional.
+        """
+        etag = response_headers.get('ETag')
+        last_modified = response_headers.get('Last-Modified')
+        if etag or last_modified:
+            with self._lock:
+                self._validators[key] = (etag, last_modified, document)
+                self._validators.move_to_end(key)
+                while len(self._validators) > self.max_validators:
+                    self._validators.popitem(last=False)
+
+    def _retry_delay(self, attempt):
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    def _request_headers(self, headers):
+        """
+        :return: headers, with the API key added if there is one
+        """
+        return {**headers, 'x-api-key': self.api_key} if self.api_key else headers
+
+    def _shed(self, url):
+        """
+        :return: the ratelimit.RateLimited to raise for a call that got no token in time, after counting it
+        """
+        label = "high" if ratelimit.priority.get() == ratelimit.HIGH else "low"
+        metrics.registry.increment("scheduleboard_upstream_shed_total", (("priority", label),))
+        return ratelimit.RateLimited(f"No rate limit token for {url} within {self.queue_timeout} seconds")
+
+    def _check_circuit(self, path):
+        """
+        Raises breaker.CircuitOpen, after counting it, if the circuit does not let a call to path through now.
+        """
+        if self.circuit and not self.circuit.allow():
+            metrics.registry.increment("scheduleboard_upstream_rejected_total", (("path", path),))
+            raise breaker.CircuitOpen(f"The MBTA API is failing, not calling {path}")
+
+    def _record_outcome(self, status):
+        """
+        Tells the circuit breaker how a call went.
+        :param status: the HTTP status of the final attempt, or None if it failed without a response. A 429 that
+        is still there after every retry is a failure too: the API is refusing calls.
+        """
+        if self.circuit:
+            if status is None or status == 429 or status >= 500:
+                self.circuit.record_failure()
+            else:
+                self.circuit.record_success()
+
+
+class MBTAClient(BaseMBTAClient):
+    """
+    A pooled, retrying HTTP client for the MBTA API.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Creates a new client, see BaseMBTAClient for the parameters.
+        """
+        super().__init__(*args, **kwargs)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, path, params=None):
+        """
+        Calls the MBTA API and returns the decoded JSON document. If the API answers 304 Not Modified to our
+        conditional GET, the document decoded for the previous identical call is returned without decoding anything.
+        :param path: the API path, e.g. "schedules"
+        :param params: a dictionary of query parameters
+        :return: the decoded JSON document
+        """
+        params = params or {}
+        key, validator, headers = self._conditional_headers(path, params)
+        self._check_circuit(path)
+        try:
+            response = self.request(f"{self.base_url}/{path}", params, headers)
+        except ratelimit.RateLimited:
+            metrics.count_upstream(path, None)
+            raise
+        except Exception:
+            metrics.count_upstream(path, None)
+            self._record_outcome(None)
+            raise
+        metrics.count_upstream(path, response.status_code)
+        self._record_outcome(response.status_code)
+        if response.status_code == 304 and validator:
+            logger.debug(f"{path} was not modified")
+            return validator[2]
+        response.raise_for_status()
+        with metrics.stage("decode"):
+            document = loads(response.content)
+        self._remember(key, response.headers, document)
+        return document
+
+    def request(self, url, params, headers):
+        """
+        Performs a GET, retrying connection errors, timeouts and RETRY_STATUSES responses.
+        :param url: the full URL
+        :param params: a dictionary of query parameters
+        :param headers: a dictionary of extra request headers
+        :return: the requests.Response of the last attempt
+        """
+        headers = self._request_headers(headers)
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            if self.limiter and not self.limiter.acquire(ratelimit.priority.get(), self.queue_timeout):
+                raise self._shed(url)
+            try:
+                with metrics.stage("upstream"):  # only the call itself, not the wait for a rate limit token
+                    response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if last_attempt:
+                    raise
+                logger.warning(f"Call to {url} failed ({e}), retrying")
+            else:
+                if self.limiter:
+                    self.limiter.observe(response.status_code, response.headers)
+                if response.status_code not in RETRY_STATUSES or last_attempt:
+                    return response
+                logger.warning(f"Call to {url} returned {response.status_code}, retrying")
+                response.close()
+            time.sleep(self._retry_delay(attempt))
+
+
+class AsyncMBTAClient(BaseMBTAClient):
+    """
+    The asyncio counterpart of MBTAClient, built on httpx, for use from async views. Waiting on the MBTA API does not
+    tie up a thread, so a single process can keep hundreds of calls in flight.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Creates a new client, see BaseMBTAClient for the parameters.
+        """
+        super().__init__(*args, **kwargs)
+        if httpx is None:
+            raise ImportError("AsyncMBTAClient requires httpx, install it with `pip install httpx`")
+        self._clients = weakref.WeakKeyDictionary()  # event loop -> httpx.AsyncClient
+
+    def _client(self):
+        """
+        :return: the httpx.AsyncClient for the running event loop. Pooled connections belong to the loop that opened
+        them, so each loop gets its own client.
+        """
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            if isinstance(self.timeout, tuple):
+                timeout = httpx.Timeout(self.timeout[1], connect=self.timeout[0])
+            else:
+                timeout = httpx.Timeout(self.timeout)
+            limits = httpx.Limits(max_connections=None, max_keepalive_connections=self.pool_size)
+            client = httpx.AsyncClient(timeout=timeout, limits=limits)
+            self._clients[loop] = client
+        return client
+
+    async def get(self, path, params=None):
+        """
+        Calls the MBTA API and returns the decoded JSON document, see MBTAClient.get.
+        :param path: the API path, e.g. "schedules"
+        :param params: a dictionary of query parameters
+        :return: the decoded JSON document
+        """
+        params = params or {}
+        key, validator, headers = self._conditional_headers(path, params)
+        self._check_circuit(path)
+        try:
+            response = await self.request(f"{self.base_url}/{path}", params, headers)
+        except ratelimit.RateLimited:
+            metrics.count_upstream(path, None)
+            raise
+        except Exception:
+            metrics.count_upstream(path, None)
+            self._record_outcome(None)
+            raise
+        metrics.count_upstream(path, response.status_code)
+        self._record_outcome(response.status_code)
+        if response.status_code == 304 and validator:
+            logger.debug(f"{path} was not modified")
+            return validator[2]
+        response.raise_for_status()
+        with metrics.stage("decode"):
+            document = loads(response.content)
+        self._remember(key, response.headers, document)
+        return document
+
+    async def request(self, url, params, headers):
+        """
+        Performs a GET, retrying connection errors, timeouts and RETRY_STATUSES responses.
+        :param url: the full URL
+        :param params: a dictionary of query parameters
+        :param headers: a dictionary of extra request headers
+        :return: the httpx.Response of the last attempt
+        """
+        headers = self._request_headers(headers)
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            if self.limiter and not await self.limiter.acquire_async(ratelimit.priority.get(), self.queue_timeout):
+                raise self._shed(url)
+            try:
+                with metrics.stage("upstream"):
+                    response = await self._client().get(url, params=params, headers=headers)
+            except httpx.TransportError as e:
+                if last_attempt:
+                    raise
+                logger.warning(f"Call to {url} failed ({e}), retrying")
+            else:
+                if self.limiter:
+                    self.limiter.observe(response.status_code, response.headers)
+                if response.status_code not in RETRY_STATUSES or last_attempt:
+                    return response
+                logger.warning(f"Call to {url} returned {response.status_code}, retrying")
+            await asyncio.sleep(self._retry_delay(attempt))
+
+
+# The rate limit shared by every call: the MBTA API allows 20 calls per minute without a key, and 1000 with one.
+api_key = getattr(settings, 'MBTA_API_KEY', None)
+limiter = ratelimit.RateLimiter.per_minute(getattr(settings, 'MBTA_API_RATE_LIMIT', None) or (1000 if api_key else 20))
+
+# The circuit breaker shared by every call, so a failing API is called only once in a while by the whole process.
+circuit = breaker.CircuitBreaker(failure_threshold=getattr(settings, 'MBTA_API_FAILURE_THRESHOLD', 5),
+                                 reset_timeout=getattr(settings, 'MBTA_API_PROBE_INTERVAL', 30))
+
+# The clients shared by everything in services.py, so all calls share one connection pool, rate limit and circuit.
+client = MBTAClient(timeout=getattr(settings, 'MBTA_API_TIMEOUT', (3.05, 10)),
+                    retries=getattr(settings, 'MBTA_API_RETRIES', 2), api_key=api_key, limiter=limiter,
+                    queue_timeout=getattr(settings, 'MBTA_API_QUEUE_TIMEOUT', 5), circuit=circuit)
+async_client = AsyncMBTAClient(timeout=client.timeout, retries=client.retries, api_key=api_key, limiter=limiter,
+                               queue_timeout=client.queue_timeout, circuit=circuit) if httpx else None
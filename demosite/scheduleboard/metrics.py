@@ -0,0 +1,257 @@
+from contextlib import contextmanager
+import asyncio
+import contextvars
+import threading
+import time
+
+"""
+This file contains the schedule board's instrumentation: the time spent in each stage of a request (the upstream call,
+decoding, parsing, sorting, rendering, ...) is reported to the browser in a Server-Timing header and added to latency
+histograms, which are served together with upstream error and cache counters in the Prometheus text format at
+/schedule/metrics.
+"""
+
+# The stage timings of the request being handled, as a list of (stage, seconds); None outside of a request.
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+# The upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """
+    The distribution of a latency, in cumulative buckets as Prometheus expects them.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        :param value: a latency in seconds
+        """
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Registry:
+    """
+    A thread-safe collection of counters and histograms, each identified by a metric name and a tuple of labels.
+    """
+
+    def __init__(self):
+        self._counters = {}  # name -> {labels: value}
+        self._histograms = {}  # name -> {labels: Histogram}
+        self._help = {}  # name -> (type, help text)
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        """
+        Sets the type ("counter" or "histogram") and help text reported for a metric.
+        """
+        self._help[name] = (kind, text)
+
+    def increment(self, name, labels=(), amount=1):
+        """
+        Adds amount to a counter.
+        :param name: the metric name
+        :param labels: a tuple of (label, value) pairs
+        :param amount: how much to add
+        """
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + amount
+
+    def observe(self, name, labels, value):
+        """
+        Adds a latency to a histogram.
+        :param name: the metric name
+        :param labels: a tuple of (label, value) pairs
+        :param value: the latency in seconds
+        """
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = series[labels] = Histogram()
+            histogram.observe(value)
+
+    def get_counter(self, name, labels=()):
+        """
+        :return: the current value of a counter, 0 if it was never incremented
+        """
+        with self._lock:
+            return self._counters.get(name, {}).get(labels, 0)
+
+    def get_histogram(self, name, labels=()):
+        """
+        :return: the Histogram for name and labels, or None if nothing was observed yet
+        """
+        with self._lock:
+            return self._histograms.get(name, {}).get(labels)
+
+    def clear(self):
+        """
+        Resets every metric, mostly useful for tests.
+        """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """
+        :return: every metric in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.extend(self._header(name, "counter"))
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                lines.extend(self._header(name, "histogram"))
+                for labels, histogram in sorted(series.items()):
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, name, kind):
+        kind, text = self._help.get(name, (kind, ""))
+        return [f"# HELP {name} {text}", f"# TYPE {name} {kind}"] if text else [f"# TYPE {name} {kind}"]
+
+
+def format_labels(labels):
+    """
+    :param labels: a tuple of (label, value) pairs
+    :return: the labels in the Prometheus format, e.g. {stage="render"}, or an empty string
+    """
+    if not labels:
+        return ""
+    escaped = (f'{label}="{escape_label(value)}"' for label, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def escape_label(value):
+    """
+    :return: value as a string, with backslashes, double quotes and newlines escaped for a Prometheus label
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# The process-wide registry served at /schedule/metrics
+registry = Registry()
+registry.describe("scheduleboard_stage_seconds", "histogram", "Time spent in each stage of building the board")
+registry.describe("scheduleboard_request_seconds", "histogram", "Time spent handling each request, by view")
+registry.describe("scheduleboard_upstream_requests_total", "counter", "Calls to the MBTA API, by path and status")
+registry.describe("scheduleboard_upstream_errors_total", "counter", "Failed calls to the MBTA API, by path")
+registry.describe("scheduleboard_upstream_shed_total", "counter", "Calls to the MBTA API shed by the rate limiter")
+registry.describe("scheduleboard_upstream_rejected_total", "counter",
+                  "Calls to the MBTA API not made because the circuit breaker was open")
+registry.describe("scheduleboard_stale_served_total", "counter",
+                  "Last good snapshots served while revalidating them or while the MBTA API is failing")
+registry.describe("scheduleboard_push_connections_total", "counter", "Displays that subscribed to pushed updates")
+registry.describe("scheduleboard_push_events_total", "counter", "Board updates queued for subscribed displays")
+registry.describe("scheduleboard_push_resyncs_total", "counter",
+                  "Displays too slow to keep up, whose pending updates were replaced by a full board")
+registry.describe("scheduleboard_cache_requests_total", "counter", "Cache lookups, by cache and hit or miss")
+
+
+@contextmanager
+def stage(name):
+    """
+    Times the enclosed block as a stage of the current request: it is added to the Server-Timing header (if a request
+    is being handled) and to the scheduleboard_stage_seconds histogram.
+    :param name: the stage name, e.g. "upstream" or "render"
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        timings = request_timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+        registry.observe("scheduleboard_stage_seconds", (("stage", name),), elapsed)
+
+
+def count_cache(cache_name, hit):
+    """
+    Counts a cache lookup.
+    :param cache_name: the cache, e.g. "schedule"
+    :param hit: True if the lookup was answered from the cache
+    """
+    registry.increment("scheduleboard_cache_requests_total",
+                       (("cache", cache_name), ("result", "hit" if hit else "miss")))
+
+
+def count_upstream(path, status):
+    """
+    Counts a call to the MBTA API.
+    :param path: the API path, e.g. "schedules"
+    :param status: the HTTP status, or None if the call failed without a response
+    """
+    registry.increment("scheduleboard_upstream_requests_total", (("path", path), ("status", str(status or "error"))))
+    if status is None or status >= 400:
+        registry.increment("scheduleboard_upstream_errors_total", (("path", path),))
+
+
+def server_timing(timings, total):
+    """
+    :param timings: a list of (stage, seconds); repeated stages are added up
+    :param total: the time spent on the whole request, in seconds
+    :return: the value of the Server-Timing header, e.g. "upstream;dur=120.5, render;dur=8.1, total;dur=131.0"
+    """
+    durations = {}
+    for name, seconds in timings:
+        durations[name] = durations.get(name, 0) + seconds
+    durations["total"] = total
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in durations.items())
+
+
+class ServerTimingMiddleware:
+    """
+    Collects the stage timings of every request, adds them to the response as a Server-Timing header, and adds the
+    request's latency to the scheduleboard_request_seconds histogram. Works for both sync and async views.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine  # lets Django call this middleware asynchronously
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self._call_async(request)
+        token, start = request_timings.set([]), time.perf_counter()
+        try:
+            response = self.get_response(request)
+            return self._finish(request, response, start)
+        finally:
+            request_timings.reset(token)
+
+    async def _call_async(self, request):
+        token, start = request_timings.set([]), time.perf_counter()
+        try:
+            response = await self.get_response(request)
+            return self._finish(request, response, start)
+        finally:
+            request_timings.reset(token)
+
+    def _finish(self, request, response, start):
+        total = time.perf_counter() - start
+        match = getattr(request, "resolver_match", None)
+        view = match.url_name if match and match.url_name else "other"
+        registry.observe("scheduleboard_request_seconds", (("view", view),), total)
+        response["Server-Timing"] = server_timing(request_timings.get(), total)
+        return response
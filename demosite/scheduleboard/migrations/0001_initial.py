@@ -0,0 +1,65 @@
+# Generated by Django 3.1.14 on 2026-10-18 03:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PredictionRecord',
+            fields=[
+                ('id', models.CharField(max_length=128, primary_key=True, serialize=False)),
+                ('arrival_time', models.DateTimeField(null=True)),
+                ('departure_time', models.DateTimeField(null=True)),
+                ('direction_id', models.SmallIntegerField()),
+                ('status', models.CharField(max_length=64, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RouteRecord',
+            fields=[
+                ('id', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('color', models.CharField(blank=True, max_length=6)),
+                ('text_color', models.CharField(blank=True, max_length=6)),
+                ('short_name', models.CharField(blank=True, max_length=64)),
+                ('long_name', models.CharField(blank=True, max_length=128)),
+                ('dir_destinations', models.JSONField(default=list)),
+                ('dir_names', models.JSONField(default=list)),
+                ('route_type', models.SmallIntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ScheduleRecord',
+            fields=[
+                ('id', models.CharField(max_length=128, primary_key=True, serialize=False)),
+                ('station', models.CharField(max_length=64)),
+                ('stop_id', models.CharField(max_length=64)),
+                ('trip_id', models.CharField(max_length=128)),
+                ('direction_id', models.SmallIntegerField()),
+                ('arrival_time', models.DateTimeField(null=True)),
+                ('departure_time', models.DateTimeField(null=True)),
+                ('scheduled_time', models.DateTimeField()),
+                ('prediction', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='scheduleboard.predictionrecord')),
+                ('route', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='scheduleboard.routerecord')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='schedulerecord',
+            index=models.Index(fields=['station', 'scheduled_time'], name='scheduleboa_station_7b6334_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='schedulerecord',
+            index=models.Index(fields=['stop_id', 'scheduled_time'], name='scheduleboa_stop_id_3bef89_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='schedulerecord',
+            index=models.Index(fields=['trip_id'], name='scheduleboa_trip_id_94eaf8_idx'),
+        ),
+    ]
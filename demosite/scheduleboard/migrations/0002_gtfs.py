@@ -0,0 +1,71 @@
+# Generated by Django 3.1.14 on 2026-10-18 03:39
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduleboard', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GtfsRoute',
+            fields=[
+                ('id', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('color', models.CharField(blank=True, max_length=6)),
+                ('text_color', models.CharField(blank=True, max_length=6)),
+                ('short_name', models.CharField(blank=True, max_length=64)),
+                ('long_name', models.CharField(blank=True, max_length=128)),
+                ('dir_destinations', models.JSONField(default=list)),
+                ('dir_names', models.JSONField(default=list)),
+                ('route_type', models.SmallIntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GtfsService',
+            fields=[
+                ('id', models.CharField(max_length=128, primary_key=True, serialize=False)),
+                ('days', models.CharField(max_length=7)),
+                ('start_date', models.DateField()),
+                ('end_date', models.DateField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GtfsServiceException',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('service_id', models.CharField(max_length=128)),
+                ('date', models.DateField(db_index=True)),
+                ('exception_type', models.SmallIntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GtfsTrip',
+            fields=[
+                ('id', models.CharField(max_length=128, primary_key=True, serialize=False)),
+                ('service_id', models.CharField(max_length=128)),
+                ('direction_id', models.SmallIntegerField()),
+                ('route', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='scheduleboard.gtfsroute')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GtfsStopTime',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('station', models.CharField(max_length=64)),
+                ('stop_id', models.CharField(max_length=64)),
+                ('stop_sequence', models.IntegerField()),
+                ('arrival_seconds', models.IntegerField(null=True)),
+                ('departure_seconds', models.IntegerField(null=True)),
+                ('scheduled_seconds', models.IntegerField()),
+                ('trip', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='scheduleboard.gtfstrip')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='gtfsstoptime',
+            index=models.Index(fields=['station', 'scheduled_seconds'], name='scheduleboa_station_3db354_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-18 04:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduleboard', '0002_gtfs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedulerecord',
+            name='ingested_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -1,11 +1,16 @@
 from django.db import models
+from . import columnar, display
+import hashlib
+import threading
+import time
 
 
 # Create your models here.
 """
-The models included in this file are not managed by Django; for a simple demo app we don't need to cache anything in
-our own database. For a larger site with many users, we would want to cache our Schedule, Route, and Prediction objects
-to keep from hitting the MBTA API too frequently. 
+The Schedule, Route, and Prediction models included in this file are not managed by Django; they are the in-memory
+objects the schedule board is built from. For a larger site with many users, the RouteRecord, PredictionRecord and
+ScheduleRecord models at the end of this file store the same data in our own database (see store.py), so that the
+board keeps working across restarts and MBTA API outages, and many workers can share one ingested copy.
 """
 
 #A simple enumeration of stations that the user can switch between. This can easily be extended if you know the station IDs you want to add, just add more (station_id, station_name) pairs.
@@ -16,6 +21,14 @@ STATION_CHOICES = (
 )
 
 
+def is_known_station(station_key):
+    """
+    :param station_key: a station key, e.g. from a query string
+    :return: True if station_key is one of STATION_CHOICES
+    """
+    return any(station[0] == station_key for station in STATION_CHOICES)
+
+
 def get_station_display_name(station_key):
     """
     Given a station_key, find the corresponding station_name from STATION_CHOICES
@@ -34,16 +47,10 @@ class Schedule:
     A class that wraps the MBTA Schedule returned from https://api-v3.mbta.com/schedules.
     Only fields relevant to the schedule board are stored in this class.
     See https://api-v3.mbta.com/docs/swagger/index.html#/Schedule for more information.
+    We hold many of these at once, so instances use __slots__ rather than a per-instance __dict__.
     """
     managed = False #technically not needed as this class does not extend models.Model, included for clarity
-    id = 0
-    arrival_time = None
-    departure_time = None
-    direction_id = None
-    route = None
-    trip_id = None
-    stop_id = None
-    prediction = None
+    __slots__ = ('id', 'arrival_time', 'departure_time', 'direction_id', 'route', 'trip_id', 'stop_id', 'prediction')
 
     def __init__(self, sid, at, dt, dir, rt, tp, sp, pr):
         """
@@ -58,15 +65,13 @@ class Schedule:
         :param pr: prediction id
         """
         self.id = sid
-        if at:
-            self.arrival_time = at
-        if dt:
-            self.departure_time = dt
+        self.arrival_time = at or None
+        self.departure_time = dt or None
         self.direction_id = dir
         self.route = rt
+        self.trip_id = tp
         self.stop_id = sp
-        if pr:
-            self.prediction = pr
+        self.prediction = pr or None
 
     def __str__(self):
         return f"Schedule({self.id}|{self.arrival_time}|{self.departure_time})"
@@ -103,16 +108,10 @@ class Route:
     """
     A class that wraps the MBTA route, see https://api-v3.mbta.com/docs/swagger/index.html#/Route for more information.
     Only fields relevant to the schedule board are stored within this class.
+    Routes are shared between schedules and snapshots; see RouteRegistry.
     """
     managed = False
-    id = None
-    color = None
-    text_color = None
-    short_name = None
-    long_name = None
-    dir_destinations = None
-    dir_names = None
-    route_type = None
+    __slots__ = ('id', 'color', 'text_color', 'short_name', 'long_name', 'dir_destinations', 'dir_names', 'route_type')
 
     def __init__(self, rid, c, tc, sn, ln, dd, dn, rt):
         """
@@ -154,27 +153,71 @@ class Route:
             return self.long_name
 
 
+class RouteRegistry:
+    """
+    A process-wide registry that interns Route objects by id. Routes almost never change, so instead of creating new
+    Route objects for every response, each route is built once and then shared by every schedule that refers to it.
+    A route is only rebuilt once it is older than refresh_interval seconds, and even then the existing object is
+    updated in place, so schedules that already refer to it see the new values.
+    """
+
+    def __init__(self, refresh_interval=3600, clock=time.monotonic):
+        """
+        Creates a new registry
+        :param refresh_interval: how many seconds a route is used before it is rebuilt from fresh data
+        :param clock: a function returning the current time in seconds, mostly useful for tests
+        """
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self._routes = {}  # route_id -> (refreshed_at, Route)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._routes)
+
+    def intern(self, rid, build):
+        """
+        Returns the shared Route for rid, calling build() only if the route is unknown or due for a refresh.
+        :param rid: the route id
+        :param build: a function taking no arguments that returns a new Route for rid
+        :return: the shared Route object
+        """
+        with self._lock:
+            entry = self._routes.get(rid)
+            now = self.clock()
+            if entry and now - entry[0] < self.refresh_interval:
+                return entry[1]
+            route = build()
+            if entry:
+                for name in Route.__slots__:
+                    setattr(entry[1], name, getattr(route, name))
+                route = entry[1]
+            self._routes[rid] = (now, route)
+            return route
+
+    def get(self, rid):
+        """
+        :param rid: the route id
+        :return: the shared Route for rid, or None if it has not been seen yet
+        """
+        entry = self._routes.get(rid)
+        return entry[1] if entry else None
+
+
 class Prediction:
     """
     A class that wraps a prediction from the MBTA APi.
     See https://api-v3.mbta.com/docs/swagger/index.html#/Prediction for more information.
     """
     managed = False
-    id = None
-    arrival_time = None
-    departure_time = None
-    direction_id = None
-    status = None
+    __slots__ = ('id', 'arrival_time', 'departure_time', 'direction_id', 'status')
 
     def __init__(self, pid, at, dt, di, s):
         self.id = pid
-        if at:
-            self.arrival_time = at
-        if dt:
-            self.departure_time = dt
+        self.arrival_time = at or None
+        self.departure_time = dt or None
         self.direction_id = di
-        if s:
-            self.status = s
+        self.status = s or None
 
     def get_display_time(self):
         """
@@ -191,3 +234,191 @@ class Prediction:
             return self.status
         else:
             return ""
+
+
+class StationSnapshot:
+    """
+    The schedules, routes and predictions fetched for a single station at a single point in time.
+    """
+    managed = False
+    __slots__ = ('station', 'schedule', 'routes', 'predictions', 'fetched_at', '_version', '_rows', '_table')
+
+    def __init__(self, station, schedule, routes, predictions, fetched_at):
+        """
+        Creates a new snapshot
+        :param station: the station key, taken from STATION_CHOICES
+        :param schedule: a list of Schedule objects, in chronological order
+        :param routes: a dictionary of route_id -> Route
+        :param predictions: a dictionary of prediction_id -> Prediction
+        :param fetched_at: the (timezone aware) datetime the data was fetched
+        """
+        self.station = station
+        self.schedule = schedule
+        self.routes = routes
+        self.predictions = predictions
+        self.fetched_at = fetched_at
+        self._version = None
+        self._rows = None
+        self._table = None
+
+    def __str__(self):
+        return f"StationSnapshot({self.station}|{self.fetched_at}|{len(self.schedule)})"
+
+    def get_version(self):
+        """
+        Gets a version string for the content of this snapshot: two snapshots with the same schedules, times, routes
+        and statuses have the same version, however far apart they were fetched.
+        :return: a short hexadecimal string
+        """
+        if self._version is None:
+            digest = hashlib.blake2b(self.station.encode(), digest_size=8)
+            for s in self.schedule:
+                # times are hashed as instants, so the same time read back from the database in UTC hashes the same
+                predicted = s.prediction.get_display_time() if s.prediction else None
+                predicted = predicted.timestamp() if predicted else None
+                scheduled = s.get_scheduled_time().timestamp()
+                digest.update(f"{s.id}|{scheduled}|{predicted}|{s.get_status()}|{s.route.id}\n".encode())
+            self._version = digest.hexdigest()
+        return self._version
+
+    def get_display_rows(self):
+        """
+        Gets the rows of the board for this snapshot, formatted once and shared by every page rendered from it.
+        :return: a tuple of display.DisplayRow, in the order of the schedule
+        """
+        if self._rows is None:
+            self._rows = display.build_rows(self.schedule)
+        return self._rows
+
+    def get_table(self):
+        """
+        Gets the schedule as columns, built once and shared by every page selected from this snapshot.
+        :return: a columnar.ScheduleTable in the order of the schedule, or None if NumPy is not installed
+        """
+        if self._table is None and columnar.numpy is not None:
+            self._table = columnar.ScheduleTable.from_schedule(self.schedule, presorted=True)
+        return self._table
+
+
+class RouteRecord(models.Model):
+    """
+    A route stored in our own database, see Route.
+    """
+    id = models.CharField(max_length=64, primary_key=True)
+    color = models.CharField(max_length=6, blank=True)
+    text_color = models.CharField(max_length=6, blank=True)
+    short_name = models.CharField(max_length=64, blank=True)
+    long_name = models.CharField(max_length=128, blank=True)
+    dir_destinations = models.JSONField(default=list)
+    dir_names = models.JSONField(default=list)
+    route_type = models.SmallIntegerField()
+
+    def __str__(self):
+        return f"RouteRecord({self.id})"
+
+
+class PredictionRecord(models.Model):
+    """
+    A prediction stored in our own database, see Prediction.
+    """
+    id = models.CharField(max_length=128, primary_key=True)
+    arrival_time = models.DateTimeField(null=True)
+    departure_time = models.DateTimeField(null=True)
+    direction_id = models.SmallIntegerField()
+    status = models.CharField(max_length=64, null=True)
+
+    def __str__(self):
+        return f"PredictionRecord({self.id})"
+
+
+class ScheduleRecord(models.Model):
+    """
+    A schedule stored in our own database, see Schedule. scheduled_time is Schedule.get_scheduled_time(), stored so
+    that a station's time window can be read with a single indexed range query. ingested_at is when the row was last
+    fetched from the MBTA API, so boards read from the store show how old they are.
+    """
+    id = models.CharField(max_length=128, primary_key=True)
+    station = models.CharField(max_length=64)
+    stop_id = models.CharField(max_length=64)
+    trip_id = models.CharField(max_length=128)
+    route = models.ForeignKey(RouteRecord, on_delete=models.CASCADE)
+    prediction = models.ForeignKey(PredictionRecord, null=True, on_delete=models.SET_NULL)
+    direction_id = models.SmallIntegerField()
+    arrival_time = models.DateTimeField(null=True)
+    departure_time = models.DateTimeField(null=True)
+    scheduled_time = models.DateTimeField()
+    ingested_at = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['station', 'scheduled_time']),
+            models.Index(fields=['stop_id', 'scheduled_time']),
+            models.Index(fields=['trip_id']),
+        ]
+
+    def __str__(self):
+        return f"ScheduleRecord({self.id}|{self.station}|{self.scheduled_time})"
+
+
+class GtfsRoute(models.Model):
+    """
+    A route imported from a GTFS static feed (routes.txt, with destinations from directions.txt), see gtfs.py.
+    """
+    id = models.CharField(max_length=64, primary_key=True)
+    color = models.CharField(max_length=6, blank=True)
+    text_color = models.CharField(max_length=6, blank=True)
+    short_name = models.CharField(max_length=64, blank=True)
+    long_name = models.CharField(max_length=128, blank=True)
+    dir_destinations = models.JSONField(default=list)
+    dir_names = models.JSONField(default=list)
+    route_type = models.SmallIntegerField()
+
+
+class GtfsService(models.Model):
+    """
+    A service calendar imported from a GTFS static feed (calendar.txt). days holds one character per weekday,
+    Monday first, e.g. "1111100" for weekdays only.
+    """
+    id = models.CharField(max_length=128, primary_key=True)
+    days = models.CharField(max_length=7)
+    start_date = models.DateField()
+    end_date = models.DateField()
+
+
+class GtfsServiceException(models.Model):
+    """
+    A service added (exception_type=1) or removed (exception_type=2) on a single date, from calendar_dates.txt.
+    """
+    service_id = models.CharField(max_length=128)
+    date = models.DateField(db_index=True)
+    exception_type = models.SmallIntegerField()
+
+
+class GtfsTrip(models.Model):
+    """
+    A trip imported from a GTFS static feed (trips.txt).
+    """
+    id = models.CharField(max_length=128, primary_key=True)
+    route = models.ForeignKey(GtfsRoute, on_delete=models.CASCADE)
+    service_id = models.CharField(max_length=128)
+    direction_id = models.SmallIntegerField()
+
+
+class GtfsStopTime(models.Model):
+    """
+    A trip's stop at one of our stations, from stop_times.txt. Times are seconds after noon minus 12 hours on the
+    service day, as in GTFS, so they may exceed 24 hours for trips running past midnight. scheduled_seconds is the
+    departure time, or the arrival time at the last stop, and is what the board is sorted and windowed by.
+    """
+    trip = models.ForeignKey(GtfsTrip, on_delete=models.CASCADE)
+    station = models.CharField(max_length=64)
+    stop_id = models.CharField(max_length=64)
+    stop_sequence = models.IntegerField()
+    arrival_seconds = models.IntegerField(null=True)
+    departure_seconds = models.IntegerField(null=True)
+    scheduled_seconds = models.IntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['station', 'scheduled_seconds']),
+        ]
@@ -0,0 +1,151 @@
+from django.conf import settings
+from django.utils import timezone
+import functools
+import logging
+import threading
+from . import models, ratelimit, services, window
+
+"""
+This file contains a background poller that keeps a recent snapshot of every station in models.STATION_CHOICES, so
+that the schedule board view can read the latest snapshot instead of waiting on the MBTA API.
+"""
+
+logger = logging.getLogger(__name__)
+
+# The poller started by start_poller(), if any.
+poller = None
+
+# The stations somebody looked at recently; the views record every page load here.
+viewers = ratelimit.ViewerTracker(ttl=getattr(settings, 'SCHEDULEBOARD_VIEWER_TTL', 120))
+
+
+class SnapshotPoller(threading.Thread):
+    """
+    A daemon thread that refreshes the snapshot for each station every interval seconds. With a schedule_interval,
+    the schedules are kept in a sliding window whose end is only fetched every schedule_interval seconds, and every
+    refresh fetches the predictions and merges them onto the schedules already held.
+    """
+
+    def __init__(self, stations, interval, fetch=None, schedule_interval=None, fetch_predictions=None):
+        """
+        Creates a new poller. The poller does nothing until start() is called.
+        :param stations: a list of station keys, e.g. taken from models.STATION_CHOICES
+        :param interval: the number of seconds to wait between refreshes
+        :param fetch: a function taking (min_time, stations) and returning a dictionary of station -> tuple of
+        schedules, routes and predictions; defaults to services.get_schedules_for_stations, which fetches every
+        station with a single call to the MBTA API. If schedule_interval is set, it must also take max_time=, and
+        it defaults to fetching without predictions.
+        :param schedule_interval: how many seconds may go by before the end of the window of schedules is fetched
+        (see window.ScheduleWindow), or None to fetch schedules and predictions together on every refresh
+        :param fetch_predictions: a function taking a list of stations and returning a dictionary of
+        (trip_id, stop_id) -> models.Prediction; defaults to services.get_predictions_for_stations
+        """
+        super().__init__(name="scheduleboard-poller", daemon=True)
+        self.stations = list(stations)
+        self.interval = interval
+        self.schedule_interval = schedule_interval
+        if fetch is None and schedule_interval:
+            fetch = functools.partial(services.get_schedules_for_stations, predictions=False)
+        self.fetch = fetch or services.get_schedules_for_stations
+        self.fetch_predictions = fetch_predictions or services.get_predictions_for_stations
+        self.snapshots = {}  # station -> models.StationSnapshot
+        self.window = window.ScheduleWindow(self.stations, self.fetch, step=schedule_interval,
+                                            reset=getattr(settings, 'SCHEDULEBOARD_WINDOW_RESET', 3600)) \
+            if schedule_interval else None
+        self._stopped = threading.Event()
+
+    def run(self):
+        logger.info(f"Polling {len(self.stations)} stations every {self.interval} seconds")
+        while not self._stopped.is_set():
+            self.refresh_all()
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        """
+        Asks the poller to stop after the current refresh.
+        """
+        self._stopped.set()
+
+    def refresh_all(self):
+        """
+        Refreshes every station. Stations somebody is looking at (see viewers) are fetched at once with HIGH priority;
+        the idle ones are fetched together with LOW priority, so under a tight rate limit their refresh is delayed or
+        skipped rather than the busy stations'. If a refresh fails, its stations keep their previous snapshots.
+        """
+        active = [station for station in self.stations if viewers.is_active(station)]
+        idle = [station for station in self.stations if station not in active]
+        for stations, level in ((active, ratelimit.HIGH), (idle, ratelimit.LOW)):
+            if stations:
+                with ratelimit.with_priority(level):
+                    self.refresh(stations)
+
+    def refresh(self, stations):
+        """
+        Refreshes the given stations with a single fetch, or, between schedule refreshes, a single fetch of their
+        predictions.
+        :param stations: a list of station keys
+        """
+        fetched_at = timezone.localtime()
+        try:
+            if not self.schedule_interval:
+                results = self.fetch(fetched_at, stations)
+            else:
+                self.refresh_predictions(stations, fetched_at)
+                return
+        except ratelimit.RateLimited:
+            logger.info(f"Rate limited, skipped refreshing {len(stations)} stations")
+            return
+        except Exception:
+            logger.exception("Could not refresh stations, keeping the previous snapshots")
+            return
+        for station, (schedule, routes, predictions) in results.items():
+            # a single assignment, so readers never see a half-built snapshot
+            self.snapshots[station] = models.StationSnapshot(station, schedule, routes, predictions, fetched_at)
+        logger.debug(f"Refreshed {len(results)} stations")
+
+    def refresh_predictions(self, stations, fetched_at):
+        """
+        Moves the window of schedules forward (fetching only what it is missing), then fetches the predictions of
+        every station, and merges them into new snapshots (see services.merge_predictions).
+        :param stations: a list of station keys
+        :param fetched_at: the time of the refresh
+        """
+        skeletons = self.window.advance(fetched_at, stations)
+        predictions = self.fetch_predictions(stations)
+        for station, skeleton in skeletons.items():
+            self.snapshots[station] = services.merge_predictions(skeleton, predictions, fetched_at)
+        logger.debug(f"Merged {len(predictions)} predictions into {len(stations)} stations")
+
+    def get_snapshot(self, station):
+        """
+        :param station: the station key
+        :return: the latest models.StationSnapshot for the station, or None if it has not been fetched yet
+        """
+        return self.snapshots.get(station)
+
+
+def start_poller():
+    """
+    Starts the process-wide poller for every station in models.STATION_CHOICES, if it is not already running.
+    The cadence is taken from SCHEDULEBOARD_POLL_INTERVAL, and that of the schedules from
+    SCHEDULEBOARD_SCHEDULE_INTERVAL (both in seconds).
+    :return: the running SnapshotPoller
+    """
+    global poller
+    if poller is None:
+        stations = [station[0] for station in models.STATION_CHOICES]
+        poller = SnapshotPoller(stations, getattr(settings, 'SCHEDULEBOARD_POLL_INTERVAL', 30),
+                                schedule_interval=getattr(settings, 'SCHEDULEBOARD_SCHEDULE_INTERVAL', None))
+        poller.start()
+    return poller
+
+
+def get_snapshot(station):
+    """
+    :param station: the station key
+    :return: the latest snapshot from the process-wide poller, or None if the poller is not running or has not
+    fetched this station yet
+    """
+    if poller is None:
+        return None
+    return poller.get_snapshot(station)
@@ -0,0 +1,266 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.urls import reverse
+import asyncio
+import io
+import json
+import logging
+from . import metrics, services, views
+
+"""
+This file contains the push channel of the schedule board for ASGI deployments: open boards subscribe to
+/schedule/events and receive their changed rows as server-sent events, instead of each of them polling /schedule/api.
+
+Subscribers are grouped by station and filters. A single task per station gets the station's snapshot every
+SCHEDULEBOARD_PUSH_INTERVAL seconds (through views.get_snapshot, so with the same caching, poller and stale
+fallback as page loads), and when a group's rows change, their delta is computed and encoded once and queued for
+every display in the group. The work done, upstream and here, depends on how often the data changes rather than on
+how many displays are open.
+
+Every display has a short queue of pending events. A display that reads too slowly to keep up (its queue is full)
+has its pending deltas dropped and replaced by a single full board, so a slow client never holds up the others or
+makes the server buffer an unbounded backlog for it.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Sent when there is nothing else to send, so proxies keep the connection open and disconnects are noticed.
+KEEPALIVE = b": keepalive\n\n"
+
+
+def encode_event(board):
+    """
+    :param board: a JSON board, see deltas.DeltaLog.get_board
+    :return: the board as a server-sent event named "board"
+    """
+    return f"event: board\ndata: {json.dumps(board, separators=(',', ':'))}\n\n".encode()
+
+
+class Subscriber:
+    """
+    A connected display, and the events waiting to be sent to it.
+    """
+
+    def __init__(self, since=None, max_pending=8):
+        """
+        Creates a new subscriber
+        :param since: the version of the board the display already shows, or None
+        :param max_pending: how many events may wait to be sent before the display is considered too slow
+        """
+        self.since = since
+        self.synced = False  # False until the first event, which is computed from since
+        self.queue = asyncio.Queue(max_pending)
+        self.resyncs = 0
+
+    def offer(self, event, full_event):
+        """
+        Queues an event without waiting. If the queue is full, the pending events are replaced by a full board.
+        :param event: the encoded event
+        :param full_event: a function returning the full board as an encoded event
+        """
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(full_event())
+            self.resyncs += 1
+            metrics.registry.increment("scheduleboard_push_resyncs_total")
+
+
+class Group:
+    """
+    The displays showing the same station with the same filters, and the page of the board they last received.
+    """
+
+    def __init__(self, station, filters):
+        self.station = station
+        self.filters = filters
+        self.key = (station, filters['route_types'], filters['page'], filters['limit'])
+        self.subscribers = set()
+        self.page = None  # the models.StationSnapshot last sent, or None before the first one
+
+    def publish(self, snapshot, delta_log):
+        """
+        Sends the group's page of a new snapshot to its displays, if it changed: the delta is computed and encoded once
+        for all of them.
+        :param snapshot: the station's models.StationSnapshot, for every route type
+        :param delta_log: the deltas.DeltaLog deltas are computed with
+        :return: the number of events queued
+        """
+        page = views.select_page(services.select_rows(snapshot, route_types=self.filters['route_types']), self.filters)
+        previous, self.page = self.page, page
+        full = []
+
+        def full_event():
+            if not full:
+                full.append(encode_event(delta_log.get_board(page)))
+            return full[0]
+
+        event = None
+        if previous is not None and previous.get_version() != page.get_version():
+            event = encode_event(delta_log.get_board(page, previous.get_version()))
+        queued = 0
+        for subscriber in self.subscribers:
+            if not subscriber.synced:
+                subscriber.synced = True
+                subscriber.offer(encode_event(delta_log.get_board(page, subscriber.since)), full_event)
+            elif event:
+                subscriber.offer(event, full_event)
+            else:
+                continue
+            queued += 1
+        metrics.registry.increment("scheduleboard_push_events_total", amount=queued)
+        return queued
+
+
+class Broadcaster:
+    """
+    Keeps the subscriptions of every connected display and the refresh task of every subscribed station. All of its
+    state is only used from the event loop, so it needs no locks.
+    """
+
+    def __init__(self, fetch=None, interval=10, max_pending=8, heartbeat=15, delta_log=None):
+        """
+        Creates a new broadcaster
+        :param fetch: a function taking a station key and returning its models.StationSnapshot for every route type,
+        views.get_snapshot by default. It is called in a worker thread.
+        :param interval: how often, in seconds, each subscribed station is refreshed
+        :param max_pending: the queue length of every display, see Subscriber
+        :param heartbeat: how often, in seconds, an idle connection is sent a keepalive
+        :param delta_log: the deltas.DeltaLog deltas are computed with, views.delta_log by default
+        """
+        self.fetch = fetch or views.get_snapshot
+        self.interval = interval
+        self.max_pending = max_pending
+        self.heartbeat = heartbeat
+        self.delta_log = delta_log or views.delta_log
+        self.groups = {}  # (station, route_types, page, limit) -> Group
+        self._tasks = {}  # station -> the asyncio.Task refreshing it
+
+    def subscribe(self, station, filters, subscriber):
+        """
+        Adds a display, starting the station's refresh task if it is the station's first. If the group already has a
+        page, the display is sent its first event right away.
+        :return: the subscriber's Group
+        """
+        group = Group(station, filters)
+        group = self.groups.setdefault(group.key, group)
+        group.subscribers.add(subscriber)
+        if group.page is not None:
+            subscriber.synced = True
+            subscriber.offer(encode_event(self.delta_log.get_board(group.page, subscriber.since)),
+                             lambda: encode_event(self.delta_log.get_board(group.page)))
+        if station not in self._tasks:
+            self._tasks[station] = asyncio.ensure_future(self.run_station(station))
+        metrics.registry.increment("scheduleboard_push_connections_total")
+        return group
+
+    def unsubscribe(self, group, subscriber):
+        """
+        Removes a display. Groups without displays are forgotten, and so are stations without groups, whose refresh
+        task then ends.
+        """
+        group.subscribers.discard(subscriber)
+        if not group.subscribers and self.groups.get(group.key) is group:
+            del self.groups[group.key]
+
+    def publish(self, station, snapshot):
+        """
+        Sends a new snapshot of a station to every group subscribed to it.
+        :return: the number of events queued
+        """
+        return sum(group.publish(snapshot, self.delta_log)
+                   for group in list(self.groups.values()) if group.station == station)
+
+    async def run_station(self, station):
+        """
+        Refreshes a station every interval seconds, as long as any display is subscribed to it.
+        """
+        fetch = sync_to_async(self.fetch, thread_sensitive=False)
+        try:
+            while self.is_subscribed(station):
+                try:
+                    snapshot = await fetch(station)
+                except Exception as e:
+                    logger.warning(f"Could not refresh {station} for push: {e!r}")
+                else:
+                    self.publish(station, snapshot)
+                await asyncio.sleep(self.interval)
+        finally:
+            del self._tasks[station]
+        logger.debug(f"No display is subscribed to {station} anymore")
+
+    def is_subscribed(self, station):
+        return any(group.station == station for group in self.groups.values())
+
+    async def serve(self, scope, receive, send):
+        """
+        The ASGI application of the push channel: subscribes a display, streams its events until it disconnects.
+        It takes the same station_selection, route_type, limit and page parameters as the board, and since, the
+        version of the board the display already shows.
+        """
+        request = ASGIRequest(scope, io.BytesIO())
+        subscriber = Subscriber(request.GET.get('since'), self.max_pending)
+        group = self.subscribe(views.get_station_key(request), views.get_board_filters(request), subscriber)
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                                    (b'x-accel-buffering', b'no')]})
+            while True:
+                getter = asyncio.ensure_future(subscriber.queue.get())
+                done, pending = await asyncio.wait({getter, disconnected}, timeout=self.heartbeat,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if getter in done:
+                    body = getter.result()
+                else:
+                    getter.cancel()
+                    if disconnected in done:
+                        break
+                    body = KEEPALIVE
+                await send({'type': 'http.response.body', 'body': body, 'more_body': True})  # waits on slow clients
+        finally:
+            disconnected.cancel()
+            self.unsubscribe(group, subscriber)
+
+
+async def wait_for_disconnect(receive):
+    """
+    Waits until the client of an HTTP connection goes away.
+    """
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def create_broadcaster():
+    """
+    :return: a Broadcaster configured by the SCHEDULEBOARD_PUSH_* settings
+    """
+    return Broadcaster(interval=getattr(settings, 'SCHEDULEBOARD_PUSH_INTERVAL', 10),
+                       max_pending=getattr(settings, 'SCHEDULEBOARD_PUSH_QUEUE', 8),
+                       heartbeat=getattr(settings, 'SCHEDULEBOARD_PUSH_HEARTBEAT', 15))
+
+
+class PushApplication:
+    """
+    An ASGI application that serves the push channel itself and passes every other request on to Django, see
+    demosite/asgi.py. Unless SCHEDULEBOARD_PUSH_ENABLED is set, the push channel is passed on too, so Django's
+    views.board_events answers it.
+    """
+
+    def __init__(self, application, broadcaster=None):
+        """
+        :param application: the ASGI application everything else goes to, usually django.core.asgi's
+        :param broadcaster: the Broadcaster to serve, or None to create one from the settings
+        """
+        self.application = application
+        self.broadcaster = broadcaster or create_broadcaster()
+        self.path = reverse('board_events')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == self.path and \
+                getattr(settings, 'SCHEDULEBOARD_PUSH_ENABLED', False):
+            return await self.broadcaster.serve(scope, receive, send)
+        return await self.application(scope, receive, send)
@@ -0,0 +1,219 @@
+from contextlib import contextmanager
+import asyncio
+import contextvars
+import email.utils
+import logging
+import threading
+import time
+
+"""
+This file contains the scheduler every call to the MBTA API goes through. A token bucket, sized from the API key's
+rate limit (see MBTA_API_RATE_LIMIT), spaces the calls out, and adapts to the x-ratelimit-* headers and 429 responses
+the API sends back. Calls made for stations somebody is looking at (HIGH priority) may use every token and are served
+first; background refreshes of idle stations (LOW priority) leave a reserve untouched and are shed when they would
+have to wait too long, so they never crowd out page loads.
+"""
+
+logger = logging.getLogger(__name__)
+
+HIGH = 0
+LOW = 1
+
+# The priority of the calls made in the current context, see with_priority.
+priority = contextvars.ContextVar('priority', default=HIGH)
+
+
+class RateLimited(Exception):
+    """
+    Raised when a call to the MBTA API is shed because no token became available in time.
+    """
+    pass
+
+
+@contextmanager
+def with_priority(level):
+    """
+    Makes the calls to the MBTA API in the enclosed block with the given priority.
+    :param level: HIGH or LOW
+    """
+    token = priority.set(level)
+    try:
+        yield
+    finally:
+        priority.reset(token)
+
+
+class RateLimiter:
+    """
+    A thread-safe token bucket holding up to capacity tokens, refilled at rate tokens per second. Each call to the MBTA
+    API takes one token.
+    """
+
+    def __init__(self, rate, capacity, reserve=0.2, clock=time.monotonic):
+        """
+        Creates a new, full bucket
+        :param rate: the number of tokens added per second
+        :param capacity: the maximum number of tokens, i.e. the largest burst of calls
+        :param reserve: the fraction of capacity that LOW priority calls may not use
+        :param clock: a function returning the current time in seconds, mostly useful for tests
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.reserve = reserve
+        self.clock = clock
+        self.tokens = capacity
+        self.blocked_until = 0  # set when the API tells us we are out of calls
+        self._updated_at = clock()
+        self._waiting_high = 0
+        self._cond = threading.Condition()
+
+    @classmethod
+    def per_minute(cls, limit, **kwargs):
+        """
+        :param limit: the number of calls allowed per minute, e.g. 1000 for the MBTA API with a key
+        :return: a RateLimiter that allows limit calls per minute, in bursts of up to limit calls
+        """
+        return cls(limit / 60, limit, **kwargs)
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def _try_acquire(self, level):
+        """
+        Takes a token if level may have one now. Must be called with the lock held.
+        :return: 0 if a token was taken, otherwise the number of seconds to wait before trying again
+        """
+        now = self.clock()
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        floor = 0 if level == HIGH else self.reserve * self.capacity
+        if level != HIGH and self._waiting_high:
+            return max(1 / self.rate, 0.01)  # let the waiting page loads go first
+        if self.tokens - 1 >= floor:
+            self.tokens -= 1
+            return 0
+        return (floor + 1 - self.tokens) / self.rate
+
+    def acquire(self, level=HIGH, timeout=None):
+        """
+        Takes a token, waiting for one if necessary.
+        :param level: HIGH or LOW
+        :param timeout: the longest time to wait in seconds, or None to wait as long as it takes
+        :return: True if a token was taken, False if none could be had within timeout (the call should be shed)
+        """
+        deadline = None if timeout is None else self.clock() + timeout
+        with self._cond:
+            if level == HIGH:
+                self._waiting_high += 1
+            try:
+                while True:
+                    wait = self._try_acquire(level)
+                    if not wait:
+                        return True
+                    if deadline is not None and self.clock() + wait > deadline:
+                        return False
+                    self._cond.wait(wait)
+            finally:
+                if level == HIGH:
+                    self._waiting_high -= 1
+
+    async def acquire_async(self, level=HIGH, timeout=None):
+        """
+        The asyncio version of acquire, which waits without blocking the event loop.
+        """
+        deadline = None if timeout is None else self.clock() + timeout
+        with self._cond:
+            if level == HIGH:
+                self._waiting_high += 1
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_acquire(level)
+                if not wait:
+                    return True
+                if deadline is not None and self.clock() + wait > deadline:
+                    return False
+                await asyncio.sleep(wait)
+        finally:
+            if level == HIGH:
+                with self._cond:
+                    self._waiting_high -= 1
+
+    def observe(self, status, headers):
+        """
+        Adapts the bucket to what the MBTA API reported about our rate limit. The API counts the calls of every
+        process sharing the key, so its x-ratelimit-remaining can be lower than our own count.
+        :param status: the HTTP status of the response
+        :param headers: the response headers
+        """
+        limit = _header_number(headers, 'x-ratelimit-limit')
+        remaining = _header_number(headers, 'x-ratelimit-remaining')
+        reset = _header_number(headers, 'x-ratelimit-reset')  # seconds since the epoch
+        with self._cond:
+            now = self.clock()
+            self._refill(now)
+            if limit and limit != self.capacity:
+                logger.info(f"The MBTA API allows {limit:g} calls per minute, adjusting")
+                self.rate, self.capacity = limit / 60, limit
+            if remaining is not None:
+                self.tokens = min(self.tokens, remaining)
+            if status == 429 or remaining == 0:
+                self.tokens = 0
+                retry_after = _retry_after(headers)
+                if retry_after is None and reset:
+                    retry_after = reset - time.time()
+                self.blocked_until = max(self.blocked_until, now + max(retry_after or 1 / self.rate, 0))
+                logger.warning(f"Rate limited by the MBTA API for {self.blocked_until - now:.1f} seconds")
+            self._cond.notify_all()
+
+
+def _header_number(headers, name):
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _retry_after(headers):
+    """
+    :return: the number of seconds in a Retry-After header (in seconds or as an HTTP date), or None
+    """
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        date = email.utils.parsedate_to_datetime(value)
+        return date.timestamp() - time.time() if date else None
+
+
+class ViewerTracker:
+    """
+    Remembers which stations somebody looked at recently, so refreshes of those stations can be made HIGH priority.
+    """
+
+    def __init__(self, ttl=120, clock=time.monotonic):
+        """
+        Creates a new tracker
+        :param ttl: how many seconds after the last page load a station still counts as viewed
+        :param clock: a function returning the current time in seconds, mostly useful for tests
+        """
+        self.ttl = ttl
+        self.clock = clock
+        self._seen = {}  # station -> time of the last page load
+
+    def touch(self, station):
+        """
+        Records a page load for station.
+        """
+        self._seen[station] = self.clock()
+
+    def is_active(self, station):
+        """
+        :return: True if station was viewed in the last ttl seconds
+        """
+        seen = self._seen.get(station)
+        return seen is not None and self.clock() - seen < self.ttl
@@ -0,0 +1,126 @@
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib.parse import parse_qsl, urlsplit
+import json
+import logging
+import os
+import requests
+from . import mbta
+
+"""
+This file contains a recorder that saves MBTA API responses to fixture files, and a replay transport that answers
+calls from those fixtures, so that tests and benchmarks can run offline against real responses.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Where `python manage.py recordfixtures` saves fixtures by default
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures', 'mbta')
+
+# Query parameters that depend on when a call is made; they are ignored when matching a call to a fixture, so a
+# fixture recorded at one time can answer the same call made at any other time.
+TIME_PARAMS = ('filter[date]', 'filter[min_time]', 'filter[max_time]')
+
+
+def fixture_key(path, params):
+    """
+    :param path: the API path, e.g. "schedules"
+    :param params: a dictionary of query parameters
+    :return: the key a call is matched to fixtures by
+    """
+    return path.strip('/'), tuple(sorted((name, str(value)) for name, value in params.items()
+                                         if name not in TIME_PARAMS))
+
+
+def record(client, path, params, file_name):
+    """
+    Calls the MBTA API and saves the response, byte for byte, to a fixture file.
+    :param client: the mbta.MBTAClient to call the API with
+    :param path: the API path, e.g. "schedules"
+    :param params: a dictionary of query parameters
+    :param file_name: the fixture file to write
+    :return: the fixture, a dictionary of the path, params, status, headers and body (the response text)
+    """
+    response = client.request(f"{client.base_url}/{path}", params, {})
+    response.raise_for_status()
+    fixture = {
+        'path': path,
+        'params': params,
+        'status': response.status_code,
+        'headers': {name: value for name, value in response.headers.items()
+                    if name.lower() in ('content-type', 'etag', 'last-modified')},
+        'body': response.text,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+    with open(file_name, 'w', encoding='utf-8') as f:
+        json.dump(fixture, f)
+    logger.info(f"Recorded {path} ({len(response.content)} bytes) to {file_name}")
+    return fixture
+
+
+def load_fixture(file_name):
+    """
+    :param file_name: a fixture file written by record
+    :return: the fixture
+    """
+    with open(file_name, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def make_fixture(path, params, document, status=200):
+    """
+    Creates a fixture from a document instead of a recorded response, e.g. from stubs.schedule_document.
+    :param path: the API path, e.g. "schedules"
+    :param params: a dictionary of query parameters
+    :param document: a JSON-serializable document
+    :param status: the HTTP status
+    :return: the fixture
+    """
+    return {'path': path, 'params': params, 'status': status, 'headers': {'Content-Type': 'application/vnd.api+json'},
+            'body': json.dumps(document)}
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    A requests transport adapter that answers every call from fixtures instead of the network. Calls that no fixture
+    matches fail with a requests.ConnectionError, just like calls to an unreachable API.
+    """
+
+    def __init__(self, fixtures):
+        """
+        Creates a new adapter
+        :param fixtures: a list of fixtures, see record and make_fixture
+        """
+        super().__init__()
+        self.fixtures = {fixture_key(fixture['path'], fixture['params']): fixture for fixture in fixtures}
+        self.requests = []  # the URLs of every call, for tests
+
+    def send(self, request, **kwargs):
+        self.requests.append(request.url)
+        url = urlsplit(request.url)
+        fixture = self.fixtures.get(fixture_key(url.path, dict(parse_qsl(url.query))))
+        if fixture is None:
+            raise requests.ConnectionError(f"No fixture recorded for {request.url}", request=request)
+        response = requests.Response()
+        response.status_code = fixture['status']
+        response.headers = CaseInsensitiveDict(fixture['headers'])
+        response._content = fixture['body'].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def replay_client(fixtures):
+    """
+    :param fixtures: a list of fixtures, see record and make_fixture
+    :return: an mbta.MBTAClient that answers every call from fixtures; its adapter is available as client.replay
+    """
+    client = mbta.MBTAClient(retries=0)
+    client.replay = ReplayAdapter(fixtures)
+    client.session.mount("https://", client.replay)
+    client.session.mount("http://", client.replay)
+    return client
@@ -1,9 +1,16 @@
+from django.conf import settings
 from django.utils import timezone
-from datetime import datetime, timedelta
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import asyncio
 import logging
-import requests
-import operator
-from .models import Schedule, Prediction, Route
+import threading
+from . import gtfs, mbta, metrics, streaming
+from .cache import TTLCache
+from .window import ScheduleWindow
+from .models import Schedule, Prediction, Route, RouteRegistry, StationSnapshot
+from .timestamps import parse_mbta_datetime
 
 """
 This file contains methods to access the MBTA API and create our own representations of the resulting JSON response.
@@ -11,28 +18,36 @@ This file contains methods to access the MBTA API and create our own representat
 
 logger = logging.getLogger(__name__)
 
-# This is how the MBTA API currently returns all datetime values.
-mbta_datetime_format = "%Y-%m-%dT%H:%M:%S%z"
+# Schedules are cached per (station, minute) so that many page loads in the same minute share one upstream call.
+schedule_cache = TTLCache(ttl=getattr(settings, 'SCHEDULEBOARD_CACHE_TTL', 30),
+                          max_size=getattr(settings, 'SCHEDULEBOARD_CACHE_SIZE', 64), name='schedule')
 
+# With split refreshes (SCHEDULEBOARD_SCHEDULE_INTERVAL), each station's schedules, without predictions, are kept in a
+# sliding window (see window.py); only the predictions are fetched again for every new snapshot.
+schedule_windows = TTLCache(ttl=getattr(settings, 'SCHEDULEBOARD_WINDOW_RESET', 3600),
+                            max_size=getattr(settings, 'SCHEDULEBOARD_CACHE_SIZE', 64), name='window')
 
-def fix_UTC_offset(date_string):
-    """
-    Python 3.6 and lower does not like when a date string has a colon in the UTC offset, such as
-    2020-04-20T23:59:59-04:00
-    Intead, Pyton 3.6 and lower needs the colon removed:
-     2020-04-20T23:59:59-0400
+# The last snapshot fetched for each station and route types. It is served when a fresh one cannot be fetched, and,
+# with SCHEDULEBOARD_STALE_WHILE_REVALIDATE, right away while a fresh one is fetched in the background.
+last_good = TTLCache(ttl=getattr(settings, 'SCHEDULEBOARD_STALE_TTL', 3600),
+                     max_size=getattr(settings, 'SCHEDULEBOARD_CACHE_SIZE', 64), name='stale')
 
-    We can fix this easily by simply removing the colon if it exists.
-    (Python 3.7 and later does not have this issue.)
+# Runs the background fetches of stale-while-revalidate, at most one at a time per station and route types, so
+# worker threads never pile up behind a slow MBTA API.
+revalidator = ThreadPoolExecutor(max_workers=getattr(settings, 'SCHEDULEBOARD_REVALIDATE_WORKERS', 2),
+                                 thread_name_prefix='scheduleboard-revalidate')
+_revalidating = set()  # the window_keys being revalidated
+_revalidating_lock = threading.Lock()
 
-    See https://stackoverflow.com/questions/30999230/how-to-parse-timezone-with-colon for an example.
+# The length of the window of schedules shown on the board
+WINDOW_LENGTH = timedelta(hours=6)
 
-    :param date_string: a date string of the format "%Y-%m-%dT%H:%M:%S%z"
-    :return: The date string with the UTC offset fixed
-    """
-    if ":" == date_string[-3:-2]:
-        date_string = date_string[:-3] + date_string[-2:]
-    return date_string
+# MBTA service days start in the early morning: trips that run after midnight belong to the previous day's service,
+# and the MBTA API counts their times on past 24:00 (e.g. 25:10 for 1:10 AM). No service time is later than this.
+SERVICE_DAY_LENGTH = timedelta(hours=28)
+
+# Routes are shared across requests and stations, and only rebuilt every SCHEDULEBOARD_ROUTE_REFRESH seconds.
+route_registry = RouteRegistry(refresh_interval=getattr(settings, 'SCHEDULEBOARD_ROUTE_REFRESH', 3600))
 
 
 def create_schedule(json, routes, predictions):
@@ -43,52 +58,52 @@ def create_schedule(json, routes, predictions):
     :param predictions: a list of models.Prediction objects
     :return: a list of models.Schedule objects, in chronological order (earliest schedule first)
     """
-    schedules = []
-
-    for element in json:
-        assert (element["type"] == "schedule")  # here we check to ensure we're not parsing the wrong JSON
-        arrival_time = element["attributes"]["arrival_time"]
-        if arrival_time:
-            arrival_time = fix_UTC_offset(arrival_time)
-            arrival_time = datetime.strptime(arrival_time, mbta_datetime_format)
-        departure_time = element["attributes"]["departure_time"]
-        if departure_time:
-            departure_time = fix_UTC_offset(departure_time)
-            departure_time = datetime.strptime(departure_time, mbta_datetime_format)
-        direction = element["attributes"]["direction_id"]
-        route_id = element["relationships"]["route"]["data"]["id"]
-        trip_id = element["relationships"]["trip"]["data"]["id"]
-        stop_id = element["relationships"]["stop"]["data"]["id"]
-
-        route = routes[route_id]
-        prediction = None
-        if element["relationships"]["prediction"]["data"]:
-            prediction_id = element["relationships"]["prediction"]["data"]["id"]
-            prediction = predictions[prediction_id]
-        sid = element["id"]
-        schedule = Schedule(sid, arrival_time, departure_time, direction, route, trip_id, stop_id, prediction)
-        schedules.append(schedule)
-
-    schedules.sort(key=lambda x: x.get_scheduled_time()) # sort the schedules by their scheduled time
+    with metrics.stage("create_schedule"):
+        schedules = [create_schedule_entry(element, routes, predictions) for element in json]
+    with metrics.stage("sort"):
+        schedules.sort(key=Schedule.get_scheduled_time)  # sort the schedules by their scheduled time
     return schedules
 
 
+def create_schedule_entry(element, routes, predictions):
+    """
+    Creates a single models.Schedule object from a JSON dictionary
+    :param element: a single json dictionary element where type="schedule"
+    :param routes: a dictionary of route_id -> models.Route objects
+    :param predictions: a dictionary of prediction_id -> models.Prediction objects
+    :return: a models.Schedule object
+    """
+    assert (element["type"] == "schedule")  # here we check to ensure we're not parsing the wrong JSON
+    attributes = element["attributes"]
+    relationships = element["relationships"]
+    arrival_time = attributes["arrival_time"]
+    if arrival_time:
+        arrival_time = parse_mbta_datetime(arrival_time)
+    departure_time = attributes["departure_time"]
+    if departure_time:
+        departure_time = parse_mbta_datetime(departure_time)
+
+    prediction = None
+    prediction_data = relationships.get("prediction", {}).get("data")  # only present with include=prediction
+    if prediction_data:
+        prediction = predictions.get(prediction_data["id"])
+    return Schedule(element["id"], arrival_time, departure_time, attributes["direction_id"],
+                    routes[relationships["route"]["data"]["id"]], relationships["trip"]["data"]["id"],
+                    relationships["stop"]["data"]["id"], prediction)
+
+
 def create_route(json):
     """
-    creates a single models.Route object from a JSON dictionary
+    creates a single models.Route object from a JSON dictionary. Routes are interned in route_registry, so this
+    returns the existing Route object for the id whenever there is one.
     :param json: a dictionary of JSON key/value pairs.
     :return: a models.Route object
     """
     assert (json["type"] == "route")  # check to ensure this is valid JSON
-    rid = json["id"]
-    c = json["attributes"]["color"]
-    tc = json["attributes"]["text_color"]
-    sn = json["attributes"]["short_name"]
-    ln = json["attributes"]["long_name"]
-    dd = json["attributes"]["direction_destinations"]
-    dn = json["attributes"]["direction_names"]
-    rt = json["attributes"]["type"]
-    return Route(rid, c, tc, sn, ln, dd, dn, rt)
+    attributes = json["attributes"]
+    return route_registry.intern(json["id"], lambda: Route(
+        json["id"], attributes["color"], attributes["text_color"], attributes["short_name"], attributes["long_name"],
+        attributes["direction_destinations"], attributes["direction_names"], attributes["type"]))
 
 
 def create_prediction(json):
@@ -98,18 +113,14 @@ def create_prediction(json):
     :return: a models.Prediction object
     """
     assert(json["type"] == "prediction")  # check to ensure this is valid JSON
-    pid = json["id"]
-    at = json["attributes"]["arrival_time"]
+    attributes = json["attributes"]
+    at = attributes["arrival_time"]
     if at:
-        at = fix_UTC_offset(at)
-        at = datetime.strptime(at, mbta_datetime_format)
-    dt = json["attributes"]["departure_time"]
+        at = parse_mbta_datetime(at)
+    dt = attributes["departure_time"]
     if dt:
-        dt = fix_UTC_offset(dt)
-        dt = datetime.strptime(dt, mbta_datetime_format)
-    di = json["attributes"]["direction_id"]
-    s = json["attributes"]["status"]
-    return Prediction(pid, at, dt, di, s)
+        dt = parse_mbta_datetime(dt)
+    return Prediction(json["id"], at, dt, attributes["direction_id"], attributes["status"])
 
 
 def parse_included(included):
@@ -123,59 +134,601 @@ def parse_included(included):
     routes = {}
     predictions = {}
     for element in included:
-        if element["type"] == "route":
-            route = create_route(element)
-            routes[route.id] = route
-        elif element["type"] == "prediction":
-            prediction = create_prediction(element)
-            predictions[prediction.id] = prediction
+        kind = element["type"]
+        if kind == "route":
+            routes[element["id"]] = create_route(element)
+        elif kind == "prediction":
+            predictions[element["id"]] = create_prediction(element)
     return routes, predictions
 
 
-def get_schedules_routes_and_predictions(min_time, station_name):
+def parse_schedule_document(document):
+    """
+    Builds the models for a whole /schedules response in a single pass over the decoded document: the included
+    routes and predictions are indexed by id first, so each schedule can resolve its relationships as it is created.
+    :param document: the decoded JSON document of a /schedules response made with include=prediction,route
+    :return: a tuple of Schedules (list of Model.Schedules, in chronological order),
+    Routes (dictionary by ID, models.Route), and Predictions (dictionary by ID, models.Prediction)
+    """
+    with metrics.stage("parse_included"):
+        routes, predictions = parse_included(document.get('included', ()))
+    schedule = create_schedule(document['data'], routes, predictions)
+    logger.debug(f"Parsed {len(schedule)} schedules, {len(routes)} routes and {len(predictions)} predictions")
+    return schedule, routes, predictions
+
+
+def service_day_windows(min_time, max_time):
+    """
+    Splits a window of time into the parts that fall on each MBTA service day. A window that crosses the early
+    morning, such as 22:00 to 04:00, has a part on both days: the previous day's trips that run after midnight, and the
+    next day's first trips.
+    :param min_time: the (timezone aware) start of the window
+    :param max_time: the (timezone aware) end of the window
+    :return: a list of (service date, first, last) tuples in chronological order, where first and last are
+    timedeltas from the start of the service date (see gtfs.service_day_start)
+    """
+    zone = timezone.get_current_timezone()
+    day, last_day = min_time.astimezone(zone).date() - timedelta(days=1), max_time.astimezone(zone).date()
+    windows = []
+    while day <= last_day:
+        start = gtfs.service_day_start(day)
+        first, last = max(min_time - start, timedelta(0)), min(max_time - start, SERVICE_DAY_LENGTH)
+        if first < last:
+            windows.append((day, first, last))
+        day += timedelta(days=1)
+    return windows
+
+
+def format_service_time(offset):
+    """
+    :param offset: a timedelta from the start of a service day
+    :return: the offset as a filter[min_time] or filter[max_time] value, e.g. "25:10"
+    """
+    minutes = int(offset.total_seconds() // 60)
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def schedule_payloads(min_time, stops, route_types=None, max_time=None, include='prediction,trip,route'):
+    """
+    Builds the query parameters for the /schedules calls covering a window of time, one call per service day the
+    window falls on (see service_day_windows); usually a single one.
+    :param min_time: the (timezone aware) datetime the window starts at
+    :param stops: the value for filter[stop], a single stop id or a comma separated list of them
+    :param route_types: an iterable of route types to ask for, or None for every route type
+    :param max_time: the (timezone aware) datetime the window ends at, by default WINDOW_LENGTH after min_time
+    :param include: the related resources to include
+    :return: a list of dictionaries of query parameters
+    """
+# example URL https://api-v3.mbta.com/schedules?include=prediction&filter[min_time]=14%3A00&filter[max_time]=14%3A30&filter[stop]=place-sstat
+    payloads = []
+    for day, first, last in service_day_windows(min_time, max_time or min_time + WINDOW_LENGTH):
+        payload = {
+            'filter[stop]': stops,
+            'filter[min_time]': format_service_time(first),
+            'filter[max_time]': format_service_time(last),
+            'filter[date]': day.isoformat(),
+            'sort': 'arrival_time',
+            'include': include}
+        if route_types:
+            payload['filter[route_type]'] = ",".join(str(route_type) for route_type in sorted(route_types))
+        logger.debug(f"Using filter[date]: {payload['filter[date]']}, filter[min_time]: {payload['filter[min_time]']}, "
+                     f"filter[max_time]: {payload['filter[max_time]']}")
+        payloads.append(payload)
+    return payloads
+
+
+def schedule_payload(min_time, stops, route_types=None):
+    """
+    Builds the query parameters for the first /schedules call of the six hour window starting at min_time, see
+    schedule_payloads.
+    :return: a dictionary of query parameters
+    """
+    return schedule_payloads(min_time, stops, route_types)[0]
+
+
+def get_schedule_document(min_time, stops, route_types=None, max_time=None, include='prediction,trip,route'):
+    """
+    Calls /schedules for a window of time, once for every service day it falls on, see schedule_payloads.
+    :return: the decoded JSON document, with the data and included resources of every call
+    """
+    payloads = schedule_payloads(min_time, stops, route_types, max_time, include)
+    return merge_documents([mbta.client.get('schedules', payload) for payload in payloads])
+
+
+def merge_documents(documents):
+    """
+    :param documents: a list of decoded JSON documents of /schedules responses
+    :return: a single document with the data (without duplicates) and included resources of all of them
+    """
+    if len(documents) == 1:
+        return documents[0]
+    seen, data, included = set(), [], []
+    for document in documents:
+        for element in document['data']:
+            if element['id'] not in seen:
+                seen.add(element['id'])
+                data.append(element)
+        included.extend(document.get('included', ()))
+    return {'data': data, 'included': included}
+
+
+def get_schedules_routes_and_predictions(min_time, station_name, route_types=None):
     """
     This method calls out the the MBTA API to get schedules, routes, and predictions (when available)
-    for a six hour window starting at min_time. Results are always for the current day, although they may span into
-    the next day if this is called with a min_time is close to midnight.
+    for a six hour window starting at min_time. A window that crosses the early morning takes a call for each of the
+    service days it falls on, see service_day_windows.
 
     See https://api-v3.mbta.com/docs/swagger/index.html#/Schedule for a description of how filter[min_time] and
     filter[max_time] work, as the behavior may not be intuitive when crossing over midnight into tomorrow morning.
 
-    :param min_time: the min_time filter to use (refer to mbta api documentation).
-    min_time should be a HH:MM formatted string in 24 hour time, e.g., "01:00", "00:35", "24:00"
+    :param min_time: the (timezone aware) datetime the window starts at
     :param station_name: the station ID as used by the MBTA API.
     See https://api-v3.mbta.com/docs/swagger/index.html#/Stop/ for potential names. Parent names (e.g., "place-north")
     are also supported.
+    :param route_types: an iterable of route types (see models.Route) to include, or None for every route type.
+    The filter is applied by the MBTA API, so other route types are never downloaded or parsed.
     :return: a tuple of Schedules (list of Model.Schedules),
     Routes (dictionary by ID, models.Route), and Predictions (dictionary by ID, models.Prediction)
     """
-# example URL https://api-v3.mbta.com/schedules?include=prediction&filter[min_time]=14%3A00&filter[max_time]=14%3A30&filter[stop]=place-sstat
-    hours_to_get = 6
-    current_time = min_time.strftime("%H:%M")
-    current_date = min_time.strftime("%Y-%m-%d")
-
-    max_time = str(min_time.hour + hours_to_get).zfill(2)+min_time.strftime(":%M")
-    logger.debug(f"Using filter[date]: {current_date}, filter[min_time]: {current_time}, filter[max_time]: {max_time}")
-    logger.debug(f"Current time: {current_time}")
-    logger.debug(f"Current date: {current_date}")
-    payload = {
-        'filter[stop]': station_name,
-        'filter[min_time]': current_time,
-        'filter[max_time]': max_time,
-        'filter[date]': current_date,
-        'sort': 'arrival_time',
-        'include': 'prediction,trip,route'}
-    response = requests.get('https://api-v3.mbta.com/schedules', params=payload)
-    logger.debug(f"Response was {response}")
-
-    included = response.json()['included']
-    logger.debug(f"There were {len(included)} included")
-    routes, predictions = parse_included(included)
-    logger.debug(f"Now there are {len(routes)} routes and {len(predictions)} predictions")
-
-    data = response.json()['data']
-    logger.debug(f"There were {len(data)} data ")
-    schedule = create_schedule(data, routes, predictions)
-    logger.debug(f"Now there are {len(schedule)} schedules")
+    document = get_schedule_document(min_time, station_name, route_types)
+    schedule, routes, predictions = parse_schedule_document(document)
+    return schedule, routes, predictions
+
+
+def get_cached_schedules_routes_and_predictions(min_time, station_name, route_types=None):
+    """
+    A cached version of get_schedules_routes_and_predictions. Results are keyed by station and by the minute of
+    min_time, and are kept for SCHEDULEBOARD_CACHE_TTL seconds. Concurrent calls for the same key share a single
+    call to the MBTA API.
+
+    Callers must treat the returned objects as read-only, since they are shared between requests.
+
+    :param min_time: see get_schedules_routes_and_predictions
+    :param station_name: see get_schedules_routes_and_predictions
+    :param route_types: see get_schedules_routes_and_predictions
+    :return: see get_schedules_routes_and_predictions
+    """
+    snapshot = get_cached_station_snapshot(min_time, station_name, route_types)
+    return snapshot.schedule, snapshot.routes, snapshot.predictions
+
+
+def get_cached_station_snapshot(min_time, station_name, route_types=None):
+    """
+    Like get_cached_schedules_routes_and_predictions, but returns the cached models.StationSnapshot itself.
+    If SCHEDULEBOARD_SCHEDULE_INTERVAL is set, the schedules are kept in a sliding window (see get_schedule_window)
+    and every new snapshot fetches just the predictions. If the station is streamed (see SCHEDULEBOARD_STREAMING),
+    the snapshot is built from the streams without calling the MBTA API.
+    :param min_time: see get_schedules_routes_and_predictions
+    :param station_name: see get_schedules_routes_and_predictions
+    :param route_types: see get_schedules_routes_and_predictions
+    :return: a models.StationSnapshot
+    """
+    streamed = get_streamed_snapshot(min_time, station_name, route_types)
+    if streamed:
+        return streamed
+
+    def fetch():
+        if getattr(settings, 'SCHEDULEBOARD_GTFS_ENABLED', False):
+            schedule, routes, predictions = get_local_schedules_routes_and_predictions(min_time, station_name,
+                                                                                      route_types)
+        elif getattr(settings, 'SCHEDULEBOARD_SCHEDULE_INTERVAL', 0):
+            skeleton = get_schedule_window(station_name, route_types).advance(min_time)[station_name]
+            predictions = get_predictions_for_stations([station_name], route_types)
+            return merge_predictions(skeleton, predictions, min_time)
+        else:
+            schedule, routes, predictions = get_schedules_routes_and_predictions(min_time, station_name, route_types)
+        return StationSnapshot(station_name, schedule, routes, predictions, min_time)
+
+    def fetch_and_keep():
+        snapshot = fetch()
+        last_good.set(window_key(station_name, route_types), snapshot)
+        return snapshot
+
+    return schedule_cache.get_or_fetch(snapshot_cache_key(min_time, station_name, route_types), fetch_and_keep)
+
+
+def get_streamed_snapshot(min_time, station_name, route_types=None):
+    """
+    :param min_time: see get_schedules_routes_and_predictions
+    :param station_name: see get_schedules_routes_and_predictions
+    :param route_types: see get_schedules_routes_and_predictions
+    :return: a models.StationSnapshot built from the station's streams (see streaming.StationStream), cached until
+    the minute or the streams change, or None if the station is not streamed
+    """
+    stream = streaming.get_stream(station_name)
+    if stream is None:
+        return None
+    key = ('stream', stream.get_version()) + snapshot_cache_key(min_time, station_name, route_types)
+    return schedule_cache.get_or_fetch(key, lambda: select_rows(stream.get_snapshot(min_time), route_types=route_types))
+
+
+def get_snapshot_or_stale(min_time, station_name, route_types=None):
+    """
+    Like get_cached_station_snapshot, but never fails while there is a last good snapshot: if the MBTA API cannot be
+    reached (or the circuit breaker or rate limiter does not let the call through), the last good snapshot is served
+    instead. With SCHEDULEBOARD_STALE_WHILE_REVALIDATE, a cache miss does not wait on the MBTA API at all: the last
+    good snapshot is served right away, and a fresh one is fetched in the background.
+    Either way, the snapshot's fetched_at tells how old it is.
+    :param min_time: see get_schedules_routes_and_predictions
+    :param station_name: see get_schedules_routes_and_predictions
+    :param route_types: see get_schedules_routes_and_predictions
+    :return: a models.StationSnapshot
+    """
+    if getattr(settings, 'SCHEDULEBOARD_STALE_WHILE_REVALIDATE', False):
+        snapshot = schedule_cache.get(snapshot_cache_key(min_time, station_name, route_types))
+        if snapshot:
+            return snapshot
+        stale = get_stale_snapshot(min_time, station_name, route_types)
+        if stale:
+            revalidate(min_time, station_name, route_types)
+            return stale
+    try:
+        return get_cached_station_snapshot(min_time, station_name, route_types)
+    except Exception as e:
+        stale = get_stale_snapshot(min_time, station_name, route_types)
+        if stale is None:
+            raise
+        logger.warning(f"Could not fetch {station_name}, serving the snapshot fetched at {stale.fetched_at}: {e}")
+        return stale
+
+
+def get_stale_snapshot(min_time, station_name, route_types=None):
+    """
+    :param min_time: the current time
+    :param station_name: see get_schedules_routes_and_predictions
+    :param route_types: see get_schedules_routes_and_predictions
+    :return: the last good snapshot of the station, without the schedules that have left since, or None
+    """
+    snapshot = last_good.get(window_key(station_name, route_types))
+    if snapshot is None:
+        return None
+    metrics.registry.increment("scheduleboard_stale_served_total", (("station", station_name),))
+    return drop_departed(snapshot, min_time)
+
+
+def revalidate(min_time, station_name, route_types=None):
+    """
+    Fetches a fresh snapshot of the station in the background, unless one is already being fetched.
+    :return: True if a fetch was started
+    """
+    key = window_key(station_name, route_types)
+    with _revalidating_lock:
+        if key in _revalidating:
+            return False
+        _revalidating.add(key)
+
+    def run():
+        try:
+            get_cached_station_snapshot(min_time, station_name, route_types)
+        except Exception as e:
+            logger.warning(f"Could not revalidate {station_name}: {e}")
+        finally:
+            with _revalidating_lock:
+                _revalidating.discard(key)
+
+    revalidator.submit(run)
+    return True
+
+
+async def get_station_snapshot_async(min_time, station_name, route_types=None):
+    """
+    The asyncio version of get_snapshot_or_stale, for async views. It shares the same caches, but concurrent
+    misses are not coalesced, since waiting on another thread's fetch would block the event loop.
+    Requires httpx, see mbta.AsyncMBTAClient.
+    :param min_time: see get_schedules_routes_and_predictions
+    :param station_name: see get_schedules_routes_and_predictions
+    :param route_types: see get_schedules_routes_and_predictions
+    :return: a models.StationSnapshot
+    """
+    key = snapshot_cache_key(min_time, station_name, route_types)
+    snapshot = schedule_cache.get(key) or get_streamed_snapshot(min_time, station_name, route_types)
+    if snapshot:
+        return snapshot
+    if getattr(settings, 'SCHEDULEBOARD_STALE_WHILE_REVALIDATE', False):
+        stale = get_stale_snapshot(min_time, station_name, route_types)
+        if stale:
+            revalidate(min_time, station_name, route_types)
+            return stale
+    try:
+        snapshot = await fetch_station_snapshot_async(min_time, station_name, route_types)
+    except Exception as e:
+        stale = get_stale_snapshot(min_time, station_name, route_types)
+        if stale is None:
+            raise
+        logger.warning(f"Could not fetch {station_name}, serving the snapshot fetched at {stale.fetched_at}: {e}")
+        return stale
+    schedule_cache.set(key, snapshot)
+    last_good.set(window_key(station_name, route_types), snapshot)
+    return snapshot
+
+
+async def fetch_station_snapshot_async(min_time, station_name, route_types=None):
+    """
+    Fetches a station's snapshot for get_station_snapshot_async, without any caching of its own.
+    :return: a models.StationSnapshot
+    """
+    if getattr(settings, 'SCHEDULEBOARD_SCHEDULE_INTERVAL', 0) and \
+            not getattr(settings, 'SCHEDULEBOARD_GTFS_ENABLED', False):
+        # the window only calls the MBTA API once every SCHEDULEBOARD_SCHEDULE_INTERVAL, in a worker thread of its own,
+        # so the blocking calls of concurrent page loads do not queue up on a single shared thread
+        advance = sync_to_async(get_schedule_window(station_name, route_types).advance, thread_sensitive=False)
+        skeletons = await advance(min_time)
+        skeleton = skeletons[station_name]
+        document = await mbta.async_client.get('predictions', predictions_payload(station_name, route_types))
+        return merge_predictions(skeleton, parse_predictions(document), min_time)
+    if getattr(settings, 'SCHEDULEBOARD_GTFS_ENABLED', False):
+        schedule, routes = await sync_to_async(gtfs.get_schedule)(min_time, station_name, route_types=route_types)
+        try:
+            document = await mbta.async_client.get('predictions', predictions_payload(station_name, route_types))
+        except Exception:
+            logger.exception(f"Could not fetch predictions for {station_name}, showing the schedule only")
+            document = {'data': []}
+        predictions = attach_predictions(schedule, parse_predictions(document))
+    else:
+        documents = await asyncio.gather(*(mbta.async_client.get('schedules', payload)
+                                           for payload in schedule_payloads(min_time, station_name, route_types)))
+        schedule, routes, predictions = parse_schedule_document(merge_documents(documents))
+    return StationSnapshot(station_name, schedule, routes, predictions, min_time)
+
+
+def predictions_payload(station_name, route_types=None):
+    """
+    Builds the query parameters for a /predictions call for a station.
+    :param station_name: the station ID as used by the MBTA API
+    :param route_types: an iterable of route types to ask for, or None for every route type
+    :return: a dictionary of query parameters
+    """
+    payload = {'filter[stop]': station_name}
+    if route_types:
+        payload['filter[route_type]'] = ",".join(str(route_type) for route_type in sorted(route_types))
+    return payload
+
+
+def parse_predictions(document):
+    """
+    Creates models.Prediction objects from a /predictions response, indexed by the trip and stop they predict.
+    :param document: the decoded JSON document of a /predictions response
+    :return: a dictionary of (trip_id, stop_id) -> models.Prediction
+    """
+    predictions = {}
+    for element in document['data']:
+        relationships = element["relationships"]
+        key = relationships["trip"]["data"]["id"], relationships["stop"]["data"]["id"]
+        predictions[key] = create_prediction(element)
+    return predictions
+
+
+def attach_predictions(schedule, predictions):
+    """
+    Sets the prediction of every schedule that has one.
+    :param schedule: a list of models.Schedule objects; they are modified in place
+    :param predictions: a dictionary of (trip_id, stop_id) -> models.Prediction, see parse_predictions
+    :return: a dictionary of prediction_id -> models.Prediction, of the predictions that were attached
+    """
+    attached = {}
+    for entry in schedule:
+        prediction = predictions.get((entry.trip_id, entry.stop_id))
+        entry.prediction = prediction
+        if prediction:
+            attached[prediction.id] = prediction
+    return attached
+
 
+def get_local_schedules_routes_and_predictions(min_time, station_name, route_types=None):
+    """
+    Like get_schedules_routes_and_predictions, but the schedules are computed from the imported GTFS feed (see
+    gtfs.py) and only the predictions are fetched from the MBTA API. If the predictions cannot be fetched, the
+    schedules are returned without them.
+    :param min_time: a timezone aware datetime, the start of the six hour window
+    :param station_name: see get_schedules_routes_and_predictions
+    :param route_types: see get_schedules_routes_and_predictions
+    :return: see get_schedules_routes_and_predictions
+    """
+    with metrics.stage("gtfs"):
+        schedule, routes = gtfs.get_schedule(min_time, station_name, route_types=route_types)
+    try:
+        document = mbta.client.get('predictions', predictions_payload(station_name, route_types))
+    except Exception:
+        logger.exception(f"Could not fetch predictions for {station_name}, showing the schedule only")
+        document = {'data': []}
+    predictions = attach_predictions(schedule, parse_predictions(document))
     return schedule, routes, predictions
+
+
+def snapshot_cache_key(min_time, station_name, route_types=None):
+    """
+    :return: the schedule_cache key for a station's snapshot in the minute of min_time
+    """
+    return station_name, min_time.strftime("%Y-%m-%dT%H:%M"), tuple(sorted(route_types)) if route_types else None
+
+
+def window_key(station_name, route_types=None):
+    """
+    :return: the schedule_windows key for a station's schedules
+    """
+    return station_name, tuple(sorted(route_types)) if route_types else None
+
+
+# Schedules of at least this many rows are filtered by route type through their columnar.ScheduleTable when NumPy is
+# installed; on shorter ones the fixed cost of the vectorized filter outweighs the per-row loop it saves.
+COLUMNAR_MIN_ROWS = 400
+
+
+def select_rows(snapshot, route_types=None, offset=0, limit=None):
+    """
+    Selects part of a snapshot's schedule, e.g. a single page of the board.
+    :param snapshot: a models.StationSnapshot
+    :param route_types: an iterable of route types to keep, or None to keep every route type
+    :param offset: the number of (matching) rows to skip
+    :param limit: the maximum number of rows to keep, or None for no limit
+    :return: a new models.StationSnapshot with the selected schedules and only the routes and predictions they use,
+    or the snapshot itself if nothing was filtered out
+    """
+    schedule = snapshot.schedule
+    table = snapshot.get_table() if route_types and len(schedule) >= COLUMNAR_MIN_ROWS else None
+    if table is not None:
+        schedule = table.filter(route_types=route_types).to_list(limit, offset)  # vectorized, see columnar.py
+    else:
+        if route_types:
+            route_types = set(route_types)
+            schedule = [s for s in schedule if s.route.route_type in route_types]
+        if offset or limit is not None:
+            schedule = schedule[offset:None if limit is None else offset + limit]
+    if len(schedule) == len(snapshot.schedule):
+        return snapshot
+    routes = {s.route.id: s.route for s in schedule}
+    predictions = {s.prediction.id: s.prediction for s in schedule if s.prediction}
+    return StationSnapshot(snapshot.station, schedule, routes, predictions, snapshot.fetched_at)
+
+
+def get_schedule_skeleton(min_time, station_name, route_types=None, max_time=None):
+    """
+    Fetches a station's schedules without their predictions. Schedules hardly change, so they can be kept for a long
+    time while their predictions are refreshed often, see get_schedule_window and merge_predictions.
+    :param min_time: see get_schedules_routes_and_predictions
+    :param station_name: see get_schedules_routes_and_predictions
+    :param route_types: see get_schedules_routes_and_predictions
+    :param max_time: the end of the window, by default WINDOW_LENGTH after min_time
+    :return: a models.StationSnapshot without predictions
+    """
+    document = get_schedule_document(min_time, station_name, route_types, max_time, include='route')
+    schedule, routes, predictions = parse_schedule_document(document)
+    return StationSnapshot(station_name, schedule, routes, {}, min_time)
+
+
+def get_schedule_window(station_name, route_types=None):
+    """
+    :param station_name: see get_schedules_routes_and_predictions
+    :param route_types: see get_schedules_routes_and_predictions
+    :return: the window.ScheduleWindow that keeps the station's schedules for route_types. Its end moves forward
+    every SCHEDULEBOARD_SCHEDULE_INTERVAL seconds, and it is fetched whole every SCHEDULEBOARD_WINDOW_RESET seconds.
+    """
+    def fetch(min_time, stations, max_time):
+        skeleton = get_schedule_skeleton(min_time, station_name, route_types, max_time)
+        return {station_name: (skeleton.schedule, skeleton.routes)}
+
+    return schedule_windows.get_or_fetch(window_key(station_name, route_types), lambda: ScheduleWindow(
+        [station_name], fetch, hours=WINDOW_LENGTH.total_seconds() / 3600,
+        step=getattr(settings, 'SCHEDULEBOARD_SCHEDULE_INTERVAL', 0),
+        reset=getattr(settings, 'SCHEDULEBOARD_WINDOW_RESET', 3600)))
+
+
+def get_predictions_for_stations(station_names, route_types=None):
+    """
+    Fetches the current predictions for many stations with a single call to /predictions.
+    :param station_names: an iterable of station IDs
+    :param route_types: see get_schedules_routes_and_predictions
+    :return: a dictionary of (trip_id, stop_id) -> models.Prediction, see parse_predictions
+    """
+    document = mbta.client.get('predictions', predictions_payload(",".join(station_names), route_types))
+    return parse_predictions(document)
+
+
+def merge_predictions(skeleton, predictions, now):
+    """
+    Creates a snapshot from a skeleton's schedules and the latest predictions, matched by trip and stop.
+    Schedules that have already left (by their predicted time, if they have one) are dropped. The skeleton is not
+    modified: schedules whose prediction did not change are shared with it, the others are copied.
+    :param skeleton: a models.StationSnapshot, see get_schedule_skeleton
+    :param predictions: a dictionary of (trip_id, stop_id) -> models.Prediction, see parse_predictions
+    :param now: the (timezone aware) time of the predictions
+    :return: a new models.StationSnapshot
+    """
+    cutoff = now - timedelta(minutes=1)
+    schedule, attached = [], {}
+    for entry in skeleton.schedule:
+        prediction = predictions.get((entry.trip_id, entry.stop_id))
+        if prediction:
+            attached[prediction.id] = prediction
+        if has_departed(entry, prediction, cutoff):
+            continue
+        if not same_prediction(entry.prediction, prediction):
+            entry = Schedule(entry.id, entry.arrival_time, entry.departure_time, entry.direction_id, entry.route,
+                             entry.trip_id, entry.stop_id, prediction)
+        schedule.append(entry)
+    return StationSnapshot(skeleton.station, schedule, skeleton.routes, attached, now)
+
+
+def has_departed(entry, prediction, cutoff):
+    """
+    :param entry: a models.Schedule
+    :param prediction: its latest models.Prediction, or None
+    :param cutoff: a (timezone aware) datetime
+    :return: True if the entry left before cutoff, by its predicted time if it has one
+    """
+    departs = entry.get_scheduled_time()
+    if prediction and prediction.get_display_time():
+        departs = max(departs, prediction.get_display_time())
+    return departs < cutoff
+
+
+def drop_departed(snapshot, now):
+    """
+    :param snapshot: a models.StationSnapshot
+    :param now: the current (timezone aware) time
+    :return: a snapshot without the schedules that left more than a minute before now, or the snapshot itself if
+    none did
+    """
+    cutoff = now - timedelta(minutes=1)
+    schedule = [s for s in snapshot.schedule if not has_departed(s, s.prediction, cutoff)]
+    if len(schedule) == len(snapshot.schedule):
+        return snapshot
+    predictions = {s.prediction.id: s.prediction for s in schedule if s.prediction}
+    return StationSnapshot(snapshot.station, schedule, snapshot.routes, predictions, snapshot.fetched_at)
+
+
+def same_prediction(old, new):
+    """
+    :return: True if two predictions (either may be None) show the same time and status
+    """
+    if old is None or new is None:
+        return old is new
+    return (old.id, old.arrival_time, old.departure_time, old.status) == \
+        (new.id, new.arrival_time, new.departure_time, new.status)
+
+
+def parse_parent_stations(included):
+    """
+    Finds the parent station of every stop in a response made with include=stop.
+    :param included: a list of json dictionaries
+    :return: a dictionary of stop_id -> parent station id; stops without a parent map to themselves
+    """
+    parents = {}
+    for element in included:
+        if element["type"] == "stop":
+            parent = element["relationships"].get("parent_station", {}).get("data")
+            parents[element["id"]] = parent["id"] if parent else element["id"]
+    return parents
+
+
+def get_schedules_for_stations(min_time, station_names, predictions=True, max_time=None):
+    """
+    Like get_schedules_routes_and_predictions, but for many stations at once. A single call to the MBTA API is made
+    for all of them, and the combined response is parsed once and then split up by station.
+    :param min_time: see get_schedules_routes_and_predictions
+    :param station_names: an iterable of station IDs, e.g. the keys of models.STATION_CHOICES
+    :param predictions: False to fetch only the schedules, see get_schedule_skeleton
+    :param max_time: the end of the window, by default WINDOW_LENGTH after min_time
+    :return: a dictionary of station ID -> tuple of Schedules (list of Model.Schedules), Routes (dictionary by ID,
+    models.Route), and Predictions (dictionary by ID, models.Prediction). Every requested station is present,
+    with empty results if it has no service in the window.
+    """
+    station_names = list(station_names)
+    stops = ",".join(station_names)
+    include = 'prediction,trip,route,stop' if predictions else 'route,stop'
+    document = get_schedule_document(min_time, stops, max_time=max_time, include=include)
+    schedule, routes, predictions = parse_schedule_document(document)
+    parents = parse_parent_stations(document.get('included', ()))
+
+    results = {station: ([], {}, {}) for station in station_names}
+    for entry in schedule:  # already in chronological order, so each station's list stays sorted
+        station = entry.stop_id if entry.stop_id in results else parents.get(entry.stop_id)
+        if station not in results:
+            continue
+        station_schedule, station_routes, station_predictions = results[station]
+        station_schedule.append(entry)
+        station_routes[entry.route.id] = entry.route
+        if entry.prediction:
+            station_predictions[entry.prediction.id] = entry.prediction
+    logger.debug(f"Split {len(schedule)} schedules across {len(results)} stations")
+    return results
@@ -0,0 +1,173 @@
+from django.conf import settings
+import logging
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+from . import models
+
+"""
+This file contains a snapshot store shared by every worker process on a machine, without an external cache service.
+A single refresher (`python manage.py publishsnapshots`) writes each station's latest snapshot to its own file, and
+the workers read those files through a memory map instead of calling the MBTA API and parsing its responses themselves,
+so the number of upstream calls and the parsing work stay the same however many workers are running.
+
+Each file holds a fixed-size header (see HEADER) followed by the pickled models.StationSnapshot. Files are replaced
+atomically, so readers see either the previous snapshot or the new one, never a partial write. A worker only
+unpickles a station again when its content version changes; until then it keeps serving the objects it already has,
+along with the pages rendered from them.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Identifies snapshot files, and the version of their layout
+MAGIC = b'SBSNAP01'
+
+# magic, sequence number (incremented on every write), time written (seconds since the epoch), content version
+# (see models.StationSnapshot.get_version)
+HEADER = struct.Struct('<8sQd16s')
+
+
+class SharedSnapshotStore:
+    """
+    The snapshot files of every station, in a single directory.
+    """
+
+    def __init__(self, directory, max_age=None):
+        """
+        Creates a new store
+        :param directory: where the snapshot files are kept; it is created if it does not exist. Snapshots are
+        pickled, so it must only be writable by the site itself.
+        :param max_age: snapshots written more than max_age seconds ago are ignored, or None to never ignore them
+        """
+        self.directory = directory
+        self.max_age = max_age
+        self._loaded = {}  # station -> (file identity, header, models.StationSnapshot)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, station):
+        """
+        :return: the snapshot file of station
+        :raises ValueError: if the station key could name a file outside the directory. Snapshot files are unpickled,
+        so a key must never lead anywhere else.
+        """
+        if not station or os.sep in station or (os.altsep and os.altsep in station) or '..' in station \
+                or os.path.isabs(station):
+            raise ValueError(f"{station!r} is not a valid station key")
+        return os.path.join(self.directory, f"{station}.snapshot")
+
+    def write(self, snapshot):
+        """
+        Writes a snapshot, replacing the station's previous one in a single atomic rename.
+        :param snapshot: a models.StationSnapshot
+        :return: the sequence number of the new file
+        """
+        header = self.read_header(snapshot.station)
+        sequence = header[1] + 1 if header else 1
+        payload = pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+        fd, temp_name = tempfile.mkstemp(dir=self.directory, prefix=f".{snapshot.station}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, sequence, time.time(), snapshot.get_version().encode()))
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_name, self.get_path(snapshot.station))
+        except BaseException:
+            os.unlink(temp_name)
+            raise
+        logger.debug(f"Wrote {snapshot} ({len(payload)} bytes) as sequence {sequence}")
+        return sequence
+
+    def read_header(self, station):
+        """
+        :param station: the station key
+        :return: the header of the station's snapshot file as (magic, sequence, written_at, version), or None if there
+        is no valid file
+        """
+        try:
+            with open(self.get_path(station), 'rb') as f:
+                header = f.read(HEADER.size)
+        except FileNotFoundError:
+            return None
+        if len(header) < HEADER.size or not header.startswith(MAGIC):
+            return None
+        return HEADER.unpack(header)
+
+    def read(self, station):
+        """
+        :param station: the station key
+        :return: the station's latest models.StationSnapshot, or None if none was written, or it is older than max_age
+        """
+        path = self.get_path(station)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            loaded = self._loaded.get(station)
+            if not loaded or loaded[0] != identity:
+                loaded = self._load(station, path, loaded)
+                if loaded is None:
+                    return None
+                self._loaded[station] = loaded
+        written_at, snapshot = loaded[1][2], loaded[2]
+        if self.max_age is not None and time.time() - written_at > self.max_age:
+            logger.info(f"The shared snapshot of {station} is {time.time() - written_at:.0f} seconds old, ignoring")
+            return None
+        return snapshot
+
+    def _load(self, station, path, previous):
+        """
+        Maps a snapshot file and unpickles it, unless it holds the same content version as previous.
+        :return: a (file identity, header, models.StationSnapshot) tuple, or None if the file is not a valid snapshot
+        """
+        try:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                stat = os.fstat(f.fileno())
+                identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+                if len(mapped) < HEADER.size or mapped[:len(MAGIC)] != MAGIC:
+                    logger.warning(f"{path} is not a snapshot file, ignoring it")
+                    return None
+                header = HEADER.unpack_from(mapped)
+                if previous and previous[1][3] == header[3]:
+                    return identity, header, previous[2]  # same content, keep the objects (and rendered pages)
+                with memoryview(mapped) as view, view[HEADER.size:] as payload:
+                    snapshot = pickle.loads(payload)
+        except FileNotFoundError:
+            return None
+        except (ValueError, EOFError, pickle.UnpicklingError) as e:
+            logger.warning(f"Could not load the shared snapshot of {station}, ignoring it: {e}")
+            return None
+        logger.debug(f"Loaded {snapshot} as sequence {header[1]}")
+        return identity, header, snapshot
+
+
+def create_store():
+    """
+    :return: a SharedSnapshotStore in SCHEDULEBOARD_SHARED_DIR, or None if it is not set
+    """
+    directory = getattr(settings, 'SCHEDULEBOARD_SHARED_DIR', None)
+    if not directory:
+        return None
+    return SharedSnapshotStore(directory, max_age=getattr(settings, 'SCHEDULEBOARD_SHARED_MAX_AGE', 120))
+
+
+# The process-wide store the views read from, or None when SCHEDULEBOARD_SHARED_DIR is not set.
+snapshots = create_store()
+
+
+def get_snapshot(station):
+    """
+    :param station: the station key
+    :return: the station's latest shared snapshot, or None if the shared store is not used, has no fresh snapshot, or
+    station is not one of models.STATION_CHOICES
+    """
+    if snapshots is None or not models.is_known_station(station):
+        return None
+    return snapshots.read(station)
@@ -0,0 +1,123 @@
+from django.db import transaction
+import logging
+from .models import (Schedule, Prediction, Route, StationSnapshot, RouteRecord, PredictionRecord,
+                     ScheduleRecord)
+
+"""
+This file contains the database-backed schedule store. Snapshots fetched from the MBTA API are written with bulk
+upserts (see save_snapshot), and a station's time window is read back with a single indexed query (see
+load_snapshot), so every worker can serve the board from one ingested copy of the data.
+"""
+
+logger = logging.getLogger(__name__)
+
+# The number of rows per INSERT/UPDATE statement, and per `pk IN (...)` lookup. Kept well below SQLite's limit on
+# query parameters.
+BATCH_SIZE = 500
+
+ROUTE_FIELDS = ['color', 'text_color', 'short_name', 'long_name', 'dir_destinations', 'dir_names', 'route_type']
+PREDICTION_FIELDS = ['arrival_time', 'departure_time', 'direction_id', 'status']
+SCHEDULE_FIELDS = ['station', 'stop_id', 'trip_id', 'route', 'prediction', 'direction_id', 'arrival_time',
+                   'departure_time', 'scheduled_time', 'ingested_at']
+
+
+def bulk_upsert(model, records, fields):
+    """
+    Inserts the records that are not in the database yet and updates the ones that are, using one query per
+    BATCH_SIZE records for each step rather than one query per record. Must be called inside a transaction.
+    :param model: the Django model class
+    :param records: a list of unsaved model instances, with their primary keys set
+    :param fields: the names of the fields to overwrite on existing rows
+    :return: a tuple of the number of records created and updated
+    """
+    ids = [record.pk for record in records]
+    existing = set()
+    for start in range(0, len(ids), BATCH_SIZE):
+        existing.update(model.objects.filter(pk__in=ids[start:start + BATCH_SIZE]).values_list('pk', flat=True))
+    created = [record for record in records if record.pk not in existing]
+    updated = [record for record in records if record.pk in existing]
+    model.objects.bulk_create(created, batch_size=BATCH_SIZE)
+    model.objects.bulk_update(updated, fields, batch_size=BATCH_SIZE)
+    return len(created), len(updated)
+
+
+def save_snapshot(snapshot):
+    """
+    Writes a snapshot's schedules, and the routes and predictions they use, to the database in a single transaction.
+    Rows that are already stored are updated in place. Every row is marked as ingested at the snapshot's fetched_at.
+    :param snapshot: a models.StationSnapshot
+    :return: the number of schedules written
+    """
+    routes = {s.route.id: s.route for s in snapshot.schedule}
+    predictions = {s.prediction.id: s.prediction for s in snapshot.schedule if s.prediction}
+    route_records = [RouteRecord(id=r.id, color=r.color, text_color=r.text_color, short_name=r.short_name or "",
+                                 long_name=r.long_name or "", dir_destinations=r.dir_destinations,
+                                 dir_names=r.dir_names, route_type=r.route_type) for r in routes.values()]
+    prediction_records = [PredictionRecord(id=p.id, arrival_time=p.arrival_time, departure_time=p.departure_time,
+                                           direction_id=p.direction_id, status=p.status)
+                          for p in predictions.values()]
+    schedule_records = [ScheduleRecord(id=s.id, station=snapshot.station, stop_id=s.stop_id, trip_id=s.trip_id,
+                                       route_id=s.route.id, prediction_id=s.prediction.id if s.prediction else None,
+                                       direction_id=s.direction_id, arrival_time=s.arrival_time,
+                                       departure_time=s.departure_time, scheduled_time=s.get_scheduled_time(),
+                                       ingested_at=snapshot.fetched_at)
+                        for s in snapshot.schedule]
+
+    with transaction.atomic():
+        bulk_upsert(RouteRecord, route_records, ROUTE_FIELDS)
+        bulk_upsert(PredictionRecord, prediction_records, PREDICTION_FIELDS)
+        created, updated = bulk_upsert(ScheduleRecord, schedule_records, SCHEDULE_FIELDS)
+    logger.debug(f"Stored {snapshot.station}: {created} new and {updated} updated schedules")
+    return len(schedule_records)
+
+
+def load_snapshot(station, start, end, route_types=None):
+    """
+    Reads a station's schedules in [start, end) back from the database. Routes and predictions are joined in, so this
+    is a single query on the (station, scheduled_time) index.
+    :param station: the station key, taken from models.STATION_CHOICES
+    :param start: a timezone aware datetime
+    :param end: a timezone aware datetime
+    :param route_types: an iterable of route types to include, or None for every route type
+    :return: a models.StationSnapshot, in chronological order, with fetched_at set to when its oldest row was
+    ingested (or None if it has no rows), so a board is labeled with its age when `manage.py ingest` stops
+    """
+    query = (ScheduleRecord.objects.select_related('route', 'prediction')
+             .filter(station=station, scheduled_time__gte=start, scheduled_time__lt=end)
+             .order_by('scheduled_time', 'id'))
+    if route_types:
+        query = query.filter(route__route_type__in=list(route_types))
+
+    schedule, routes, predictions, fetched_at = [], {}, {}, None
+    for record in query:
+        if record.ingested_at and (fetched_at is None or record.ingested_at < fetched_at):
+            fetched_at = record.ingested_at
+        route = routes.get(record.route_id)
+        if route is None:
+            r = record.route
+            route = routes[r.id] = Route(r.id, r.color, r.text_color, r.short_name, r.long_name, r.dir_destinations,
+                                         r.dir_names, r.route_type)
+        prediction = None
+        if record.prediction_id:
+            p = record.prediction
+            prediction = predictions[p.id] = Prediction(p.id, p.arrival_time, p.departure_time, p.direction_id,
+                                                        p.status)
+        schedule.append(Schedule(record.id, record.arrival_time, record.departure_time, record.direction_id, route,
+                                 record.trip_id, record.stop_id, prediction))
+    logger.debug(f"Loaded {len(schedule)} stored schedules for {station}")
+    return StationSnapshot(station, schedule, routes, predictions, fetched_at)
+
+
+def delete_before(time):
+    """
+    Removes schedules (and the predictions they used) scheduled before time, e.g. yesterday's service.
+    :param time: a timezone aware datetime
+    :return: the number of schedules removed
+    """
+    with transaction.atomic():
+        old = ScheduleRecord.objects.filter(scheduled_time__lt=time)
+        prediction_ids = list(old.exclude(prediction=None).values_list('prediction_id', flat=True))
+        count, _ = old.delete()
+        for start in range(0, len(prediction_ids), BATCH_SIZE):
+            PredictionRecord.objects.filter(pk__in=prediction_ids[start:start + BATCH_SIZE]).delete()
+    return count
@@ -0,0 +1,331 @@
+from django.conf import settings
+from datetime import timedelta
+import logging
+import random
+import threading
+import requests
+from . import mbta, models, services
+
+"""
+This file contains a consumer for the MBTA streaming API (see https://www.mbta.com/developers/v3-api/streaming).
+Instead of polling for the whole schedule window, we keep a server-sent event stream open and apply its reset, add,
+update and remove events to an in-memory index of Schedule, Prediction and Route objects.
+
+When SCHEDULEBOARD_STREAMING is set, every station of models.STATION_CHOICES gets a StationStream when the app starts,
+and services.get_cached_station_snapshot builds the station's snapshots from it instead of calling the MBTA API.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def parse_events(lines):
+    """
+    Parses server-sent events from an iterable of lines (without line endings).
+    See https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation
+    :param lines: an iterable of strings, e.g. from requests.Response.iter_lines(decode_unicode=True)
+    :return: a generator of (event, data) tuples, where data is the event's (possibly multi-line) data string
+    """
+    event = "message"
+    data = []
+    for line in lines:
+        if not line:
+            if data:
+                yield event, "\n".join(data)
+            event = "message"
+            data = []
+        elif line.startswith(":"):
+            continue  # a comment, the MBTA API sends these as keep-alives
+        else:
+            field, _, value = line.partition(":")
+            if value.startswith(" "):
+                value = value[1:]
+            if field == "event":
+                event = value
+            elif field == "data":
+                data.append(value)
+
+
+class _Lookup(dict):
+    """
+    A dictionary that returns None for unknown ids, since stream events may refer to resources we have not seen yet.
+    """
+
+    def __missing__(self, key):
+        return None
+
+
+class StreamingIndex:
+    """
+    An in-memory index of the resources received from a stream, keyed by id. Predictions are attached to schedules
+    by (trip id, stop id), so they can arrive in either order and from either the schedules or the predictions stream.
+    """
+
+    def __init__(self):
+        self.schedules = {}  # schedule_id -> models.Schedule
+        self.predictions = _Lookup()  # prediction_id -> models.Prediction
+        self.routes = _Lookup()  # route_id -> models.Route
+        self._schedule_keys = {}  # (trip_id, stop_id) -> schedule_id
+        self._prediction_keys = {}  # (trip_id, stop_id) -> prediction_id
+        self._schedule_routes = {}  # schedule_id -> route_id, so routes that arrive late can still be attached
+        self._sorted = None
+        self.version = 0  # incremented by every event applied
+        self._lock = threading.Lock()
+
+    def apply(self, event, data):
+        """
+        Applies a single stream event to the index
+        :param event: one of "reset", "add", "update" or "remove"
+        :param data: the decoded JSON data of the event: a list of resources for "reset", otherwise a single resource
+        """
+        with self._lock:
+            if event == "reset":
+                self._clear()
+                for resource in data:
+                    self._upsert(resource)
+            elif event in ("add", "update"):
+                self._upsert(data)
+            elif event == "remove":
+                self._remove(data)
+            else:
+                logger.debug(f"Ignoring unknown event {event}")
+                return
+            self._sorted = None
+            self.version += 1
+
+    def get_schedule(self):
+        """
+        :return: a list of the indexed models.Schedule objects whose route is known, in chronological order
+        """
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = sorted((s for s in self.schedules.values() if s.route),
+                                      key=lambda x: x.get_scheduled_time())
+            return self._sorted
+
+    def get_predictions(self):
+        """
+        :return: a dictionary of (trip_id, stop_id) -> models.Prediction of the indexed predictions, see
+        services.parse_predictions
+        """
+        with self._lock:
+            return {key: self.predictions[pid] for key, pid in self._prediction_keys.items()}
+
+    def _clear(self):
+        self.schedules.clear()
+        self.predictions.clear()
+        self.routes.clear()
+        self._schedule_keys.clear()
+        self._prediction_keys.clear()
+        self._schedule_routes.clear()
+
+    @staticmethod
+    def _trip_stop(resource):
+        relationships = resource["relationships"]
+        return relationships["trip"]["data"]["id"], relationships["stop"]["data"]["id"]
+
+    def _upsert(self, resource):
+        kind = resource["type"]
+        if kind == "route":
+            route = services.create_route(resource)
+            self.routes[route.id] = route
+            for schedule_id, route_id in self._schedule_routes.items():
+                if route_id == route.id:
+                    self.schedules[schedule_id].route = route
+        elif kind == "prediction":
+            prediction = services.create_prediction(resource)
+            self.predictions[prediction.id] = prediction
+            key = self._trip_stop(resource)
+            self._prediction_keys[key] = prediction.id
+            schedule_id = self._schedule_keys.get(key)
+            if schedule_id:
+                self.schedules[schedule_id].prediction = prediction
+        elif kind == "schedule":
+            schedule = services.create_schedule_entry(resource, self.routes, self.predictions)
+            key = (schedule.trip_id, schedule.stop_id)
+            if not schedule.prediction and key in self._prediction_keys:
+                schedule.prediction = self.predictions[self._prediction_keys[key]]
+            self.schedules[schedule.id] = schedule
+            self._schedule_keys[key] = schedule.id
+            self._schedule_routes[schedule.id] = resource["relationships"]["route"]["data"]["id"]
+
+    def _remove(self, resource):
+        kind = resource["type"]
+        if kind == "schedule":
+            schedule = self.schedules.pop(resource["id"], None)
+            if schedule:
+                del self._schedule_routes[schedule.id]
+                self._schedule_keys.pop((schedule.trip_id, schedule.stop_id), None)
+        elif kind == "prediction":
+            prediction = self.predictions.pop(resource["id"], None)
+            if prediction:
+                for key, pid in list(self._prediction_keys.items()):
+                    if pid == prediction.id:
+                        del self._prediction_keys[key]
+                        schedule_id = self._schedule_keys.get(key)
+                        if schedule_id:
+                            self.schedules[schedule_id].prediction = None
+        elif kind == "route":
+            self.routes.pop(resource["id"], None)
+
+
+class StreamingClient(threading.Thread):
+    """
+    A daemon thread that keeps a stream open and applies its events to a StreamingIndex, reconnecting with
+    exponential backoff (and full jitter) when the stream fails or ends.
+    """
+
+    def __init__(self, url, params, index, session=None, backoff=1, max_backoff=60, read_timeout=60):
+        """
+        Creates a new streaming client. The client does nothing until start() is called.
+        :param url: the stream URL, e.g. https://api-v3.mbta.com/predictions
+        :param params: a dictionary of query parameters, e.g. {'filter[stop]': 'place-sstat', 'include': 'route'}
+        :param index: the StreamingIndex to apply events to
+        :param session: the requests.Session to use; a new session is created if none is given
+        :param backoff: the initial reconnect delay in seconds
+        :param max_backoff: the largest reconnect delay in seconds
+        :param read_timeout: how long to wait for data (including keep-alives) before treating the stream as dead
+        """
+        super().__init__(name="scheduleboard-stream", daemon=True)
+        self.url = url
+        self.params = params
+        self.index = index
+        self.session = session or requests.Session()
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.read_timeout = read_timeout
+        self.connections = 0
+        self._delay = backoff
+        self._response = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.consume()
+                logger.info(f"Stream {self.url} ended")
+            except (requests.RequestException, ValueError) as e:
+                if self._stopped.is_set():
+                    break
+                logger.warning(f"Stream {self.url} failed: {e}")
+            wait = random.uniform(0, self._delay)
+            self._delay = min(self._delay * 2, self.max_backoff)
+            logger.debug(f"Reconnecting to {self.url} in {wait:.1f} seconds")
+            self._stopped.wait(wait)
+
+    def stop(self):
+        """
+        Stops the client, closing the current stream if one is open.
+        """
+        self._stopped.set()
+        response = self._response
+        if response is not None:
+            response.close()
+
+    def consume(self):
+        """
+        Opens the stream once and applies its events until the stream ends or fails.
+        """
+        headers = {'Accept': 'text/event-stream'}
+        with self.session.get(self.url, params=self.params, headers=headers, stream=True,
+                              timeout=(10, self.read_timeout)) as response:
+            response.raise_for_status()
+            self._response = response
+            self.connections += 1
+            try:
+                for event, data in parse_events(response.iter_lines(decode_unicode=True)):
+                    self.index.apply(event, mbta.loads(data))
+                    if event == "reset":
+                        self._delay = self.backoff  # we are healthy again, so start over with short delays
+            finally:
+                self._response = None
+
+
+class StationStream:
+    """
+    The streams of a single station: its schedules (with their routes) and its predictions. Each stream has its own
+    index, since a reset only replaces the resources of the stream it came from; predictions are merged onto the
+    schedules by trip and stop when a snapshot is built.
+    """
+
+    def __init__(self, station, base_url="https://api-v3.mbta.com", api_key=None, hours=6, **client_options):
+        """
+        Creates the streams of a station. Nothing is streamed until start() is called.
+        :param station: the station key
+        :param base_url: the root of the MBTA API
+        :param api_key: the MBTA API key, which the streaming API requires
+        :param hours: the length of the window of schedules in the snapshots
+        :param client_options: passed on to both StreamingClients, e.g. backoff
+        """
+        self.station = station
+        self.length = timedelta(hours=hours)
+        self.schedules = StreamingIndex()
+        self.predictions = StreamingIndex()
+        params = {'filter[stop]': station}
+        if api_key:
+            params['api_key'] = api_key
+        self.clients = [
+            StreamingClient(f"{base_url}/schedules", dict(params, include='route'), self.schedules, **client_options),
+            StreamingClient(f"{base_url}/predictions", params, self.predictions, **client_options),
+        ]
+
+    def start(self):
+        for client in self.clients:
+            client.start()
+        return self
+
+    def stop(self):
+        for client in self.clients:
+            client.stop()
+
+    def is_ready(self):
+        """
+        :return: True once both streams have sent their first events
+        """
+        return self.schedules.version > 0 and self.predictions.version > 0
+
+    def get_version(self):
+        """
+        :return: a value that changes whenever either stream applies an event
+        """
+        return self.schedules.version, self.predictions.version
+
+    def get_snapshot(self, min_time):
+        """
+        Builds a snapshot from what the streams have sent so far, without calling the MBTA API.
+        :param min_time: the (timezone aware) start of the window
+        :return: a models.StationSnapshot of the schedules in the window, with their latest predictions
+        """
+        end = min_time + self.length
+        schedule = [s for s in self.schedules.get_schedule() if s.get_scheduled_time() < end]
+        routes = {s.route.id: s.route for s in schedule}
+        skeleton = models.StationSnapshot(self.station, schedule, routes, {}, min_time)
+        return services.merge_predictions(skeleton, self.predictions.get_predictions(), min_time)
+
+
+# The process-wide streams, by station, when SCHEDULEBOARD_STREAMING is set.
+streams = {}
+
+
+def start_streams():
+    """
+    Starts streaming every station in models.STATION_CHOICES, if they are not already streaming.
+    :return: the dictionary of station -> StationStream
+    """
+    api_key = getattr(settings, 'MBTA_API_KEY', None)
+    if not api_key:
+        logger.warning("The MBTA streaming API requires MBTA_API_KEY, streams will keep failing without one")
+    for station, name in models.STATION_CHOICES:
+        if station not in streams:
+            streams[station] = StationStream(station, base_url=mbta.client.base_url, api_key=api_key).start()
+    return streams
+
+
+def get_stream(station):
+    """
+    :param station: the station key
+    :return: the station's StationStream, or None if it is not streamed or has not received its first events yet
+    """
+    stream = streams.get(station)
+    if stream is None or not stream.is_ready():
+        return None
+    return stream
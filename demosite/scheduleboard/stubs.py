@@ -0,0 +1,136 @@
+from django.utils import timezone
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+import time
+
+"""
+This file contains a local stand-in for the MBTA API, used by the tests and benchmarks so they do not depend on the
+real API (or on the network).
+"""
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    """
+    Answers each request with the next (status, headers, body, delay) tuple from server.responses (the last one is
+    repeated), and records its path and headers in server.requests.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append((self.path, dict(self.headers)))
+            if len(self.server.responses) > 1:
+                status, headers, body, delay = self.server.responses.pop(0)
+            else:
+                status, headers, body, delay = self.server.responses[0]
+        if isinstance(delay, threading.Event):
+            delay.wait(10)
+        else:
+            time.sleep(delay)
+        body = json.dumps(body).encode() if body is not None else b""
+        try:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client gave up waiting, e.g. because of a timeout
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubUpstream(ThreadingHTTPServer):
+    """
+    A stand-in for the MBTA API, listening on a free local port.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, responses):
+        """
+        Creates a new stand-in; call start() to begin serving.
+        :param responses: a list of (status, headers, body, delay) tuples: the status code, a dictionary of response
+        headers, a JSON-serializable body (or None for an empty one), and a delay in seconds before answering, or a
+        threading.Event to wait for before answering (for at most 10 seconds)
+        """
+        super().__init__(("127.0.0.1", 0), UpstreamHandler)
+        self.responses = list(responses)
+        self.requests = []
+        self.lock = threading.Lock()
+        self.url = f"http://127.0.0.1:{self.server_port}"
+
+    def start(self):
+        """
+        Starts serving in a daemon thread.
+        :return: this server
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        """
+        Stops serving and closes the listening socket.
+        """
+        self.shutdown()
+        self.server_close()
+
+
+# The routes schedule_document spreads its rows over: (route id, route type, short name, long name, destinations)
+SAMPLE_ROUTES = (
+    ("Red", 1, "", "Red Line", ["Ashmont/Braintree", "Alewife"]),
+    ("Orange", 1, "", "Orange Line", ["Forest Hills", "Oak Grove"]),
+    ("CR-Fairmount", 2, "", "Fairmount Line", ["Readville", "South Station"]),
+    ("CR-Worcester", 2, "", "Framingham/Worcester Line", ["Worcester", "South Station"]),
+    ("SL4", 3, "SL4", "Dudley Station - South Station", ["Dudley Station", "South Station"]),
+    ("7", 3, "7", "City Point - Otis Street", ["City Point", "Otis Street"]),
+)
+
+
+def schedule_document(min_time, rows, hours=6, stop="70079", seed=0):
+    """
+    Creates a /schedules?include=prediction,trip,route response in the MBTA API's format, for tests and benchmarks.
+    :param min_time: a timezone aware datetime, the start of the window the schedules are spread over
+    :param rows: the number of schedules
+    :param hours: the length of the window
+    :param stop: the stop id of every schedule
+    :param seed: the seed of the random times, routes and predictions, so documents are reproducible
+    :return: the JSON-serializable document
+    """
+    rng = random.Random(seed)
+    start = timezone.localtime(min_time).replace(second=0, microsecond=0)
+    data, trips, predictions = [], [], []
+    for i in range(rows):
+        rid, route_type, short_name, long_name, destinations = SAMPLE_ROUTES[i % len(SAMPLE_ROUTES)]
+        direction_id = rng.randrange(2)
+        time = (start + timedelta(minutes=rng.randrange(hours * 60))).isoformat()
+        trip = f"trip-{i}"
+        prediction = None
+        if rng.random() < 0.3:
+            prediction = f"prediction-{trip}-{stop}"
+            predicted = (start + timedelta(minutes=rng.randrange(hours * 60))).isoformat()
+            predictions.append({"type": "prediction", "id": prediction,
+                                "attributes": {"arrival_time": predicted, "departure_time": predicted,
+                                               "direction_id": direction_id, "status": rng.choice((None, "Delayed"))},
+                                "relationships": {"trip": {"data": {"type": "trip", "id": trip}},
+                                                  "stop": {"data": {"type": "stop", "id": stop}}}})
+        data.append({"type": "schedule", "id": f"schedule-{trip}-{stop}-1",
+                     "attributes": {"arrival_time": time, "departure_time": time, "direction_id": direction_id},
+                     "relationships": {"route": {"data": {"type": "route", "id": rid}},
+                                       "trip": {"data": {"type": "trip", "id": trip}},
+                                       "stop": {"data": {"type": "stop", "id": stop}},
+                                       "prediction": {"data": {"type": "prediction", "id": prediction}
+                                                      if prediction else None}}})
+        trips.append({"type": "trip", "id": trip,
+                      "attributes": {"headsign": destinations[direction_id], "direction_id": direction_id}})
+    routes = [{"type": "route", "id": rid,
+               "attributes": {"color": "DA291C", "text_color": "FFFFFF", "short_name": short_name,
+                              "long_name": long_name, "direction_destinations": destinations,
+                              "direction_names": ["Outbound", "Inbound"], "type": route_type}}
+              for rid, route_type, short_name, long_name, destinations in SAMPLE_ROUTES]
+    return {"data": data, "included": routes + trips + predictions}
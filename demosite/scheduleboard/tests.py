@@ -1,21 +1,107 @@
-from django.test import TestCase
+from asgiref.sync import async_to_sync
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+from unittest import mock, skipUnless
 from django.utils import timezone
-from . import services
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
+import contextlib
+import io
+import json
+import os
+import re
+import requests
+import tempfile
+import threading
+import time
+import zipfile
+from . import (breaker, cache, columnar, deltas, display, gtfs, mbta, metrics, models, poller, push, ratelimit,
+               replay, services, shared, store, streaming, stubs, timestamps, views, window)
 # Create your tests here.
 
+
+def route_json(rid="Red", route_type=1):
+    """
+    :return: a route resource, as returned by the MBTA API
+    """
+    return {"type": "route", "id": rid,
+            "attributes": {"color": "DA291C", "text_color": "FFFFFF", "short_name": "", "long_name": f"{rid} Line",
+                           "direction_destinations": ["Ashmont/Braintree", "Alewife"],
+                           "direction_names": ["South", "North"], "type": route_type}}
+
+
+def schedule_json(sid, time, trip, rid="Red", stop="70079", prediction=None):
+    """
+    :return: a schedule resource, as returned by the MBTA API with include=prediction
+    """
+    return {"type": "schedule", "id": sid,
+            "attributes": {"arrival_time": time, "departure_time": time, "direction_id": 0},
+            "relationships": {"route": {"data": {"type": "route", "id": rid}},
+                              "trip": {"data": {"type": "trip", "id": trip}},
+                              "stop": {"data": {"type": "stop", "id": stop}},
+                              "prediction": {"data": {"type": "prediction", "id": prediction} if prediction else None}}}
+
+
+def stop_json(sid, parent=None):
+    """
+    :return: a stop resource, as returned by the MBTA API
+    """
+    return {"type": "stop", "id": sid, "attributes": {},
+            "relationships": {"parent_station": {"data": {"type": "stop", "id": parent} if parent else None}}}
+
+
+def use_upstream(test, server):
+    """
+    Points services at a local stand-in for the MBTA API for the rest of the test.
+    :param test: the running TestCase
+    :param server: a server started with start_upstream
+    """
+    test.addCleanup(setattr, mbta, "client", mbta.client)
+    test.addCleanup(setattr, mbta, "async_client", mbta.async_client)
+    test.addCleanup(services.schedule_cache.clear)
+    test.addCleanup(services.schedule_windows.clear)
+    test.addCleanup(services.last_good.clear)
+    mbta.client = mbta.MBTAClient(base_url=server.url, backoff=0.01)
+    if mbta.httpx:
+        mbta.async_client = mbta.AsyncMBTAClient(base_url=server.url, backoff=0.01)
+
+
+def prediction_json(pid, time, trip, stop="70079", status=None):
+    """
+    :return: a prediction resource, as returned by the MBTA API
+    """
+    return {"type": "prediction", "id": pid,
+            "attributes": {"arrival_time": time, "departure_time": time, "direction_id": 0, "status": status},
+            "relationships": {"trip": {"data": {"type": "trip", "id": trip}},
+                              "stop": {"data": {"type": "stop", "id": stop}}}}
+
+
 class ServicesTests(TestCase):
     """
-    Some simple Django tests to ensure that our services work at various times.
+    Some simple Django tests to ensure that our services work at various times. The MBTA API is replayed from
+    fixtures, so these run offline.
     """
+    def replay(self, min_time):
+        """
+        Points services at a replay of a typical /schedules response for the six hours starting at min_time.
+        """
+        fixture = replay.make_fixture("schedules", services.schedule_payload(min_time, "place-sstat"),
+                                      stubs.schedule_document(min_time, 300))
+        self.addCleanup(setattr, mbta, "client", mbta.client)
+        mbta.client = replay.replay_client([fixture])
+
     def test_at_time_now(self):
         """
         A general test to see if the service works at time now
         :return:
         """
         min_time = timezone.localtime()
-        schedules, routes, predictions = services.get_schedules_routes_and_predictions(min_time)
+        self.replay(min_time)
+        schedules, routes, predictions = services.get_schedules_routes_and_predictions(min_time, "place-sstat")
         #the last schedule in the list should occur after the first schedule
         self.assertGreaterEqual(schedules[-1].get_scheduled_time(), schedules[0].get_scheduled_time())
+        self.assertEqual(len(schedules), 300)
 
     def test_at_midnight(self):
         """
@@ -24,7 +110,8 @@ class ServicesTests(TestCase):
         """
         min_time = timezone.localtime()
         min_time = min_time.replace(hour=0, minute=0, second=0)
-        schedules, routes, predictions = services.get_schedules_routes_and_predictions(min_time)
+        self.replay(min_time)
+        schedules, routes, predictions = services.get_schedules_routes_and_predictions(min_time, "place-sstat")
         # the last schedule in the list should occur after the first schedule
         self.assertGreaterEqual(schedules[-1].get_scheduled_time(), schedules[0].get_scheduled_time())
 
@@ -36,6 +123,1432 @@ class ServicesTests(TestCase):
         """
         min_time = timezone.localtime()
         min_time = min_time.replace(hour=22, minute=0, second=0)
-        schedules, routes, predictions = services.get_schedules_routes_and_predictions(min_time)
+        self.replay(min_time)
+        schedules, routes, predictions = services.get_schedules_routes_and_predictions(min_time, "place-sstat")
         # the last schedule in the list should occur after the first schedule
-        self.assertGreaterEqual(schedules[-1].get_scheduled_time(), schedules[0].get_scheduled_time())
\ No newline at end of file
+        self.assertGreaterEqual(schedules[-1].get_scheduled_time(), schedules[0].get_scheduled_time())
+        self.assertGreater(timezone.localtime(schedules[-1].get_scheduled_time()).date(), min_time.date())
+
+
+class ReplayTests(TestCase):
+    """
+    Tests for recording MBTA API responses to fixtures and replaying them.
+    """
+    def test_record_and_replay(self):
+        min_time = timestamps.parse_mbta_datetime("2020-04-20T14:00:00-04:00")
+        document = stubs.schedule_document(min_time, 20)
+        server = start_upstream(self, [(200, {"ETag": "abc", "X-Other": "1"}, document, 0)])
+        params = services.schedule_payload(min_time, "place-sstat")
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "typical.json")
+            replay.record(mbta.MBTAClient(base_url=server.url), "schedules", params, file_name)
+            fixture = replay.load_fixture(file_name)
+        self.assertEqual(fixture["headers"], {"ETag": "abc"})
+
+        client = replay.replay_client([fixture])
+        later = services.schedule_payload(timestamps.parse_mbta_datetime("2020-04-21T09:30:00-04:00"), "place-sstat")
+        self.assertEqual(client.get("schedules", later), document)
+        with self.assertRaises(requests.ConnectionError):
+            client.get("schedules", services.schedule_payload(min_time, "place-north"))
+        self.assertEqual(len(client.replay.requests), 2)
+        self.assertEqual(len(server.requests), 1)
+
+
+class CacheTests(TestCase):
+    """
+    Tests for the TTL cache that sits in front of the MBTA API.
+    """
+    def test_entries_expire(self):
+        now = [0]
+        c = cache.TTLCache(ttl=30, max_size=4, clock=lambda: now[0])
+        self.assertEqual(c.get_or_fetch("a", lambda: 1), 1)
+        self.assertEqual(c.get_or_fetch("a", lambda: 2), 1)
+        now[0] = 31
+        self.assertEqual(c.get_or_fetch("a", lambda: 2), 2)
+
+    def test_least_recently_used_is_evicted(self):
+        c = cache.TTLCache(ttl=30, max_size=2)
+        c.set("a", 1)
+        c.set("b", 2)
+        c.get_or_fetch("a", lambda: None)  # touch a, so b is the oldest
+        c.set("c", 3)
+        self.assertEqual(len(c), 2)
+        self.assertEqual(c.get_or_fetch("b", lambda: "refetched"), "refetched")
+
+    def test_concurrent_misses_share_one_fetch(self):
+        """
+        Many threads missing on the same key at once should only call fetch a single time.
+        """
+        c = cache.TTLCache(ttl=30, max_size=4)
+        calls = []
+        release = threading.Event()
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return "schedule"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(c.get_or_fetch("key", fetch))) for i in range(10)]
+        for t in threads:
+            t.start()
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["schedule"] * 10)
+
+    def test_errors_are_not_cached(self):
+        c = cache.TTLCache(ttl=30, max_size=4)
+
+        def fail():
+            raise ValueError("upstream failed")
+
+        with self.assertRaises(ValueError):
+            c.get_or_fetch("a", fail)
+        self.assertEqual(c.get_or_fetch("a", lambda: 1), 1)
+
+    def test_waiters_see_an_interrupted_fetch(self):
+        c = cache.TTLCache(ttl=30, max_size=4)
+        started, waiting = threading.Event(), threading.Event()
+        c._count = lambda hit: hit and waiting.set()  # a miss that waits on the fetch in flight counts as a hit
+
+        def interrupted():
+            started.set()
+            waiting.wait(5)
+            raise KeyboardInterrupt()
+
+        def leader():
+            try:
+                c.get_or_fetch("a", interrupted)
+            except KeyboardInterrupt:
+                pass
+
+        results = []
+
+        def waiter():
+            try:
+                results.append(c.get_or_fetch("a", lambda: "not called"))
+            except RuntimeError as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=leader), threading.Thread(target=waiter)]
+        threads[0].start()
+        started.wait(5)
+        threads[1].start()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0], RuntimeError)
+
+
+class PollerTests(TestCase):
+    """
+    Tests for the background snapshot poller. The poller thread is never started; refreshes are called directly.
+    """
+    def setUp(self):
+        self.route = models.Route("Red", "DA291C", "FFFFFF", "", "Red Line", ["Ashmont/Braintree", "Alewife"],
+                                  ["South", "North"], 1)
+        self.fetched = []
+        self.addCleanup(setattr, poller, "viewers", poller.viewers)
+        poller.viewers = ratelimit.ViewerTracker()
+
+    def fetch(self, min_time, stations):
+        self.fetched.append(stations)
+        if "place-broken" in stations:
+            raise ConnectionError("upstream is down")
+        schedule = [models.Schedule("s1", min_time, None, 0, self.route, "t1", "70079", None)]
+        return {station: (schedule, {"Red": self.route}, {}) for station in stations}
+
+    def test_refresh_all_stores_a_snapshot_per_station(self):
+        p = poller.SnapshotPoller(["place-sstat", "place-north"], 30, fetch=self.fetch)
+        self.assertIsNone(p.get_snapshot("place-sstat"))
+        p.refresh_all()
+        self.assertEqual(self.fetched, [["place-sstat", "place-north"]])  # one call for every station
+        self.assertEqual(len(p.get_snapshot("place-north").schedule), 1)
+
+    def test_failed_refresh_keeps_previous_snapshot(self):
+        p = poller.SnapshotPoller(["place-broken"], 30, fetch=self.fetch)
+        previous = models.StationSnapshot("place-broken", [], {}, {}, timezone.localtime())
+        p.snapshots["place-broken"] = previous
+        p.refresh_all()
+        self.assertIs(p.get_snapshot("place-broken"), previous)
+
+    def test_view_reads_the_latest_snapshot(self):
+        p = poller.SnapshotPoller(["place-sstat"], 30, fetch=self.fetch)
+        p.refresh_all()
+        self.addCleanup(setattr, poller, "poller", None)
+        poller.poller = p
+        response = self.client.get("/schedule/")
+        self.assertContains(response, "Ashmont/Braintree")
+        self.assertEqual(self.fetched, [["place-sstat"]])  # the view did not fetch on its own
+
+
+class SSEHandler(BaseHTTPRequestHandler):
+    """
+    A stand-in for the MBTA streaming API. Each connection is served the next script from server.scripts, a list of
+    (event, data) pairs, after which the connection is closed.
+    """
+    def do_GET(self):
+        self.server.connections += 1
+        script = self.server.scripts.pop(0) if self.server.scripts else []
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        self.wfile.write(b": keep-alive\n\n")
+        for event, data in script:
+            self.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+        self.wfile.flush()
+        if not self.server.scripts:
+            self.server.done.set()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StreamingTests(TestCase):
+    """
+    Tests for the streaming consumer, against a local stand-in for the MBTA streaming API.
+    """
+    def test_parse_events(self):
+        lines = [": keep-alive", "", "event: reset", "data: [1,", "data: 2]", "", "event: remove", "data: {}", ""]
+        self.assertEqual(list(streaming.parse_events(lines)), [("reset", "[1,\n2]"), ("remove", "{}")])
+
+    def test_index_applies_events_in_place(self):
+        index = streaming.StreamingIndex()
+        index.apply("reset", [schedule_json("s2", "2020-04-20T10:30:00-04:00", "t2"),
+                              schedule_json("s1", "2020-04-20T10:00:00-04:00", "t1"),
+                              route_json()])
+        self.assertEqual([s.id for s in index.get_schedule()], ["s1", "s2"])
+        self.assertEqual(index.get_schedule()[0].get_destination(), "Ashmont/Braintree")
+
+        index.apply("add", prediction_json("p1", "2020-04-20T10:04:00-04:00", "t1", status="Delayed"))
+        self.assertEqual(index.get_schedule()[0].get_status(), "Delayed")
+        index.apply("update", prediction_json("p1", "2020-04-20T10:06:00-04:00", "t1", status="Boarding"))
+        self.assertEqual(index.get_schedule()[0].get_status(), "Boarding")
+        index.apply("remove", {"type": "prediction", "id": "p1"})
+        self.assertIsNone(index.get_schedule()[0].prediction)
+
+        index.apply("remove", {"type": "schedule", "id": "s1"})
+        self.assertEqual([s.id for s in index.get_schedule()], ["s2"])
+
+    def test_prediction_before_schedule(self):
+        index = streaming.StreamingIndex()
+        index.apply("add", prediction_json("p1", "2020-04-20T10:04:00-04:00", "t1", status="Delayed"))
+        index.apply("add", route_json())
+        index.apply("add", schedule_json("s1", "2020-04-20T10:00:00-04:00", "t1"))
+        self.assertEqual(index.get_schedule()[0].get_status(), "Delayed")
+
+    def test_client_reconnects_after_stream_ends(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), SSEHandler)
+        server.connections = 0
+        server.done = threading.Event()
+        server.scripts = [
+            [("reset", [route_json(), schedule_json("s1", "2020-04-20T10:00:00-04:00", "t1")]),
+             ("add", schedule_json("s2", "2020-04-20T10:30:00-04:00", "t2"))],
+            [("reset", [route_json(), schedule_json("s3", "2020-04-20T11:00:00-04:00", "t3")])],
+        ]
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        index = streaming.StreamingIndex()
+        client = streaming.StreamingClient(f"http://127.0.0.1:{server.server_port}/schedules", {}, index,
+                                           backoff=0.01, max_backoff=0.05)
+        client.start()
+        self.assertTrue(server.done.wait(5))
+        for i in range(100):  # the last reset may still be in flight when the server finishes writing it
+            if [s.id for s in index.get_schedule()] == ["s3"]:
+                break
+            time.sleep(0.05)
+        client.stop()
+        client.join(5)
+        self.assertGreaterEqual(server.connections, 2)
+        self.assertEqual([s.id for s in index.get_schedule()], ["s3"])
+
+
+def start_upstream(test, responses):
+    """
+    Starts a local stand-in for the MBTA API that is shut down when the test finishes.
+    :param test: the running TestCase
+    :param responses: a list of (status, headers, body, delay) tuples, see stubs.StubUpstream
+    :return: the server
+    """
+    server = stubs.StubUpstream(responses).start()
+    test.addCleanup(server.stop)
+    return server
+
+
+class MBTAClientTests(TestCase):
+    """
+    Tests for the pooled MBTA API client, against a local stand-in for the MBTA API.
+    """
+    def test_retries_then_uses_conditional_get(self):
+        document = {"data": [], "included": []}
+        server = start_upstream(self, [
+            (503, {}, None, 0),
+            (200, {"Last-Modified": "Mon, 20 Apr 2020 14:00:00 GMT", "ETag": '"v1"'}, document, 0),
+            (304, {}, None, 0),
+        ])
+        client = mbta.MBTAClient(base_url=server.url, backoff=0.01)
+        self.assertEqual(client.get("schedules", {"filter[stop]": "place-sstat"}), document)
+        self.assertIs(client.get("schedules", {"filter[stop]": "place-sstat"}),
+                      client.get("schedules", {"filter[stop]": "place-sstat"}))
+        self.assertEqual(len(server.requests), 4)
+        path, headers = server.requests[-1]
+        self.assertEqual(headers["If-None-Match"], '"v1"')
+        self.assertEqual(headers["If-Modified-Since"], "Mon, 20 Apr 2020 14:00:00 GMT")
+
+    def test_gives_up_after_timeouts(self):
+        server = start_upstream(self, [(200, {}, {"data": []}, 0.5)])
+        client = mbta.MBTAClient(base_url=server.url, timeout=0.1, retries=1, backoff=0.01)
+        with self.assertRaises(mbta.requests.Timeout):
+            client.get("schedules")
+        self.assertEqual(len(server.requests), 2)
+
+
+class ParsingTests(TestCase):
+    """
+    Tests for turning a decoded /schedules response into models.
+    """
+    def test_parse_schedule_document(self):
+        document = mbta.loads(json.dumps({
+            "data": [schedule_json("s2", "2020-04-20T10:30:00-04:00", "t2"),
+                     schedule_json("s1", "2020-04-20T10:00:00-04:00", "t1", prediction="p1")],
+            "included": [route_json(), prediction_json("p1", "2020-04-20T10:04:00-04:00", "t1", status="Delayed"),
+                         {"type": "trip", "id": "t1", "attributes": {}}]}).encode())
+        schedule, routes, predictions = services.parse_schedule_document(document)
+        self.assertEqual([s.id for s in schedule], ["s1", "s2"])
+        self.assertIs(schedule[0].route, routes["Red"])
+        self.assertIs(schedule[0].prediction, predictions["p1"])
+        self.assertEqual(schedule[0].get_status(), "Delayed")
+        self.assertEqual(schedule[0].trip_id, "t1")
+
+
+class TimestampTests(TestCase):
+    """
+    Tests for the MBTA timestamp parser, which must agree with the strptime based parser it replaces.
+    """
+    def test_matches_strptime(self):
+        for value in ["2020-04-20T23:59:59-04:00", "2020-11-01T01:30:00-05:00", "2020-04-21T00:05:00+00:00",
+                      "2020-04-20T23:59:59-0400"]:
+            expected = datetime.strptime(timestamps.fix_UTC_offset(value), timestamps.mbta_datetime_format)
+            parsed = timestamps.parse_mbta_datetime(value)
+            self.assertEqual(parsed, expected)
+            self.assertEqual(parsed.utcoffset(), expected.utcoffset())
+
+    def test_results_are_memoized(self):
+        value = "2020-04-20T10:00:00-04:00"
+        self.assertIs(timestamps.parse_mbta_datetime(value), timestamps.parse_mbta_datetime(value))
+
+
+class ModelTests(TestCase):
+    """
+    Tests for the compact models and the interned route registry.
+    """
+    def test_models_have_no_instance_dict(self):
+        route = models.Route("Red", "DA291C", "FFFFFF", "", "Red Line", [], [], 1)
+        prediction = models.Prediction("p1", None, None, 0, "None")
+        schedule = models.Schedule("s1", None, None, 0, route, "t1", "70079", prediction)
+        for obj in (route, prediction, schedule):
+            self.assertFalse(hasattr(obj, "__dict__"))
+        self.assertIsNone(schedule.arrival_time)
+        self.assertEqual(schedule.get_status(), "")
+
+    def test_registry_reuses_routes_and_refreshes_in_place(self):
+        now = [0]
+        registry = models.RouteRegistry(refresh_interval=60, clock=lambda: now[0])
+        built = []
+
+        def build(color):
+            built.append(color)
+            return models.Route("Red", color, "FFFFFF", "", "Red Line", [], [], 1)
+
+        red = registry.intern("Red", lambda: build("DA291C"))
+        self.assertIs(registry.intern("Red", lambda: build("000000")), red)
+        self.assertEqual(built, ["DA291C"])
+
+        now[0] = 61
+        self.assertIs(registry.intern("Red", lambda: build("000000")), red)
+        self.assertEqual(red.color, "000000")
+        self.assertEqual(len(registry), 1)
+
+
+@skipUnless(columnar.numpy, "numpy is not installed")
+class ColumnarTests(TestCase):
+    """
+    Tests for the optional NumPy backed schedule table.
+    """
+    def setUp(self):
+        self.red = models.Route("Red", "DA291C", "FFFFFF", "", "Red Line", ["Ashmont/Braintree", "Alewife"], [], 1)
+        self.rail = models.Route("CR-Fairmount", "80276C", "FFFFFF", "", "Fairmount Line", ["Readville", "South"],
+                                 [], 2)
+        self.start = timestamps.parse_mbta_datetime("2020-04-20T10:00:00-04:00")
+        self.schedule = []
+        for minute, route, direction in [(30, self.red, 0), (5, self.rail, 1), (15, self.red, 1), (45, self.rail, 0)]:
+            time = timestamps.parse_mbta_datetime(f"2020-04-20T10:{minute:02}:00-04:00")
+            prediction = models.Prediction(f"p{minute}", time.replace(minute=minute + 2), None, direction, None)
+            self.schedule.append(models.Schedule(f"s{minute}", time, None, direction, route, f"t{minute}", "stop",
+                                                 prediction if route is self.red else None))
+
+    def test_rows_are_sorted(self):
+        table = columnar.ScheduleTable.from_schedule(self.schedule)
+        self.assertEqual([s.id for s in table.to_list()], ["s5", "s15", "s30", "s45"])
+        self.assertEqual(table.prediction_deltas[1], 120)
+        self.assertTrue(columnar.numpy.isnan(table.prediction_deltas[0]))
+
+    def test_window_and_filter(self):
+        table = columnar.ScheduleTable.from_schedule(self.schedule)
+        window = table.window(self.start.replace(minute=10), self.start.replace(minute=45))
+        self.assertEqual([s.id for s in window.to_list()], ["s15", "s30"])
+        self.assertEqual([s.id for s in table.filter(route_types=[2]).to_list()], ["s5", "s45"])
+        self.assertEqual([s.id for s in table.filter(route_types=[1], direction_id=1).to_list()], ["s15"])
+        self.assertEqual([s.id for s in table.to_list(limit=1)], ["s5"])
+
+    def test_select_rows_uses_the_table(self):
+        schedule = sorted(self.schedule, key=models.Schedule.get_scheduled_time)
+        snapshot = models.StationSnapshot("place-sstat", schedule, {}, {}, self.start)
+        with mock.patch.object(services, "COLUMNAR_MIN_ROWS", 0):
+            selected = services.select_rows(snapshot, route_types=(1,), offset=1, limit=5)
+        self.assertIsNotNone(snapshot._table)
+        self.assertEqual([s.id for s in selected.schedule], ["s30"])
+        with mock.patch.object(columnar, "numpy", None):
+            plain = models.StationSnapshot("place-sstat", schedule, {}, {}, self.start)
+            self.assertIsNone(plain.get_table())
+            self.assertEqual(services.select_rows(plain, route_types=(1,), offset=1, limit=5).get_version(),
+                             selected.get_version())
+        small = models.StationSnapshot("place-sstat", schedule, {}, {}, self.start)
+        services.select_rows(small, route_types=(1,))
+        self.assertIsNone(small._table)  # too short to be worth a table
+
+
+class BatchedFetchTests(TestCase):
+    """
+    Tests for fetching many stations with a single call to the MBTA API.
+    """
+    def test_one_call_split_by_parent_station(self):
+        document = {
+            "data": [schedule_json("s1", "2020-04-20T10:30:00-04:00", "t1", stop="70079"),
+                     schedule_json("s2", "2020-04-20T10:10:00-04:00", "t2", stop="70080", prediction="p2"),
+                     schedule_json("s3", "2020-04-20T10:20:00-04:00", "t3", stop="North Station-01")],
+            "included": [route_json(), prediction_json("p2", "2020-04-20T10:12:00-04:00", "t2", stop="70080"),
+                         stop_json("70079", "place-sstat"), stop_json("70080", "place-sstat"),
+                         stop_json("North Station-01", "place-north")]}
+        server = start_upstream(self, [(200, {}, document, 0)])
+        use_upstream(self, server)
+
+        min_time = timestamps.parse_mbta_datetime("2020-04-20T10:00:00-04:00")  # within a single service day
+        results = services.get_schedules_for_stations(min_time, ["place-sstat", "place-north", "place-bbsta"])
+        self.assertEqual(len(server.requests), 1)
+        self.assertIn("place-sstat%2Cplace-north%2Cplace-bbsta", server.requests[0][0])
+
+        schedule, routes, predictions = results["place-sstat"]
+        self.assertEqual([s.id for s in schedule], ["s2", "s1"])
+        self.assertEqual(list(routes), ["Red"])
+        self.assertEqual(list(predictions), ["p2"])
+        self.assertEqual([s.id for s in results["place-north"][0]], ["s3"])
+        self.assertEqual(results["place-bbsta"], ([], {}, {}))
+
+
+@skipUnless(mbta.httpx, "httpx is not installed")
+class AsyncTests(TestCase):
+    """
+    Tests for the asyncio client and the async view, against a local stand-in for the MBTA API.
+    """
+    def setUp(self):
+        document = {"data": [schedule_json("s1", "2020-04-20T10:30:00-04:00", "t1")], "included": [route_json()]}
+        self.server = start_upstream(self, [(503, {}, None, 0), (200, {"ETag": '"v1"'}, document, 0),
+                                            (304, {}, None, 0)])
+        use_upstream(self, self.server)
+
+    def test_async_client_retries_and_uses_conditional_get(self):
+        first = async_to_sync(mbta.async_client.get)("schedules", {"filter[stop]": "place-sstat"})
+        second = async_to_sync(mbta.async_client.get)("schedules", {"filter[stop]": "place-sstat"})
+        self.assertIs(first, second)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.requests[-1][1]["If-None-Match"], '"v1"')
+
+    @override_settings(SCHEDULEBOARD_SCHEDULE_INTERVAL=600)
+    def test_schedule_windows_advance_in_parallel(self):
+        now = timestamps.parse_mbta_datetime("2020-04-20T10:00:00-04:00")
+        both_advancing = threading.Barrier(2, timeout=5)  # only passed if the two windows advance at the same time
+
+        def get_schedule_window(station, route_types=None):
+            def advance(min_time):
+                both_advancing.wait()
+                return {station: models.StationSnapshot(station, [], {}, {}, min_time)}
+            return mock.Mock(advance=advance)
+
+        async def fetch_both():
+            return await asyncio.gather(services.fetch_station_snapshot_async(now, "place-sstat"),
+                                        services.fetch_station_snapshot_async(now, "place-north"))
+
+        with mock.patch.object(services, "get_schedule_window", get_schedule_window), \
+                mock.patch.object(mbta.async_client, "get", mock.AsyncMock(return_value={"data": []})):
+            snapshots = async_to_sync(fetch_both)()
+        self.assertFalse(both_advancing.broken)
+        self.assertEqual([snapshot.station for snapshot in snapshots], ["place-sstat", "place-north"])
+
+    @override_settings(SCHEDULEBOARD_SCHEDULE_INTERVAL=0)
+    def test_async_view(self):
+        now = timestamps.parse_mbta_datetime("2020-04-20T10:00:00-04:00")  # a window within a single service day
+        with mock.patch("django.utils.timezone.localtime", return_value=now):
+            response = self.client.get("/schedule/async/")
+            self.assertContains(response, "Ashmont/Braintree")
+            self.client.get("/schedule/async/")
+        self.assertEqual(len(self.server.requests), 2)  # the second page load was served from the cache
+
+
+class ConditionalGetTests(TestCase):
+    """
+    Tests for the ETag support and the rendered page cache of the board view.
+    """
+    def setUp(self):
+        route = models.Route("Red", "DA291C", "FFFFFF", "", "Red Line", ["Ashmont/Braintree", "Alewife"], [], 1)
+        self.now = timestamps.parse_mbta_datetime("2020-04-20T10:00:00-04:00")
+        self.schedule = [models.Schedule("s1", self.now, None, 0, route, "t1", "70079", None)]
+        self.poller = poller.SnapshotPoller(["place-sstat"], 30)
+        self.poller.snapshots["place-sstat"] = models.StationSnapshot("place-sstat", self.schedule, {}, {}, self.now)
+        self.addCleanup(setattr, poller, "poller", None)
+        self.addCleanup(views.page_cache.clear)
+        poller.poller = self.poller
+        patcher = mock.patch("django.utils.timezone.localtime", return_value=self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_if_none_match_returns_304(self):
+        response = self.client.get("/schedule/")
+        etag = response["ETag"]
+        self.assertContains(response, "Ashmont/Braintree")
+        response = self.client.get("/schedule/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+    def test_pages_are_rendered_once_per_version(self):
+        with mock.patch.object(views, "render_page", wraps=views.render_page) as render_page:
+            first = self.client.get("/schedule/")
+            second = self.client.get("/schedule/")
+            self.assertEqual(render_page.call_count, 1)
+            self.assertEqual(first.content, second.content)
+
+            # the same content fetched again keeps its version, new content gets a new one
+            self.poller.snapshots["place-sstat"] = models.StationSnapshot("place-sstat", list(self.schedule), {}, {},
+                                                                          self.now)
+            self.assertEqual(self.client.get("/schedule/")["ETag"], first["ETag"])
+            self.poller.snapshots["place-sstat"] = models.StationSnapshot("place-sstat", [], {}, {}, self.now)
+            self.assertNotEqual(self.client.get("/schedule/")["ETag"], first["ETag"])
+            self.assertEqual(render_page.call_count, 2)
+
+    def test_later_rows_change_the_etag(self):
+        first = self.client.get("/schedule/", {"limit": "1"})
+        self.assertNotContains(first, "Later")
+        later = models.Schedule("s2", self.now.replace(minute=10), None, 0, self.schedule[0].route, "t2", "70079", None)
+        self.poller.snapshots["place-sstat"] = models.StationSnapshot("place-sstat", self.schedule + [later], {}, {},
+                                                                      self.now)
+        response = self.client.get("/schedule/", {"limit": "1"}, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(response.status_code, 200)  # the first page's rows are the same, but it links to the next
+        self.assertContains(response, "Later")
+
+    def test_switching_stations_keeps_the_filters(self):
+        response = self.client.get("/schedule/", {"route_type": ["1", "3"], "limit": "5", "page": "2"})
+        form = re.search(r'<form id="station_form".*?</form>', response.content.decode(), re.DOTALL).group(0)
+        self.assertEqual(re.findall(r'<input type="hidden" name="(\w+)" value="(\w+)">', form),
+                         [("route_type", "1"), ("route_type", "3"), ("limit", "5")])
+
+
+class DisplayTests(TestCase):
+    """
+    Tests for the precomputed display rows the board is rendered from.
+    """
+    def setUp(self):
+        self.route = models.Route("Red", "DA291C", "FFFFFF", "", "Red <Line>", ["Ashmont/Braintree", "Alewife"], [], 1)
+        self.time = timestamps.parse_mbta_datetime("2020-04-20T14:05:00-04:00")
+        prediction = models.Prediction("p1", self.time.replace(minute=7), None, 0, "Delayed")
+        self.schedule = [models.Schedule("s1", self.time, None, 0, self.route, "t1", "70079", prediction),
+                         models.Schedule("s2", self.time.replace(minute=20), None, 1, self.route, "t2", "70079", None)]
+
+    def test_rows_are_formatted(self):
+        rows = models.StationSnapshot("place-sstat", self.schedule, {}, {}, self.time).get_display_rows()
+        self.assertEqual(rows[0], display.DisplayRow("s1", int(self.time.timestamp()), "2:05 PM", "2:07 PM", 1,
+                                                     "Red <Line>", "Ashmont/Braintree", "Delayed", "DA291C", "FFFFFF"))
+        self.assertEqual((rows[1].predicted, rows[1].destination), ("", "Alewife"))
+
+    def test_rows_are_rendered_like_the_template_did(self):
+        html = display.render_rows(display.build_rows(self.schedule[:1]))
+        self.assertEqual(html, f'<tr class="route_type_1" data-id="s1" data-time="{int(self.time.timestamp())}">'
+                               '<td>2:05 PM</td><td>2:07 PM</td>'
+                               '<td style="color:FFFFFF" bgcolor="DA291C">Red &lt;Line&gt;</td>'
+                               '<td style="color:FFFFFF" bgcolor="DA291C">Ashmont/Braintree</td>'
+                               '<td>Delayed</td></tr>')
+
+    def test_unchanged_rows_are_rendered_once(self):
+        snapshot = models.StationSnapshot("place-sstat", self.schedule, {}, {}, self.time)
+        self.assertIs(snapshot.get_display_rows(), snapshot.get_display_rows())
+        # a later snapshot with the same content reuses the HTML rendered for the first one
+        later = models.StationSnapshot("place-sstat", list(self.schedule), {}, {}, self.time)
+        first, second = snapshot.get_display_rows()[0], later.get_display_rows()[0]
+        self.assertIsNot(first, second)
+        self.assertIs(display.render_row(first), display.render_row(second))
+
+
+class BoardApiTests(TestCase):
+    """
+    Tests for the JSON board API and its ?since= deltas.
+    """
+    def setUp(self):
+        self.route = models.Route("Red", "DA291C", "FFFFFF", "", "Red Line", ["Ashmont/Braintree", "Alewife"], [], 1)
+        self.poller = poller.SnapshotPoller(["place-sstat"], 30)
+        self.addCleanup(setattr, poller, "poller", None)
+        poller.poller = self.poller
+
+    def publish(self, *rows):
+        schedule = []
+        for sid, time, status in rows:
+            time = timestamps.parse_mbta_datetime(f"2020-04-20T{time}:00-04:00")
+            prediction = models.Prediction(f"p-{sid}", time, None, 0, status) if status else None
+            schedule.append(models.Schedule(sid, time, None, 0, self.route, f"t-{sid}", "70079", prediction))
+        self.poller.snapshots["place-sstat"] = models.StationSnapshot("place-sstat", schedule, {}, {}, None)
+
+    def test_full_board_then_delta(self):
+        self.publish(("s1", "10:00", None), ("s2", "10:15", None), ("s3", "10:30", None))
+        board = self.client.get("/schedule/api", {"station_selection": "place-sstat"}).json()
+        self.assertTrue(board["full"])
+        self.assertEqual([row["id"] for row in board["rows"]], ["s1", "s2", "s3"])
+        self.assertEqual(board["rows"][0]["scheduled_display"], "10:00 AM")
+        self.assertEqual(board["rows"][0]["route"]["name"], "Red Line")
+
+        self.publish(("s2", "10:15", "Delayed"), ("s3", "10:30", None), ("s4", "10:45", None))
+        delta = self.client.get("/schedule/api", {"station_selection": "place-sstat",
+                                                  "since": board["version"]}).json()
+        self.assertFalse(delta["full"])
+        self.assertEqual([row["id"] for row in delta["upserts"]], ["s2", "s4"])
+        self.assertEqual(delta["upserts"][0]["status"], "Delayed")
+        self.assertEqual(delta["removed"], ["s1"])
+
+        unchanged = self.client.get("/schedule/api", {"since": delta["version"]}).json()
+        self.assertEqual((unchanged["upserts"], unchanged["removed"]), ([], []))
+
+    def test_data_changes_before_the_first_poll(self):
+        self.publish(("s1", "10:00", None), ("s2", "10:15", None))
+        self.addCleanup(views.page_cache.clear)
+        html = self.client.get("/schedule/").content.decode()
+        with mock.patch.object(views, "delta_log", deltas.DeltaLog()):  # e.g. another worker process
+            html = self.client.get("/schedule/").content.decode()  # served from the page cache
+            version = re.search(r'data-version="([^"]+)"', html).group(1)
+            self.publish(("s2", "10:15", "Delayed"))
+            delta = self.client.get("/schedule/api", {"since": version}).json()
+        self.assertFalse(delta["full"])
+        self.assertEqual([row["id"] for row in delta["upserts"]], ["s2"])
+        self.assertEqual(delta["removed"], ["s1"])
+
+    def test_unknown_version_gets_full_board(self):
+        self.publish(("s1", "10:00", None))
+        board = self.client.get("/schedule/api", {"since": "forgotten"}).json()
+        self.assertTrue(board["full"])
+        self.assertEqual(len(board["rows"]), 1)
+
+
+class FilterTests(TestCase):
+    """
+    Tests for server-side route type filtering and paging of the board.
+    """
+    def setUp(self):
+        self.addCleanup(views.page_cache.clear)
+        red = models.Route("Red", "DA291C", "FFFFFF", "", "Red Line", ["Ashmont/Braintree", "Alewife"], [], 1)
+        rail = models.Route("CR-Fairmount", "80276C", "FFFFFF", "", "Fairmount Line", ["Readville", "South"], [], 2)
+        self.schedule = []
+        for minute in range(0, 60, 5):
+            time = timestamps.parse_mbta_datetime(f"2020-04-20T10:{minute:02}:00-04:00")
+            route = rail if minute % 15 == 0 else red
+            self.schedule.append(models.Schedule(f"s{minute}", time, None, 0, route, f"t{minute}", "stop", None))
+
+    @override_settings(SCHEDULEBOARD_SCHEDULE_INTERVAL=0)
+    def test_route_types_are_sent_upstream(self):
+        document = {"data": [schedule_json("s1", "2020-04-20T10:30:00-04:00", "t1")], "included": [route_json()]}
+        server = start_upstream(self, [(200, {}, document, 0)])
+        use_upstream(self, server)
+        response = self.client.get("/schedule/", {"route_type": ["2", "0", "nonsense"]})
+        self.assertContains(response, "Ashmont/Braintree")
+        self.assertIn("filter%5Broute_type%5D=0%2C2", server.requests[0][0])
+
+    @override_settings(SCHEDULEBOARD_SCHEDULE_INTERVAL=0)
+    def test_unknown_stations_fall_back_to_the_default(self):
+        document = {"data": [schedule_json("s1", "2020-04-20T10:30:00-04:00", "t1")], "included": [route_json()]}
+        server = start_upstream(self, [(200, {}, document, 0)])
+        use_upstream(self, server)
+        now = timestamps.parse_mbta_datetime("2020-04-20T10:00:00-04:00")
+        with mock.patch("django.utils.timezone.localtime", return_value=now):
+            response = self.client.get("/schedule/", {"station_selection": "place-made-up"})
+        self.assertContains(response, "South Station")
+        self.assertEqual(len(server.requests), 1)
+        self.assertIn("filter%5Bstop%5D=place-sstat&", server.requests[0][0])
+
+    def test_poller_snapshot_is_filtered_and_paged(self):
+        p = poller.SnapshotPoller(["place-sstat"], 30)
+        p.snapshots["place-sstat"] = models.StationSnapshot("place-sstat", self.schedule, {}, {}, None)
+        self.addCleanup(setattr, poller, "poller", None)
+        poller.poller = p
+
+        board = self.client.get("/schedule/api", {"route_type": "2"}).json()
+        self.assertEqual([row["id"] for row in board["rows"]], ["s0", "s15", "s30", "s45"])
+
+        board = self.client.get("/schedule/api", {"route_type": "1", "limit": "3", "page": "2"}).json()
+        self.assertEqual([row["id"] for row in board["rows"]], ["s25", "s35", "s40"])
+
+        response = self.client.get("/schedule/", {"limit": "5"})
+        self.assertContains(response, 'data-id="s20"')
+        self.assertNotContains(response, 'data-id="s25"')
+        self.assertContains(response, "page=2")
+
+
+class StoreTests(TestCase):
+    """
+    Tests for the database-backed schedule store.
+    """
+    def setUp(self):
+        self.red = models.Route("Red", "DA291C", "FFFFFF", "", "Red Line", ["Ashmont/Braintree", "Alewife"], [], 1)
+        self.rail = models.Route("CR-Fairmount", "80276C", "FFFFFF", "", "Fairmount Line", ["Readville", "South"],
+                                 [], 2)
+
+    def snapshot(self, status="On time"):
+        schedule = []
+        for minute in range(0, 60, 10):
+            time = timestamps.parse_mbta_datetime(f"2020-04-20T10:{minute:02}:00-04:00")
+            prediction = models.Prediction(f"p{minute}", time, None, 0, status) if minute == 20 else None
+            route = self.rail if minute == 30 else self.red
+            schedule.append(models.Schedule(f"s{minute}", time, None, 0, route, f"t{minute}", "70079", prediction))
+        return models.StationSnapshot("place-sstat", schedule, {}, {}, schedule[0].arrival_time)
+
+    def test_save_upserts_and_load_reads_one_window(self):
+        store.save_snapshot(self.snapshot())
+        with self.assertNumQueries(8):  # a lookup and one bulk UPDATE per table, inside a savepoint
+            store.save_snapshot(self.snapshot(status="Delayed"))
+        self.assertEqual(models.ScheduleRecord.objects.count(), 6)
+
+        start = timestamps.parse_mbta_datetime("2020-04-20T10:10:00-04:00")
+        end = timestamps.parse_mbta_datetime("2020-04-20T10:40:00-04:00")
+        with self.assertNumQueries(1):
+            snapshot = store.load_snapshot("place-sstat", start, end)
+        self.assertEqual([s.id for s in snapshot.schedule], ["s10", "s20", "s30"])
+        self.assertEqual(snapshot.schedule[1].get_status(), "Delayed")
+        self.assertEqual(snapshot.schedule[2].get_destination(), "Readville")
+        self.assertEqual(snapshot.get_version(), services.select_rows(
+            self.snapshot(status="Delayed"), offset=1, limit=3).get_version())
+
+        snapshot = store.load_snapshot("place-sstat", start, end, route_types=(2,))
+        self.assertEqual([s.id for s in snapshot.schedule], ["s30"])
+        self.assertEqual(store.load_snapshot("place-north", start, end).schedule, [])
+
+    def test_board_reads_from_store(self):
+        store.save_snapshot(self.snapshot())
+        now = timestamps.parse_mbta_datetime("2020-04-20T10:05:00-04:00")
+        with self.settings(SCHEDULEBOARD_STORE_ENABLED=True), \
+                mock.patch("django.utils.timezone.localtime", return_value=now), \
+                mock.patch.object(mbta.client, "get", side_effect=AssertionError("no upstream call expected")):
+            board = self.client.get("/schedule/api").json()
+        self.assertEqual([row["id"] for row in board["rows"]], ["s10", "s20", "s30", "s40", "s50"])
+
+    def test_stored_boards_show_when_they_were_ingested(self):
+        store.save_snapshot(self.snapshot())  # ingested at 10:00
+        later = self.snapshot()
+        later.schedule = later.schedule[3:]
+        later.fetched_at = timestamps.parse_mbta_datetime("2020-04-20T10:04:00-04:00")
+        store.save_snapshot(later)
+        start = timestamps.parse_mbta_datetime("2020-04-20T10:00:00-04:00")
+        snapshot = store.load_snapshot("place-sstat", start, start + timedelta(hours=1))
+        self.assertEqual(snapshot.fetched_at, start)  # the oldest row's
+        self.assertEqual(store.load_snapshot("place-sstat", later.schedule[0].arrival_time,
+                                             start + timedelta(hours=1)).fetched_at, later.fetched_at)
+
+        now = timestamps.parse_mbta_datetime("2020-04-20T10:08:00-04:00")  # s10 and s20 were not ingested since 10:00
+        with self.settings(SCHEDULEBOARD_STORE_ENABLED=True), \
+                mock.patch("django.utils.timezone.localtime", return_value=now):
+            response = self.client.get("/schedule/")
+        self.assertContains(response, "Last updated at 10:00 AM, 8 minutes ago")
+
+    def test_async_board_is_unavailable_when_the_store_fails(self):
+        with self.settings(SCHEDULEBOARD_STORE_ENABLED=True), \
+                mock.patch.object(views, "get_stored_snapshot", side_effect=DatabaseError("database is locked")):
+            response = self.client.get("/schedule/async/")
+        self.assertContains(response, "The MBTA API is not responding", status_code=503)
+
+    def test_delete_before(self):
+        store.save_snapshot(self.snapshot())
+        removed = store.delete_before(timestamps.parse_mbta_datetime("2020-04-20T10:30:00-04:00"))
+        self.assertEqual(removed, 3)
+        self.assertFalse(models.PredictionRecord.objects.exists())
+
+
+class SharedStoreTests(TestCase):
+    """
+    Tests for the memory-mapped snapshot store shared by worker processes.
+    """
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.route = models.Route("Red", "DA291C", "FFFFFF", "", "Red Line", ["Ashmont/Braintree", "Alewife"], [], 1)
+        self.now = timestamps.parse_mbta_datetime("2020-04-20T10:00:00-04:00")
+
+    def snapshot(self, *minutes):
+        schedule = [models.Schedule(f"s{minute}", self.now.replace(minute=minute), None, 0, self.route, f"t{minute}",
+                                    "70079", None) for minute in minutes]
+        return models.StationSnapshot("place-sstat", schedule, {"Red": self.route}, {}, self.now)
+
+    def test_station_keys_cannot_leave_the_directory(self):
+        store = shared.SharedSnapshotStore(self.directory)
+        for station in ["../place-sstat", "place/../../etc", os.path.abspath("place-sstat"), "..", ""]:
+            with self.assertRaises(ValueError):
+                store.get_path(station)
+        with mock.patch.object(shared, "snapshots", store), mock.patch.object(store, "read") as read:
+            self.assertIsNone(shared.get_snapshot("../scheduleboard/place-sstat"))
+            self.assertIsNone(shared.get_snapshot("place-unknown"))
+        read.assert_not_called()
+
+    def test_workers_read_what_the_refresher_wrote(self):
+        writer = shared.SharedSnapshotStore(self.directory)
+        worker = shared.SharedSnapshotStore(self.directory)  # as if in another process
+        self.assertIsNone(worker.read("place-sstat"))
+        self.assertEqual(writer.write(self.snapshot(10, 20)), 1)
+
+        first = worker.read("place-sstat")
+        self.assertEqual([s.id for s in first.schedule], ["s10", "s20"])
+        self.assertEqual(first.get_version(), self.snapshot(10, 20).get_version())
+        self.assertIs(first.schedule[0].route, first.schedule[1].route)
+        self.assertIs(worker.read("place-sstat"), first)  # not unpickled again
+
+        # the same content written again keeps the objects already loaded, new content is loaded
+        self.assertEqual(writer.write(self.snapshot(10, 20)), 2)
+        self.assertIs(worker.read("place-sstat"), first)
+        self.assertEqual(writer.write(self.snapshot(20, 30)), 3)
+        self.assertEqual([s.id for s in worker.read("place-sstat").schedule], ["s20", "s30"])
+        self.assertEqual(os.listdir(self.directory), ["place-sstat.snapshot"])  # no temporary files left behind
+
+    def test_stale_and_invalid_files_are_ignored(self):
+        writer = shared.SharedSnapshotStore(self.directory)
+        writer.write(self.snapshot(10))
+        with mock.patch("time.time", return_value=time.time() + 121):
+            self.assertIsNone(shared.SharedSnapshotStore(self.directory, max_age=120).read("place-sstat"))
+        with open(writer.get_path("place-sstat"), "wb") as f:
+            f.write(b"not a snapshot")
+        self.assertIsNone(shared.SharedSnapshotStore(self.directory).read("place-sstat"))
+        self.assertEqual(writer.write(self.snapshot(10)), 1)
+
+    def test_view_reads_the_shared_store(self):
+        self.addCleanup(setattr, shared, "snapshots", shared.snapshots)
+        shared.snapshots = shared.SharedSnapshotStore(self.directory)
+        shared.snapshots.write(self.snapshot(10, 20))
+        with mock.patch("django.utils.timezone.localtime", return_value=self.now), \
+                mock.patch.object(mbta.client, "get", side_effect=AssertionError("no upstream call expected")):
+            board = self.client.get("/schedule/api").json()
+        self.assertEqual([row["id"] for row in board["rows"]], ["s10", "s20"])
+
+
+def gtfs_zip(tables):
+    """
+    :param tables: a dictionary of file name -> list of rows, the first row being the header
+    :return: an in-memory GTFS zip file
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as feed:
+        for name, rows in tables.items():
+            feed.writestr(name, "\n".join(",".join(row) for row in rows) + "\n")
+    buffer.seek(0)
+    return buffer
+
+
+class GtfsTests(TestCase):
+    """
+    Tests for computing schedules from an imported GTFS feed.
+    """
+    def setUp(self):
+        feed = gtfs_zip({
+            "stops.txt": [["stop_id", "parent_station"], ["place-sstat", ""], ["70079", "place-sstat"],
+                          ["70000", "place-north"]],
+            "routes.txt": [["route_id", "route_color", "route_text_color", "route_short_name", "route_long_name",
+                            "route_type"], ["Red", "DA291C", "FFFFFF", "", "Red Line", "1"]],
+            "trips.txt": [["route_id", "service_id", "trip_id", "trip_headsign", "direction_id"],
+                          ["Red", "weekday", "T1", "Ashmont", "0"], ["Red", "weekday", "T2", "Ashmont", "0"],
+                          ["Red", "weekday", "T3", "Alewife", "1"], ["Red", "sunday", "T4", "Alewife", "1"]],
+            "stop_times.txt": [["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence",
+                                "pickup_type", "drop_off_type"],
+                               ["T1", "23:50:00", "23:50:00", "70079", "1", "0", "0"],
+                               ["T2", "24:40:00", "24:40:00", "70079", "1", "0", "0"],
+                               ["T3", "08:00:00", "08:00:00", "70079", "5", "1", "0"],
+                               ["T3", "08:30:00", "08:30:00", "70000", "9", "0", "0"],
+                               ["T4", "08:10:00", "08:10:00", "70079", "5", "0", "0"]],
+            "calendar.txt": [["service_id", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday",
+                              "sunday", "start_date", "end_date"],
+                             ["weekday", "1", "1", "1", "1", "1", "0", "0", "20200401", "20200430"],
+                             ["sunday", "0", "0", "0", "0", "0", "0", "1", "20200401", "20200430"]],
+            "calendar_dates.txt": [["service_id", "date", "exception_type"], ["weekday", "20200421", "2"]],
+        })
+        counts = gtfs.import_feed(feed, ["place-sstat"])
+        self.assertEqual(counts["stop times"], 4)
+
+    def test_service_day_runs_past_midnight(self):
+        # Tuesday has no weekday service, but Monday's 24:40 trip still leaves at 00:40 on Tuesday
+        min_time = timestamps.parse_mbta_datetime("2020-04-21T00:30:00-04:00")
+        with self.assertNumQueries(3):
+            schedule, routes = gtfs.get_schedule(min_time, "place-sstat")
+        self.assertEqual([s.id for s in schedule], ["schedule-T2-70079-1"])
+        self.assertEqual(schedule[0].get_scheduled_time(), timestamps.parse_mbta_datetime("2020-04-21T00:40:00-04:00"))
+
+    def test_window_runs_into_the_next_service_day(self):
+        # Thursday 23:00 to Friday 09:00: Thursday's last trips, then Friday's first ones
+        min_time = timestamps.parse_mbta_datetime("2020-04-23T23:00:00-04:00")
+        with self.assertNumQueries(3):
+            schedule, routes = gtfs.get_schedule(min_time, "place-sstat", hours=10)
+        self.assertEqual([s.id for s in schedule], ["schedule-T1-70079-1", "schedule-T2-70079-1",
+                                                    "schedule-T3-70079-5"])
+        self.assertEqual(schedule[2].get_scheduled_time(), timestamps.parse_mbta_datetime("2020-04-24T08:00:00-04:00"))
+
+    def test_schedule_matches_the_api(self):
+        min_time = timestamps.parse_mbta_datetime("2020-04-20T07:00:00-04:00")
+        schedule, routes = gtfs.get_schedule(min_time, "place-sstat")
+        self.assertEqual([s.id for s in schedule], ["schedule-T3-70079-5"])
+        self.assertIsNone(schedule[0].departure_time)  # no pickup, like the API's last stop of a trip
+        self.assertEqual(schedule[0].get_destination(), "Alewife")
+        self.assertEqual(routes["Red"].get_name(), "Red Line")
+        self.assertEqual(gtfs.get_schedule(min_time, "place-sstat", route_types=(2,)), ([], {}))
+
+    def test_only_predictions_are_fetched(self):
+        document = {"data": [prediction_json("p1", "2020-04-20T08:03:00-04:00", "T3", status="Delayed")]}
+        server = start_upstream(self, [(200, {}, document, 0), (404, {}, {}, 0)])
+        use_upstream(self, server)
+        min_time = timestamps.parse_mbta_datetime("2020-04-20T07:00:00-04:00")
+        with self.settings(SCHEDULEBOARD_GTFS_ENABLED=True):
+            snapshot = services.get_cached_station_snapshot(min_time, "place-sstat")
+            self.assertEqual(snapshot.schedule[0].get_status(), "Delayed")
+            self.assertEqual(list(snapshot.predictions), ["p1"])
+            self.assertTrue(server.requests[0][0].startswith("/predictions?filter%5Bstop%5D=place-sstat"))
+
+            services.schedule_cache.clear()
+            snapshot = services.get_cached_station_snapshot(min_time, "place-sstat")
+            self.assertEqual([s.id for s in snapshot.schedule], ["schedule-T3-70079-5"])
+            self.assertEqual(snapshot.predictions, {})
+
+
+class MetricsTests(TestCase):
+    """
+    Tests for the Server-Timing header and the Prometheus metrics endpoint.
+    """
+    def setUp(self):
+        metrics.registry.clear()
+        self.addCleanup(metrics.registry.clear)
+        self.addCleanup(views.page_cache.clear)
+        now = timestamps.parse_mbta_datetime("2020-04-20T14:00:00-04:00")
+        patcher = mock.patch("django.utils.timezone.localtime", return_value=now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = start_upstream(self, [(200, {}, stubs.schedule_document(now, 20), 0), (200, {}, {"data": []}, 0)])
+        use_upstream(self, self.server)
+
+    def test_server_timing_reports_each_stage(self):
+        response = self.client.get("/schedule/")
+        stages = [entry.split(";")[0] for entry in response["Server-Timing"].split(", ")]
+        self.assertEqual(stages, ["upstream", "decode", "parse_included", "create_schedule", "sort", "render", "total"])
+
+        response = self.client.get("/schedule/")  # the same minute: cached snapshot and page
+        self.assertEqual([entry.split(";")[0] for entry in response["Server-Timing"].split(", ")], ["total"])
+
+        text = self.client.get("/schedule/metrics").content.decode()
+        self.assertIn('scheduleboard_upstream_requests_total{path="schedules",status="200"} 1\n', text)
+        self.assertIn('scheduleboard_cache_requests_total{cache="schedule",result="hit"} 1\n', text)
+        self.assertIn('scheduleboard_cache_requests_total{cache="page",result="miss"} 1\n', text)
+        self.assertIn('scheduleboard_request_seconds_count{view="index"} 2\n', text)
+        self.assertIn('scheduleboard_stage_seconds_bucket{stage="render",le="+Inf"} 1\n', text)
+        self.assertIn("# TYPE scheduleboard_stage_seconds histogram\n", text)
+
+    def test_upstream_errors_are_counted(self):
+        self.server.responses = [(404, {}, {}, 0)]
+        with self.assertRaises(requests.HTTPError):
+            mbta.client.get("schedules")
+        self.assertEqual(metrics.registry.get_counter("scheduleboard_upstream_errors_total",
+                                                      (("path", "schedules"),)), 1)
+
+
+class RateLimitTests(TestCase):
+    """
+    Tests for the rate limiter in front of the MBTA API.
+    """
+    def test_bucket_and_reserve(self):
+        limiter = ratelimit.RateLimiter(rate=50, capacity=10, reserve=0.2)
+        for i in range(8):
+            self.assertTrue(limiter.acquire(ratelimit.LOW, timeout=0))
+        self.assertFalse(limiter.acquire(ratelimit.LOW, timeout=0))  # the last two tokens are kept for page loads
+        self.assertTrue(limiter.acquire(ratelimit.HIGH, timeout=0))
+        self.assertTrue(limiter.acquire(ratelimit.HIGH, timeout=0))
+        self.assertFalse(limiter.acquire(ratelimit.HIGH, timeout=0))
+        self.assertTrue(limiter.acquire(ratelimit.HIGH, timeout=1))  # waits about 1/50 seconds for a token
+
+    def test_adapts_to_rate_limit_headers(self):
+        limiter = ratelimit.RateLimiter.per_minute(20)
+        limiter.observe(200, {"x-ratelimit-limit": "1000", "x-ratelimit-remaining": "3",
+                              "x-ratelimit-reset": str(time.time() + 60)})
+        self.assertEqual(limiter.capacity, 1000)
+        self.assertLessEqual(limiter.tokens, 3)
+        limiter.observe(429, {"retry-after": "30"})
+        self.assertFalse(limiter.acquire(timeout=1))
+
+    def test_client_sends_key_and_waits_out_429(self):
+        server = start_upstream(self, [(429, {"Retry-After": "0.1"}, {}, 0), (200, {}, {"data": []}, 0)])
+        limiter = ratelimit.RateLimiter(rate=100, capacity=5)
+        client = mbta.MBTAClient(base_url=server.url, backoff=0.01, api_key="secret", limiter=limiter)
+        start = time.monotonic()
+        self.assertEqual(client.get("schedules"), {"data": []})
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        self.assertEqual([headers.get("x-api-key") for path, headers in server.requests], ["secret", "secret"])
+
+        limiter.observe(429, {"retry-after": "30"})
+        with self.assertRaises(ratelimit.RateLimited):
+            mbta.MBTAClient(base_url=server.url, limiter=limiter, queue_timeout=0.1).get("schedules")
+
+    def test_waiting_for_a_token_is_not_upstream_time(self):
+        server = start_upstream(self, [(200, {}, {"data": []}, 0)])
+        events = []
+        stage = metrics.stage
+
+        @contextlib.contextmanager
+        def record_stage(name):
+            events.append(f"start {name}")
+            with stage(name):
+                yield
+            events.append(f"end {name}")
+
+        limiter = mock.Mock(**{"acquire.side_effect": lambda priority, timeout: events.append("token") or True})
+        with mock.patch.object(metrics, "stage", record_stage):
+            mbta.MBTAClient(base_url=server.url, limiter=limiter).get("schedules")
+        self.assertEqual(events[:3], ["token", "start upstream", "end upstream"])
+
+    def test_viewed_stations_are_refreshed_first(self):
+        calls = []
+        self.addCleanup(setattr, poller, "viewers", poller.viewers)
+        poller.viewers = ratelimit.ViewerTracker(ttl=60)
+
+        def fetch(min_time, stations):
+            calls.append((stations, ratelimit.priority.get()))
+            if ratelimit.priority.get() == ratelimit.LOW:
+                raise ratelimit.RateLimited("shed")
+            return {station: ([], {}, {}) for station in stations}
+
+        poller.viewers.touch("place-north")
+        p = poller.SnapshotPoller(["place-sstat", "place-north"], 30, fetch=fetch)
+        p.refresh_all()
+        self.assertEqual(calls, [(["place-north"], ratelimit.HIGH), (["place-sstat"], ratelimit.LOW)])
+        self.assertEqual(list(p.snapshots), ["place-north"])
+
+
+class SplitRefreshTests(TestCase):
+    """
+    Tests for refreshing schedules rarely and predictions often.
+    """
+    def setUp(self):
+        self.now = timestamps.parse_mbta_datetime("2020-04-20T10:00:00-04:00")
+        self.document = {"data": [schedule_json("s1", "2020-04-20T09:58:00-04:00", "t1"),
+                                  schedule_json("s2", "2020-04-20T10:30:00-04:00", "t2"),
+                                  schedule_json("s3", "2020-04-20T10:40:00-04:00", "t3")],
+                         "included": [route_json()]}
+
+    def predictions(self, status):
+        return {"data": [prediction_json("p1", "2020-04-20T10:02:00-04:00", "t1", status="Boarding"),
+                         prediction_json("p3", "2020-04-20T10:45:00-04:00", "t3", status=status)]}
+
+    def test_merge_predictions(self):
+        skeleton = models.StationSnapshot("place-sstat", *services.parse_schedule_document(self.document)[:2], {},
+                                          self.now)
+        first = services.merge_predictions(skeleton, services.parse_predictions(self.predictions("Delayed")),
+                                           self.now)
+        self.assertEqual([s.get_status() for s in first.schedule], ["Boarding", "", "Delayed"])
+        self.assertIs(first.schedule[1], skeleton.schedule[1])  # no prediction, shared with the skeleton
+        self.assertIsNone(skeleton.schedule[2].prediction)
+
+        later = timestamps.parse_mbta_datetime("2020-04-20T10:05:00-04:00")
+        second = services.merge_predictions(skeleton, services.parse_predictions(self.predictions("Delayed")), later)
+        self.assertEqual([s.id for s in second.schedule], ["s2", "s3"])  # s1 has left
+        self.assertEqual(second.get_version(), services.select_rows(first, offset=1).get_version())
+
+    def test_poller_fetches_schedules_once(self):
+        fetched, statuses = [], iter(["Delayed", "Cancelled"])
+
+        def fetch(min_time, stations, max_time=None):
+            fetched.append(stations)
+            return {station: services.parse_schedule_document(self.document) for station in stations}
+
+        def fetch_predictions(stations):
+            return services.parse_predictions(self.predictions(next(statuses)))
+
+        p = poller.SnapshotPoller(["place-sstat"], 10, fetch=fetch, schedule_interval=600,
+                                  fetch_predictions=fetch_predictions)
+        with mock.patch("django.utils.timezone.localtime", return_value=self.now):
+            p.refresh_all()
+            self.assertEqual(p.get_snapshot("place-sstat").schedule[2].get_status(), "Delayed")
+            p.refresh_all()
+        self.assertEqual(p.get_snapshot("place-sstat").schedule[2].get_status(), "Cancelled")
+        self.assertEqual(fetched, [["place-sstat"]])
+
+    def test_page_loads_fetch_only_predictions(self):
+        server = start_upstream(self, [(200, {}, self.document, 0), (200, {}, self.predictions("Delayed"), 0)])
+        use_upstream(self, server)
+        self.addCleanup(views.page_cache.clear)
+        for minute in ("10:00", "10:01", "10:02"):
+            now = timestamps.parse_mbta_datetime(f"2020-04-20T{minute}:00-04:00")
+            with mock.patch("django.utils.timezone.localtime", return_value=now):
+                self.assertContains(self.client.get("/schedule/", {"route_type": "1"}), "Delayed")
+        paths = [path.split("?")[0] for path, headers in server.requests]
+        self.assertEqual(paths, ["/schedules", "/predictions", "/predictions", "/predictions"])
+        self.assertIn("include=route&", server.requests[0][0])
+        self.assertIn("filter%5Broute_type%5D=1", server.requests[1][0])
+
+    @skipUnless(mbta.httpx, "httpx is not installed")
+    def test_async_page_loads_fetch_only_predictions(self):
+        server = start_upstream(self, [(200, {}, self.document, 0), (200, {}, self.predictions("Delayed"), 0)])
+        use_upstream(self, server)
+        self.addCleanup(views.page_cache.clear)
+        for minute in ("10:00", "10:01"):
+            now = timestamps.parse_mbta_datetime(f"2020-04-20T{minute}:00-04:00")
+            with mock.patch("django.utils.timezone.localtime", return_value=now):
+                self.assertContains(self.client.get("/schedule/async/"), "Delayed")
+        self.assertEqual([path.split("?")[0] for path, headers in server.requests],
+                         ["/schedules", "/predictions", "/predictions"])
+
+
+class ScheduleWindowTests(TestCase):
+    """
+    Tests for service day windows and the sliding window of schedules.
+    """
+    def setUp(self):
+        self.route = models.Route("Red", "DA291C", "FFFFFF", "", "Red Line", ["Ashmont/Braintree", "Alewife"], [], 1)
+
+    def test_windows_are_split_by_service_day(self):
+        def windows(time):
+            min_time = timestamps.parse_mbta_datetime(f"2020-04-20T{time}:00-04:00")
+            return [(p["filter[date]"], p["filter[min_time]"], p["filter[max_time]"])
+                    for p in services.schedule_payloads(min_time, "place-sstat")]
+
+        self.assertEqual(windows("10:00"), [("2020-04-20", "10:00", "16:00")])
+        # the previous day's trips after midnight count on past 24:00, the next day's first trips from 00:00
+        self.assertEqual(windows("22:00"), [("2020-04-20", "22:00", "28:00"), ("2020-04-21", "00:00", "04:00")])
+        self.assertEqual(windows("00:30"), [("2020-04-19", "24:30", "28:00"), ("2020-04-20", "00:30", "06:30")])
+
+    def test_window_fetches_only_the_missing_end(self):
+        calls, clock = [], [0]
+
+        def fetch(min_time, stations, max_time):
+            calls.append((min_time.strftime("%H:%M"), max_time.strftime("%H:%M")))
+            times = [min_time + timedelta(minutes=minute)
+                     for minute in range(0, int((max_time - min_time).total_seconds() // 60) + 1, 10)]
+            schedule = [models.Schedule(f"s{time:%H%M}", time, None, 0, self.route, f"t{time:%H%M}", "70079", None)
+                        for time in times]
+            return {station: (schedule, {"Red": self.route}, {}) for station in stations}
+
+        w = window.ScheduleWindow(["place-sstat"], fetch, step=600, reset=3600, clock=lambda: clock[0])
+        at = lambda time: timestamps.parse_mbta_datetime(f"2020-04-20T{time}:00-04:00")
+        first = w.advance(at("10:00"))["place-sstat"]
+        self.assertEqual(len(first.schedule), 37)
+        self.assertEqual(w.advance(at("10:05"))["place-sstat"].get_version(), first.get_version())  # no call
+
+        second = w.advance(at("10:40"))["place-sstat"]
+        self.assertEqual(calls, [("10:00", "16:00"), ("16:00", "16:40")])
+        # schedules that left more than half an hour ago are dropped, the one at 16:00 is not repeated
+        self.assertEqual(second.schedule[0].get_scheduled_time(), at("10:10"))
+        self.assertEqual(len(second.schedule), len({s.id for s in second.schedule}))
+        self.assertEqual(second.schedule[-1].get_scheduled_time(), at("16:40"))
+
+        clock[0] = 3600  # the whole window is fetched again every reset seconds, and after falling behind
+        w.advance(at("10:45"))
+        w.advance(at("17:00"))
+        self.assertEqual(calls[2:], [("10:45", "16:45"), ("17:00", "23:00")])
+
+
+class StaleServingTests(TestCase):
+    """
+    Tests for the circuit breaker and for serving the last good snapshot while the MBTA API is failing or slow.
+    """
+    def setUp(self):
+        self.document = {"data": [schedule_json("s2", "2020-04-20T10:30:00-04:00", "t2"),
+                                  schedule_json("s3", "2020-04-20T10:40:00-04:00", "t3")],
+                         "included": [route_json()]}
+        self.addCleanup(views.page_cache.clear)
+
+    def predictions(self, status):
+        return {"data": [prediction_json("p3", "2020-04-20T10:45:00-04:00", "t3", status=status)]}
+
+    def get(self, time, path="/schedule/"):
+        now = timestamps.parse_mbta_datetime(f"2020-04-20T{time}:00-04:00")
+        with mock.patch("django.utils.timezone.localtime", return_value=now):
+            return self.client.get(path, {"route_type": "1"})
+
+    def test_breaker_opens_and_probes(self):
+        clock = [0]
+        circuit = breaker.CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=lambda: clock[0])
+        circuit.record_failure()
+        self.assertTrue(circuit.allow())
+        circuit.record_failure()
+        self.assertTrue(circuit.is_open)
+        self.assertFalse(circuit.allow())
+        clock[0] = 30
+        self.assertTrue(circuit.allow())  # one probe...
+        self.assertFalse(circuit.allow())  # ...per reset_timeout
+        circuit.record_success()
+        self.assertFalse(circuit.is_open)
+        self.assertTrue(circuit.allow())
+
+    def test_client_fails_fast_while_open(self):
+        server = start_upstream(self, [(503, {}, None, 0)])
+        client = mbta.MBTAClient(base_url=server.url, retries=0,
+                                 circuit=breaker.CircuitBreaker(failure_threshold=2, reset_timeout=30))
+        for attempt in range(2):
+            with self.assertRaises(requests.HTTPError):
+                client.get("schedules")
+        with self.assertRaises(breaker.CircuitOpen):
+            client.get("schedules")
+        self.assertEqual(len(server.requests), 2)
+
+    def test_exhausted_429s_open_the_circuit(self):
+        server = start_upstream(self, [(429, {"Retry-After": "0"}, {}, 0)])
+        client = mbta.MBTAClient(base_url=server.url, retries=0,
+                                 circuit=breaker.CircuitBreaker(failure_threshold=2, reset_timeout=30))
+        for attempt in range(2):
+            with self.assertRaises(requests.HTTPError):
+                client.get("schedules")
+        self.assertTrue(client.circuit.is_open)
+
+    def test_serves_last_good_snapshot_when_upstream_fails(self):
+        server = start_upstream(self, [(200, {}, self.document, 0), (200, {}, self.predictions("Delayed"), 0),
+                                       (500, {}, None, 0)])
+        use_upstream(self, server)
+        response = self.get("10:00")
+        self.assertContains(response, "Delayed")
+        self.assertNotContains(response, "Last updated")
+
+        response = self.get("10:05")
+        self.assertContains(response, "Delayed")
+        self.assertContains(response, "Last updated at 10:00 AM, 5 minutes ago")
+        board = json.loads(self.get("10:05", "/schedule/api").content)
+        self.assertEqual(board["fetched_at"], "2020-04-20T10:00:00-04:00")
+
+    def test_no_snapshot_is_unavailable(self):
+        server = start_upstream(self, [(500, {}, None, 0)])
+        use_upstream(self, server)
+        response = self.get("10:00")
+        self.assertContains(response, "The MBTA API is not responding", status_code=503)
+        self.assertEqual(self.get("10:00", "/schedule/api").status_code, 503)
+
+    @override_settings(SCHEDULEBOARD_STALE_WHILE_REVALIDATE=True)
+    def test_stale_while_revalidate(self):
+        release = threading.Event()  # the upstream does not answer the revalidation until it is set
+        server = start_upstream(self, [(200, {}, self.document, 0), (200, {}, self.predictions("Delayed"), 0),
+                                       (200, {}, self.predictions("Cancelled"), release)])
+        self.addCleanup(release.set)
+        use_upstream(self, server)
+        self.assertContains(self.get("10:00"), "Delayed")
+
+        now = timestamps.parse_mbta_datetime("2020-04-20T10:05:00-04:00")
+        with mock.patch("django.utils.timezone.localtime", return_value=now):
+            for load in range(2):  # served while the revalidation is still waiting on the upstream
+                response = self.client.get("/schedule/", {"route_type": "1"})
+                self.assertContains(response, "Last updated at 10:00 AM, 5 minutes ago")
+                self.assertTrue(services._revalidating)
+            release.set()
+            deadline = time.monotonic() + 5
+            while services._revalidating and time.monotonic() < deadline:
+                time.sleep(0.01)
+            response = self.client.get("/schedule/", {"route_type": "1"})
+        self.assertContains(response, "Cancelled")
+        self.assertNotContains(response, "Last updated")
+        self.assertEqual(len(server.requests), 3)  # one revalidation, however many page loads
+
+
+class PushTests(TestCase):
+    """
+    Tests for pushing board updates to subscribed displays.
+    """
+    def setUp(self):
+        self.everything = {'route_types': None, 'page': 1, 'limit': None}
+        self.subway = {'route_types': (1,), 'page': 1, 'limit': None}
+
+    def snapshot(self, seed):
+        min_time = timestamps.parse_mbta_datetime("2020-04-20T10:00:00-04:00")
+        schedule, routes, predictions = services.parse_schedule_document(stubs.schedule_document(min_time, 12,
+                                                                                                 seed=seed))
+        return models.StationSnapshot("place-sstat", schedule, routes, predictions, min_time)
+
+    @staticmethod
+    def decode(event):
+        return json.loads(event.decode().split("data: ", 1)[1])
+
+    def test_updates_are_encoded_once_per_group(self):
+        current = [self.snapshot(0)]
+        broadcaster = push.Broadcaster(fetch=lambda station: current[0], interval=0.01, delta_log=deltas.DeltaLog())
+
+        async def run():
+            first, second, subway = push.Subscriber(), push.Subscriber(), push.Subscriber()
+            groups = [broadcaster.subscribe("place-sstat", self.everything, first),
+                      broadcaster.subscribe("place-sstat", self.everything, second),
+                      broadcaster.subscribe("place-sstat", self.subway, subway)]
+            self.assertEqual(len(broadcaster.groups), 2)
+            task = broadcaster._tasks["place-sstat"]
+            initial = [self.decode(await asyncio.wait_for(s.queue.get(), 5)) for s in (first, second, subway)]
+            current[0] = self.snapshot(1)
+            updates = [await asyncio.wait_for(s.queue.get(), 5) for s in (first, second, subway)]
+            for group, subscriber in zip(groups, (first, second, subway)):
+                broadcaster.unsubscribe(group, subscriber)
+            await task
+            return initial, updates
+
+        initial, updates = async_to_sync(run)()
+        self.assertTrue(all(board["full"] for board in initial))
+        self.assertIs(updates[0], updates[1])  # one delta for the whole group
+        delta = self.decode(updates[0])
+        self.assertFalse(delta["full"])
+        self.assertEqual(delta["since"], initial[0]["version"])
+        self.assertEqual({row["route"]["route_type"] for row in self.decode(updates[2])["upserts"]}, {1})
+        self.assertEqual(broadcaster.groups, {})
+        self.assertEqual(broadcaster._tasks, {})
+
+    def test_slow_display_gets_a_full_board(self):
+        log = deltas.DeltaLog()
+        group = push.Group("place-sstat", self.everything)
+        subscriber = push.Subscriber(max_pending=2)
+        group.subscribers.add(subscriber)
+        for seed in range(5):
+            group.publish(self.snapshot(seed), log)
+        self.assertEqual(subscriber.resyncs, 2)
+        self.assertEqual(subscriber.queue.qsize(), 1)
+        board = self.decode(subscriber.queue.get_nowait())
+        self.assertTrue(board["full"])
+        self.assertEqual(board["version"], self.snapshot(4).get_version())
+
+    @override_settings(SCHEDULEBOARD_PUSH_ENABLED=True)
+    def test_event_stream(self):
+        broadcaster = push.Broadcaster(fetch=lambda station: self.snapshot(0), interval=0.01,
+                                       delta_log=deltas.DeltaLog())
+        fallback = mock.AsyncMock()
+        application = push.PushApplication(fallback, broadcaster)
+        scope = {'type': 'http', 'method': 'GET', 'path': '/schedule/events', 'root_path': '', 'headers': [],
+                 'query_string': b'station_selection=place-sstat&route_type=1'}
+
+        async def run():
+            sent, received = [], asyncio.Event()
+
+            async def receive():
+                await received.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+                if message.get('body', b'').startswith(b'event: board'):
+                    received.set()
+
+            await asyncio.wait_for(application(scope, receive, send), 5)
+            await asyncio.gather(*broadcaster._tasks.values())
+            await application(dict(scope, path='/schedule/'), receive, send)
+            return sent
+
+        sent = async_to_sync(run)()
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'), sent[0]['headers'])
+        board = self.decode(sent[1]['body'])
+        self.assertEqual(board["station"], "place-sstat")
+        self.assertEqual({row["route"]["route_type"] for row in board["rows"]}, {1})
+        self.assertEqual(broadcaster.groups, {})
+        fallback.assert_awaited_once()
+        self.assertEqual(self.client.get("/schedule/events").status_code, 501)  # not served by Django itself
+
+    def test_disabled_push_is_left_to_django(self):
+        broadcaster = mock.Mock()
+        fallback = mock.AsyncMock()
+        scope = {'type': 'http', 'method': 'GET', 'path': '/schedule/events', 'root_path': '', 'headers': [],
+                 'query_string': b''}
+        async_to_sync(push.PushApplication(fallback, broadcaster))(scope, mock.AsyncMock(), mock.AsyncMock())
+        fallback.assert_awaited_once()
+        broadcaster.serve.assert_not_called()
+
+
+class MultiStationTests(TestCase):
+    """
+    Tests for the multi-station board.
+    """
+    def setUp(self):
+        self.now = timestamps.parse_mbta_datetime("2020-04-20T10:00:00-04:00")
+        self.addCleanup(services.last_good.clear)
+
+    def snapshot(self, station, fetched_at=None):
+        schedule, routes, predictions = services.parse_schedule_document(stubs.schedule_document(self.now, 6))
+        return models.StationSnapshot(station, schedule, routes, predictions, fetched_at or self.now)
+
+    def get(self, wait=lambda station: None, **params):
+        def get_snapshot(station, route_types=None):
+            wait(station)
+            return self.snapshot(station)
+
+        with mock.patch.object(views, "get_snapshot", side_effect=get_snapshot), \
+                mock.patch("django.utils.timezone.localtime", return_value=self.now):
+            return self.client.get("/schedule/multi", {"stations": "place-sstat,place-north,place-sstat", **params})
+
+    def test_stations_are_fetched_in_parallel(self):
+        both_fetching = threading.Barrier(2, timeout=5)  # only passed if the two fetches overlap
+        response = self.get(lambda station: both_fetching.wait())
+        self.assertFalse(both_fetching.broken)
+        self.assertContains(response, "South Station")
+        self.assertContains(response, "North Station")
+        self.assertContains(response, '<table class="schedule_table">', count=2)
+
+    def test_unknown_stations_are_ignored(self):
+        response = self.get(stations="place-sstat,../place-north,place-bogus,place-sstat")
+        self.assertContains(response, '<table class="schedule_table">', count=1)
+        self.assertContains(response, "South Station")
+
+    @override_settings(SCHEDULEBOARD_MULTI_TIMEOUT=0.2)
+    def test_slow_station_degrades_alone(self):
+        earlier = timestamps.parse_mbta_datetime("2020-04-20T09:57:00-04:00")
+        services.last_good.set(services.window_key("place-north", None), self.snapshot("place-north", earlier))
+        release = threading.Event()  # place-north does not answer until the test is over
+        self.addCleanup(release.set)
+
+        def wait(station):
+            if station == "place-north":
+                release.wait(5)
+
+        response = self.get(wait)
+        self.assertContains(response, '<table class="schedule_table">', count=2)
+        self.assertContains(response, "Last updated at 9:57 AM, 3 minutes ago", count=1)
+
+        services.last_good.clear()
+        response = self.get(wait)
+        self.assertContains(response, '<table class="schedule_table">', count=1)
+        self.assertContains(response, "The MBTA API is not responding for this station")
+
+
+class StationStreamTests(TestCase):
+    """
+    Tests for building the board from a station's streams. The streaming clients are never started; events are
+    applied to the indexes directly.
+    """
+    def setUp(self):
+        self.now = timestamps.parse_mbta_datetime("2020-04-20T10:00:00-04:00")
+        self.stream = streaming.StationStream("place-sstat")
+        self.addCleanup(streaming.streams.pop, "place-sstat", None)
+        self.addCleanup(services.schedule_cache.clear)
+        streaming.streams["place-sstat"] = self.stream
+
+    def test_snapshots_are_built_from_the_streams(self):
+        self.assertIsNone(streaming.get_stream("place-sstat"))  # nothing received yet
+        self.stream.schedules.apply("reset", [route_json(), route_json("Green-B", 0),
+                                              schedule_json("s1", "2020-04-20T09:50:00-04:00", "t1"),
+                                              schedule_json("s2", "2020-04-20T10:30:00-04:00", "t2"),
+                                              schedule_json("s3", "2020-04-20T10:40:00-04:00", "t3", rid="Green-B"),
+                                              schedule_json("s4", "2020-04-20T17:00:00-04:00", "t4")])
+        self.stream.predictions.apply("reset", [prediction_json("p2", "2020-04-20T10:35:00-04:00", "t2",
+                                                                status="Delayed")])
+        with mock.patch.object(mbta.client, "get", side_effect=AssertionError("the MBTA API was called")):
+            snapshot = services.get_cached_station_snapshot(self.now, "place-sstat")
+            self.assertEqual([s.id for s in snapshot.schedule], ["s2", "s3"])  # s1 has left, s4 is after the window
+            self.assertEqual(snapshot.schedule[0].get_status(), "Delayed")
+            self.assertIs(services.get_cached_station_snapshot(self.now, "place-sstat"), snapshot)
+
+            self.stream.predictions.apply("update", prediction_json("p2", "2020-04-20T10:38:00-04:00", "t2",
+                                                                    status="Boarding"))
+            subway = services.get_cached_station_snapshot(self.now, "place-sstat", (1,))
+        self.assertEqual([(s.id, s.get_status()) for s in subway.schedule], [("s2", "Boarding")])
@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta, timezone
+import functools
+
+"""
+This file contains the parser for the timestamps returned by the MBTA API. Every schedule and prediction carries up to
+two of them, and many rows share the exact same minute, so parsed values are memoized.
+"""
+
+# This is how the MBTA API currently returns all datetime values.
+mbta_datetime_format = "%Y-%m-%dT%H:%M:%S%z"
+
+
+def fix_UTC_offset(date_string):
+    """
+    Python 3.6 and lower does not like when a date string has a colon in the UTC offset, such as
+    2020-04-20T23:59:59-04:00
+    Intead, Pyton 3.6 and lower needs the colon removed:
+     2020-04-20T23:59:59-0400
+
+    We can fix this easily by simply removing the colon if it exists.
+    (Python 3.7 and later does not have this issue.)
+
+    See https://stackoverflow.com/questions/30999230/how-to-parse-timezone-with-colon for an example.
+
+    :param date_string: a date string of the format "%Y-%m-%dT%H:%M:%S%z"
+    :return: The date string with the UTC offset fixed
+    """
+    if ":" == date_string[-3:-2]:
+        date_string = date_string[:-3] + date_string[-2:]
+    return date_string
+
+
+@functools.lru_cache(maxsize=None)
+def _utc_offset(minutes):
+    """
+    :param minutes: a UTC offset in minutes, e.g. -240
+    :return: a shared datetime.timezone for the offset (there are only ever a couple of them)
+    """
+    return timezone(timedelta(minutes=minutes))
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_mbta_datetime(date_string):
+    """
+    Parses a timestamp returned by the MBTA API, such as 2020-04-20T23:59:59-04:00.
+    Timestamps in exactly that layout are sliced apart directly, which is much faster than strptime; anything else
+    falls back to strptime. Results are memoized, so a timestamp shared by many rows is only parsed once.
+    :param date_string: a date string of the format "%Y-%m-%dT%H:%M:%S%z"
+    :return: a timezone aware datetime
+    """
+    if len(date_string) == 25 and date_string[10] == "T" and date_string[22] == ":" and date_string[19] in "+-":
+        offset = int(date_string[20:22]) * 60 + int(date_string[23:25])
+        if date_string[19] == "-":
+            offset = -offset
+        return datetime(int(date_string[0:4]), int(date_string[5:7]), int(date_string[8:10]),
+                        int(date_string[11:13]), int(date_string[14:16]), int(date_string[17:19]),
+                        tzinfo=_utc_offset(offset))
+    return datetime.strptime(fix_UTC_offset(date_string), mbta_datetime_format)
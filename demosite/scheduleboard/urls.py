@@ -3,10 +3,19 @@ from django.urls import path
 from . import views
 """
 The schedule board has two paths: a default path that lets the view pick the default station, and a /station URL that
-includes the user's selected station.
+includes the user's selected station. The same two paths are available under async/ for ASGI deployments, and /multi
+shows several stations side by side. The board is also available as JSON at /api, which the page uses to update
+itself in place, or pushed as server-sent events at /events on ASGI deployments (see push.py). /metrics serves the
+board's instrumentation to Prometheus.
 """
 
 urlpatterns = [
     path('', views.index, name='index'),
-    path('station', views.index, name='index')
+    path('station', views.index, name='index'),
+    path('async/', views.index_async, name='index_async'),
+    path('async/station', views.index_async, name='index_async'),
+    path('multi', views.multi, name='multi'),
+    path('api', views.board_api, name='board_api'),
+    path('events', views.board_events, name='board_events'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
@@ -1,13 +1,47 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.template.loader import render_to_string
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import timedelta
+from urllib.parse import urlencode
 import logging
-from . import services, forms, models
+from . import display, services, forms, metrics, models, poller, shared, store
+from .cache import TTLCache
+from .deltas import DeltaLog
 
 logger = logging.getLogger(__name__)
 """
-This class contains a single view - the view used to display the schedule board.
+This class contains the views used to display the schedule board: index, index_async for ASGI deployments,
+multi, which shows several stations side by side, board_api, which serves the board as JSON, board_events, which
+stands in for the push channel of push.py on WSGI deployments, and metrics_view, which serves the board's
+instrumentation.
 """
 
+# Rendered pages, keyed by (station, ETag). The ETag changes whenever the snapshot or the displayed minute does.
+page_cache = TTLCache(ttl=60, max_size=getattr(settings, 'SCHEDULEBOARD_PAGE_CACHE_SIZE', 64), name='page')
+
+# The route types the board can be filtered by (see models.Route), and the largest page size a client may ask for.
+ROUTE_TYPES = ((0, 'Streetcar'), (1, 'Subway'), (2, 'Commuter Rail'), (3, 'Bus'))
+MAX_ROWS = 500
+
+# The recent versions of each station's board, used to answer board_api's ?since= requests with only the changes.
+delta_log = DeltaLog(history=getattr(settings, 'SCHEDULEBOARD_DELTA_HISTORY', 20))
+
+# How far ahead the board reads from the database-backed store; the same six hours the MBTA API is asked for.
+STORE_WINDOW = timedelta(hours=6)
+
+# The stations of the multi-station board are fetched in parallel on this pool. It is bounded, so that many wall
+# displays loading at once cannot start an unbounded number of calls to the MBTA API.
+station_pool = ThreadPoolExecutor(max_workers=getattr(settings, 'SCHEDULEBOARD_MULTI_WORKERS', 8),
+                                  thread_name_prefix='scheduleboard-multi')
+MAX_STATIONS = 8
+
+# Boards older than this are labeled with their age, e.g. while the MBTA API is down and the last good one is served.
+STALE_AFTER = timedelta(seconds=getattr(settings, 'SCHEDULEBOARD_STALE_AFTER', 90))
+
 
 # Create your views here.
 def index(request):
@@ -15,40 +49,391 @@ def index(request):
     To display the schedule board, we perform a few simple steps.
 
     1. Did the user select a station from the drop-down menu? If so, use that station.
-    Otherwise, default to South Station.
+    Otherwise, default to South Station. Also read the route types, page and page size the user asked for, if any.
 
-    2. Get the schedules, routes, and predictions for the station, starting at time now.
+    2. Get the snapshot of schedules, routes, and predictions for the station. If the background poller is running,
+    we use its latest snapshot. If SCHEDULEBOARD_SHARED_DIR is set, we use the snapshot `manage.py publishsnapshots`
+    shares with every worker process. If SCHEDULEBOARD_STORE_ENABLED is set, we read it from our own database, which
+    `manage.py ingest` keeps up to date. Otherwise we fetch one starting at time now, asking the MBTA API for only the
+    selected route types. Fetched snapshots are cached for a short time, so many page loads in the same minute share a
+    single call to the MBTA API. If the MBTA API cannot be reached, we serve the last good snapshot instead, labeled
+    with its age, or an empty board with 503 Service Unavailable if we have none.
 
-    3. Create the station form, with the initial selection corresponding to the station selected during step 1.
+    3. If the browser already has this exact page (its If-None-Match matches our ETag), answer 304 Not Modified.
 
-    4. Render the template.
+    4. Otherwise render the requested page of the board, or reuse the page already rendered for the same ETag.
 
     :param request:
     :return:
     """
 
-    station_key = models.STATION_CHOICES[0][0]
-    logger.debug(f"POST contents were {request.POST}")
-    if request.POST.get('station_selection'):
-        station_key = request.POST.get('station_selection')
+    station_key = get_station_key(request)
+    filters = get_board_filters(request)
+    try:
+        snapshot = get_snapshot(station_key, filters['route_types'])
+    except Exception as e:
+        logger.error(f"Could not get a snapshot of {station_key}: {e!r}")
+        return render_unavailable(station_key, filters)
+    return render_board(request, snapshot, filters)
+
+
+async def index_async(request):
+    """
+    The same schedule board as index, for ASGI deployments. Waiting on the MBTA API does not tie up a thread, so a
+    single process can serve many page loads that are waiting on slow upstream calls. Requires httpx.
+    :param request:
+    :return:
+    """
+    station_key = get_station_key(request)
+    filters = get_board_filters(request)
+
+    poller.viewers.touch(station_key)
+    snapshot = poller.get_snapshot(station_key) or get_shared_snapshot(station_key)
+    if snapshot:
+        return render_board(request, services.select_rows(snapshot, route_types=filters['route_types']), filters)
+    try:
+        if getattr(settings, 'SCHEDULEBOARD_STORE_ENABLED', False):
+            # in a worker thread of its own, so slow database reads do not queue up on a single shared thread
+            snapshot = await sync_to_async(get_stored_snapshot, thread_sensitive=False)(station_key,
+                                                                                       filters['route_types'])
+        else:
+            snapshot = await services.get_station_snapshot_async(timezone.localtime(), station_key,
+                                                                 filters['route_types'])
+    except Exception as e:
+        logger.error(f"Could not get a snapshot of {station_key}: {e!r}")
+        return render_unavailable(station_key, filters)
+
+    return render_board(request, snapshot, filters)
+
+
+def multi(request):
+    """
+    Shows several stations side by side, e.g. /schedule/multi?stations=place-sstat,place-north, for wall displays.
+    The stations are fetched in parallel (see get_snapshots), so the page takes about as long as its slowest station
+    rather than all of them together, and a station that is not ready within SCHEDULEBOARD_MULTI_TIMEOUT seconds shows
+    its last good snapshot, or a notice, instead of holding up the others. The route_type and limit parameters apply
+    to every station.
+    :param request:
+    :return:
+    """
+    stations = get_station_keys(request)
+    filters = get_board_filters(request)
+    current_datetime = timezone.localtime()
+    snapshots = get_snapshots(stations, filters['route_types'], current_datetime)
+    boards = []
+    for station in stations:
+        snapshot = snapshots[station]
+        board = {'station': station, 'name': models.get_station_display_name(station),
+                 'unavailable': snapshot is None}
+        if snapshot is not None:
+            page = select_page(snapshot, dict(filters, page=1))
+            board.update({'rows_html': display.render_rows(page.get_display_rows()) if page.schedule else '',
+                          'fetched_at': display.format_time(snapshot.fetched_at),
+                          'data_age': get_data_age(snapshot, current_datetime)})
+        boards.append(board)
+    with metrics.stage("render"):
+        html = render_to_string('scheduleboard/multi.html', {
+            'boards': boards,
+            'current_datetime': current_datetime,
+            'refresh_seconds': getattr(settings, 'SCHEDULEBOARD_CLIENT_REFRESH', 30),
+        })
+    response = HttpResponse(html)
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+def board_api(request):
+    """
+    Serves a station's board as JSON, see deltas.DeltaLog.get_board. Clients that pass the version they already have
+    as ?since=<version> only receive the rows that were added, changed or removed since then.
+    The same route_type, limit and page parameters as the board page are supported. If there is no snapshot to serve,
+    the answer is 503 Service Unavailable.
+    :param request:
+    :return:
+    """
+    station_key = get_station_key(request)
+    filters = get_board_filters(request)
+    try:
+        snapshot = get_snapshot(station_key, filters['route_types'])
+    except Exception as e:
+        logger.error(f"Could not get a snapshot of {station_key}: {e!r}")
+        response = JsonResponse({'station': station_key, 'error': "The MBTA API is not responding"}, status=503)
+        response['Retry-After'] = str(getattr(settings, 'SCHEDULEBOARD_CLIENT_REFRESH', 30))
+        return response
+    board = delta_log.get_board(select_page(snapshot, filters), request.GET.get('since'))
+    return JsonResponse(board)
+
+
+def board_events(request):
+    """
+    The push channel of the board, /schedule/events, is served by push.PushApplication in front of Django, so this view
+    only answers when the site does not run that ASGI application (see demosite/asgi.py).
+    :param request:
+    :return:
+    """
+    return HttpResponse("Board updates are only pushed by the ASGI application, see demosite/asgi.py.", status=501,
+                        content_type='text/plain; charset=utf-8')
+
+
+def metrics_view(request):
+    """
+    Serves the request latencies, stage timings, upstream call and cache counters in the Prometheus text format.
+    :param request:
+    :return:
+    """
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def get_snapshot(station_key, route_types=None):
+    """
+    :param station_key: the selected station
+    :param route_types: a tuple of route types to include, or None for every route type
+    :return: the background poller's latest models.StationSnapshot for the station if there is one, or else the one
+    published to the shared snapshot store (either filtered down to route_types), otherwise the stored snapshot if
+    SCHEDULEBOARD_STORE_ENABLED is set, otherwise a (cached) snapshot of route_types fetched starting at time now, or
+    the last good one if it cannot be fetched (see services.get_snapshot_or_stale)
+    """
+    poller.viewers.touch(station_key)
+    snapshot = poller.get_snapshot(station_key) or get_shared_snapshot(station_key)
+    if snapshot:
+        return services.select_rows(snapshot, route_types=route_types)
+    if getattr(settings, 'SCHEDULEBOARD_STORE_ENABLED', False):
+        return get_stored_snapshot(station_key, route_types)
+    return services.get_snapshot_or_stale(timezone.localtime(), station_key, route_types)
+
+
+def get_snapshots(station_keys, route_types, current_datetime):
+    """
+    Gets the snapshots of several stations at once, each one as get_snapshot would, in parallel on station_pool.
+    Stations that fail, or are not ready within SCHEDULEBOARD_MULTI_TIMEOUT seconds, get their last good snapshot
+    instead; those still being fetched keep going in the background, so their next page load is likely to find them
+    cached.
+    :param station_keys: the selected stations
+    :param route_types: a tuple of route types to include, or None for every route type
+    :param current_datetime: the current time
+    :return: a dictionary of station -> models.StationSnapshot, or None if there is no snapshot of it at all
+    """
+    timeout = getattr(settings, 'SCHEDULEBOARD_MULTI_TIMEOUT', 5)
+    futures = {station_key: station_pool.submit(get_snapshot, station_key, route_types) for station_key in station_keys}
+    wait(futures.values(), timeout=timeout)
+    snapshots = {}
+    for station_key, future in futures.items():
+        if future.done() and future.exception() is None:
+            snapshots[station_key] = future.result()
+            continue
+        if future.done():
+            logger.error(f"Could not get a snapshot of {station_key}: {future.exception()!r}")
+        else:
+            logger.warning(f"{station_key} was not ready within {timeout} seconds, not waiting for it")
+        snapshots[station_key] = services.get_stale_snapshot(current_datetime, station_key, route_types)
+    return snapshots
+
+
+def get_shared_snapshot(station_key):
+    """
+    :param station_key: the selected station
+    :return: the station's snapshot from the shared snapshot store (see shared.py), or None if it is not used or has
+    no fresh snapshot
+    """
+    if shared.snapshots is None:
+        return None
+    with metrics.stage("shared"):
+        return shared.get_snapshot(station_key)
+
+
+def get_stored_snapshot(station_key, route_types=None):
+    """
+    :param station_key: the selected station
+    :param route_types: a tuple of route types to include, or None for every route type
+    :return: the station's next STORE_WINDOW of schedules, read from the database-backed store (see store.py)
+    """
+    now = timezone.localtime()
+    with metrics.stage("store"):
+        return store.load_snapshot(station_key, now, now + STORE_WINDOW, route_types)
+
+
+def get_board_filters(request):
+    """
+    Reads the optional route_type (repeatable), limit and page query parameters. Invalid values are ignored.
+    :param request:
+    :return: a dictionary with the selected route_types (a sorted tuple, or None for every route type), the page
+    (counting from 1) and limit (the number of rows per page, or None to show every row)
+    """
+    known = {route_type for route_type, name in ROUTE_TYPES}
+    route_types = tuple(sorted({int(value) for value in request.GET.getlist('route_type')
+                                if value.isdigit() and int(value) in known}))
+    limit = request.GET.get('limit', '')
+    limit = min(int(limit), MAX_ROWS) if limit.isdigit() and int(limit) > 0 else None
+    page = request.GET.get('page', '')
+    page = int(page) if page.isdigit() and int(page) > 0 and limit else 1
+    return {'route_types': route_types or None, 'page': page, 'limit': limit}
+
+
+def select_page(snapshot, filters):
+    """
+    :param snapshot: a models.StationSnapshot
+    :param filters: the board filters, see get_board_filters
+    :return: a models.StationSnapshot with only the rows of the requested page
+    """
+    if not filters['limit']:
+        return snapshot
+    return services.select_rows(snapshot, offset=(filters['page'] - 1) * filters['limit'], limit=filters['limit'])
+
+
+def has_next_page(filters, total_rows):
+    """
+    :param filters: the board filters, see get_board_filters
+    :param total_rows: the number of rows on every page together
+    :return: True if there are rows after the requested page
+    """
+    return bool(filters['limit']) and filters['page'] * filters['limit'] < total_rows
+
+
+def get_filter_query(station_key, filters, page=None):
+    """
+    :return: the query string that selects station_key with the given filters, optionally for a different page
+    """
+    query = {'station_selection': station_key, 'route_type': filters['route_types'] or ()}
+    if filters['limit']:
+        query['limit'] = filters['limit']
+        query['page'] = page or filters['page']
+    return urlencode(query, doseq=True)
+
+
+def get_station_keys(request):
+    """
+    :param request:
+    :return: the known stations of the comma separated stations parameter, without duplicates and at most
+    MAX_STATIONS of them, or every station of models.STATION_CHOICES if there are none
+    """
+    station_keys = []
+    for station_key in request.GET.get('stations', '').split(','):
+        station_key = station_key.strip()
+        if not station_key or station_key in station_keys:
+            continue
+        if models.is_known_station(station_key):
+            station_keys.append(station_key)
+        else:
+            logger.warning(f"Ignoring unknown station {station_key!r}")
+    return station_keys[:MAX_STATIONS] or [station_key for station_key, name in models.STATION_CHOICES]
+
+
+def get_station_key(request):
+    """
+    :param request:
+    :return: the station the user selected from the drop-down menu, or the first of models.STATION_CHOICES if none
+    was selected or the selection is not one of them. Station keys become cache keys, poller stations and MBTA API
+    calls, so unknown ones are never let through.
+    """
+    station_key = request.GET.get('station_selection') or request.POST.get('station_selection')
+    if station_key and models.is_known_station(station_key):
         logger.debug(f"User selected {station_key}")
+        return station_key
+    if station_key:
+        logger.warning(f"Ignoring unknown station {station_key!r}")
+    return models.STATION_CHOICES[0][0]
+
+
+def render_board(request, snapshot, filters):
+    """
+    Renders the schedule board for a station snapshot, answering conditional requests with 304 Not Modified.
+    The page shows the current time to the minute, so the ETag covers the version of the displayed rows, the filters,
+    whether there is a next page to link to, and the minute. The displayed version is recorded in delta_log, which the page's board_api polls ask for changes
+    since.
+    :param request:
+    :param snapshot: the models.StationSnapshot to display
+    :param filters: the board filters, see get_board_filters
+    :return: the response
+    """
+    current_datetime = timezone.localtime()
+    page = select_page(snapshot, filters)
+    delta_log.record(page)  # so the page's first ?since= poll gets a delta, even for a page rendered earlier
+    route_types = "".join(str(route_type) for route_type in filters['route_types'] or ())
+    etag = f'"{page.get_version()}-{route_types}-{filters["page"]}-{filters["limit"]}-{current_datetime:%Y%m%d%H%M}'
+    if has_next_page(filters, len(snapshot.schedule)):
+        etag += '-next'  # the same rows, but with a link to the later ones
+    if get_data_age(snapshot, current_datetime):
+        etag += '-stale'  # the same rows, but labeled with their age
+    etag += '"'
 
-    min_time = timezone.localtime()
-    schedule, routes, predictions = services.get_schedules_routes_and_predictions(min_time, station_key)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        html = page_cache.get_or_fetch((snapshot.station, etag),
+                                       lambda: render_page(page, current_datetime, filters, len(snapshot.schedule)))
+        response = HttpResponse(html)
+    response['ETag'] = etag
+    patch_cache_control(response, no_cache=True)  # browsers must revalidate, which is cheap thanks to the ETag
+    return response
 
+
+def render_unavailable(station_key, filters):
+    """
+    Renders an empty schedule board saying that the MBTA API is not responding, for when there is no snapshot at all
+    to show. The page reloads itself after SCHEDULEBOARD_CLIENT_REFRESH seconds.
+    :param station_key: the selected station
+    :param filters: the board filters, see get_board_filters
+    :return: a 503 Service Unavailable response
+    """
+    snapshot = models.StationSnapshot(station_key, [], {}, {}, None)
+    response = HttpResponse(render_page(snapshot, timezone.localtime(), filters, 0, unavailable=True), status=503)
+    response['Retry-After'] = str(getattr(settings, 'SCHEDULEBOARD_CLIENT_REFRESH', 30))
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+def get_data_age(snapshot, current_datetime):
+    """
+    :param snapshot: a models.StationSnapshot
+    :param current_datetime: the current time
+    :return: the number of whole minutes since the snapshot was fetched if that is more than STALE_AFTER, otherwise 0
+    """
+    if not snapshot.fetched_at or current_datetime - snapshot.fetched_at <= STALE_AFTER:
+        return 0
+    return int((current_datetime - snapshot.fetched_at).total_seconds() // 60)
+
+
+def render_page(snapshot, current_datetime, filters, total_rows, unavailable=False):
+    """
+    Renders the schedule board template to a string. The page is shared by every visitor, so it is rendered without
+    a request and must not contain anything visitor specific (such as a CSRF token).
+    :param snapshot: the models.StationSnapshot to display, already cut down to the requested page
+    :param current_datetime: the time shown in the page header
+    :param filters: the board filters, see get_board_filters
+    :param total_rows: the number of rows on every page together, used to link to the next page
+    :param unavailable: True to say that the MBTA API is not responding instead of that there is no schedule
+    :return: the page's HTML
+    """
+    schedule, routes, predictions = snapshot.schedule, snapshot.routes, snapshot.predictions
     logger.debug(f"Calling template with {len(schedule)} schedules, {len(routes)} routes and {len(predictions)} predictions")
 
     template_name = 'scheduleboard/index.html'
 
-    station_form = forms.StationForm(initial={'station_selection': station_key})
-    logger.debug(f"station form is: {type(station_form)}")
-    station_display_name = models.get_station_display_name(station_key)
-
-    return render(request, template_name, {
-        'schedule': schedule,
-        'routes': routes,
-        'predictions': predictions,
-        'current_datetime': timezone.localtime(),
-        'station_form': station_form,
-        'station_display_name': station_display_name
-    })
+    station_form = forms.StationForm(initial={'station_selection': snapshot.station})
+    station_display_name = models.get_station_display_name(snapshot.station)
+
+    with metrics.stage("render"):
+        return render_to_string(template_name, {
+            'schedule': schedule,
+            'rows_html': display.render_rows(snapshot.get_display_rows()),
+            'routes': routes,
+            'predictions': predictions,
+            'current_datetime': current_datetime,
+            'fetched_at': display.format_time(snapshot.fetched_at),
+            'data_age': get_data_age(snapshot, current_datetime),
+            'unavailable': unavailable,
+            'station_form': station_form,
+            'station_display_name': station_display_name,
+            'station': snapshot.station,
+            'version': snapshot.get_version(),
+            'refresh_seconds': getattr(settings, 'SCHEDULEBOARD_CLIENT_REFRESH', 30),
+            'push_enabled': getattr(settings, 'SCHEDULEBOARD_PUSH_ENABLED', False),
+            'route_types': [(route_type, name, not filters['route_types'] or route_type in filters['route_types'])
+                            for route_type, name in ROUTE_TYPES],
+            'filter_query': get_filter_query(snapshot.station, filters),
+            'previous_query': get_filter_query(snapshot.station, filters, filters['page'] - 1)
+            if filters['page'] > 1 else None,
+            'next_query': get_filter_query(snapshot.station, filters, filters['page'] + 1)
+            if has_next_page(filters, total_rows) else None,
+            'selected_route_types': filters['route_types'] or (),
+            'limit': filters['limit'],
+        })
@@ -0,0 +1,106 @@
+from datetime import timedelta
+import logging
+import threading
+import time
+from .models import Schedule, StationSnapshot
+
+"""
+This file contains the sliding window of schedules used by split refreshes (see SCHEDULEBOARD_SCHEDULE_INTERVAL).
+Rather than downloading a station's whole six hour window again, the window drops the schedules that have passed and
+fetches only the part at its end that has opened up since the last fetch, so a refresh downloads schedules in
+proportion to the time that went by rather than to the size of the window. The whole window is still fetched again
+every so often, to pick up changes to the schedules already held.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Schedules are kept this long after their scheduled time, so that services.merge_predictions can keep showing a
+# delayed train until its predicted time has passed.
+DEPARTED_GRACE = timedelta(minutes=30)
+
+
+class ScheduleWindow:
+    """
+    The schedules, without predictions, of one or more stations over the hours starting now. Stations that need the
+    same part of the window are fetched together.
+    """
+
+    def __init__(self, stations, fetch, hours=6, step=600, reset=3600, clock=time.monotonic):
+        """
+        Creates a new, empty window
+        :param stations: a list of station keys
+        :param fetch: a function taking (min_time, stations, max_time=...) and returning a dictionary of station ->
+        tuple of schedules and routes (anything after those is ignored), e.g. services.get_schedules_for_stations
+        with predictions=False
+        :param hours: the length of the window
+        :param step: the number of seconds the end of the window may fall behind before the missing part is fetched,
+        so that refreshes in between make no call at all
+        :param reset: the number of seconds after which the whole window is fetched again
+        :param clock: a function returning the current time in seconds, mostly useful for tests
+        """
+        self.stations = list(stations)
+        self.fetch = fetch
+        self.length = timedelta(hours=hours)
+        self.step = timedelta(seconds=step)
+        self.reset = reset
+        self.clock = clock
+        self._schedules = {}  # station -> list of models.Schedule, in chronological order
+        self._routes = {}  # station -> dictionary of route_id -> models.Route
+        self._covered = {}  # station -> the time up to which its schedules were fetched
+        self._reset_at = {}  # station -> clock() when its whole window was last fetched
+        self._lock = threading.Lock()
+
+    def advance(self, now, stations=None):
+        """
+        Moves the window to start at now: stations seen for the first time, not refreshed for longer than the window
+        or due for a reset are fetched whole, and the others only for the part of the window they are missing.
+        Concurrent callers wait for the fetch in progress rather than making their own.
+        :param now: the (timezone aware) start of the window
+        :param stations: the stations to advance, or None for all of them
+        :return: a dictionary of station -> models.StationSnapshot without predictions
+        """
+        stations = self.stations if stations is None else stations
+        end = now + self.length
+        with self._lock:
+            whole = [station for station in stations if station not in self._covered or now >= self._covered[station]
+                     or self.clock() - self._reset_at[station] >= self.reset]
+            if whole:
+                self._fetch(whole, now, end, replace=True)
+            tails = {}  # start of the missing part -> stations missing it
+            for station in stations:
+                if station not in whole and end - self._covered[station] >= self.step:
+                    tails.setdefault(self._covered[station], []).append(station)
+            for start, group in tails.items():
+                self._fetch(group, start, end, replace=False)
+            return {station: self._snapshot(station, now) for station in stations}
+
+    def _fetch(self, stations, start, end, replace):
+        """
+        Fetches stations' schedules from start to end, replacing what is held or adding to it.
+        """
+        results = self.fetch(start, stations, max_time=end)
+        for station in stations:
+            schedule, routes = results[station][:2]
+            if replace:
+                self._schedules[station], self._routes[station] = list(schedule), dict(routes)
+                self._reset_at[station] = self.clock()
+            else:
+                held = self._schedules[station]
+                known = {s.id for s in held}  # a schedule right at start can be returned by both fetches
+                held.extend(s for s in schedule if s.id not in known)
+                held.sort(key=Schedule.get_scheduled_time)  # already nearly sorted, so this is cheap
+                self._routes[station].update(routes)
+            self._covered[station] = end
+        logger.debug(f"Fetched {'the whole window' if replace else 'the end of the window'} ({start} to {end}) "
+                     f"for {len(stations)} stations")
+
+    def _snapshot(self, station, now):
+        """
+        Drops the station's schedules that have passed, and returns the others as a new snapshot.
+        """
+        held, cutoff = self._schedules[station], now - DEPARTED_GRACE
+        passed = 0
+        while passed < len(held) and held[passed].get_scheduled_time() < cutoff:
+            passed += 1
+        del held[:passed]
+        return StationSnapshot(station, list(held), dict(self._routes[station]), {}, now)